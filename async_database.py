@@ -0,0 +1,442 @@
+import asyncio
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from tracing import span
+from user_cache import UserProfile, UserProfileCache
+
+logger = logging.getLogger(__name__)
+
+# Асинхронная обёртка над database.py: запросы выполняются в отдельных потоках,
+# event loop aiogram никогда не ждёт SQLite.
+READ_WORKERS = 4
+WRITE_BATCH_SIZE = 256
+# Нажатия "Сделано"/"Пропуск" копятся в памяти и пишутся одной транзакцией
+# раз в STATS_FLUSH_MS или как только накопилось STATS_FLUSH_ENTRIES
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_MS", 200)) / 1000
+STATS_FLUSH_ENTRIES = int(os.getenv("STATS_FLUSH_ENTRIES", 500))
+
+_read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="db-read")
+
+
+class BatchWriter:
+    # Единственный поток-писатель. Всё, что накопилось в очереди, пока шла
+    # предыдущая транзакция, выполняется одной транзакцией (каждая операция — в своём SAVEPOINT).
+    def __init__(self, max_batch=WRITE_BATCH_SIZE):
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-write", daemon=True)
+                self._thread.start()
+
+    def submit(self, func, *args):
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((func, args, future, loop))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = self._next_batch()
+            if None in batch:
+                stop = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                self._execute(batch)
+        database.close_connection()
+
+    def _execute(self, batch):
+        outcomes = []
+        try:
+            with database.get_connection():
+                for func, args, future, loop in batch:
+                    try:
+                        with database.get_connection():
+                            outcomes.append((future, loop, func(*args), None))
+                    except Exception as e:
+                        outcomes.append((future, loop, None, e))
+        except Exception as e:
+            # Не удалось закоммитить — ни одна операция пачки не записана
+            logger.exception("Write batch of %s operations failed", len(batch))
+            outcomes = [(future, loop, None, e) for _, _, future, loop in batch]
+        # Результаты отдаём только после COMMIT
+        for future, loop, result, error in outcomes:
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+_writer = BatchWriter()
+
+
+async def _read(func, *args):
+    with span(f"db.{func.__name__}"):
+        return await asyncio.get_running_loop().run_in_executor(_read_executor, func, *args)
+
+
+async def _write(func, *args):
+    # Время спана включает ожидание своей очереди в пачке писателя
+    with span(f"db.{func.__name__}"):
+        return await _writer.submit(func, *args)
+
+
+def _reads(func):
+    @functools.wraps(func)
+    async def wrapper(*args):
+        return await _read(func, *args)
+    return wrapper
+
+
+class StatsBuffer:
+    # Write-behind для update_habit_stats: нажатия по одной привычке сливаются в одну запись
+    # (счётчики +N одним UPDATE), все привычки — в одну транзакцию apply_habit_stats.
+    # Каждое нажатие хранится отдельным событием: ничего не перезаписывается до сброса.
+    # Чтения данных пользователя сначала дожидаются записи его нажатий (read-your-writes).
+    def __init__(self, flush_interval=STATS_FLUSH_INTERVAL, max_entries=STATS_FLUSH_ENTRIES):
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self._pending = {}
+        self._entries = 0
+        self._users = set()
+        self._flushing_users = set()
+        self._wake = None
+        self._lock = None
+        self._task = None
+        self._closing = False
+
+    @property
+    def pending(self):
+        return self._entries
+
+    def _ensure_started(self):
+        if self._task is None:
+            self._closing = False
+            self._wake = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    def add(self, habit_id, user_id, is_done, ts=None):
+        self._ensure_started()
+        # Ключ — пара (привычка, пользователь): чужое нажатие не вытесняет ещё не записанные
+        # нажатия владельца, apply_habit_stats просто его не применит
+        self._pending.setdefault((habit_id, user_id), []).append((int(ts if ts is not None else time.time()), is_done))
+        self._users.add(user_id)
+        self._entries += 1
+        if self._entries >= self.max_entries:
+            self._wake.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Stats flush failed")
+
+    async def flush(self):
+        if self._lock is None:
+            return
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending, self._entries = self._pending, {}, 0
+            self._flushing_users, self._users = self._users, set()
+            try:
+                await _write(database.apply_habit_stats, [(habit_id, user_id, events) for (habit_id, user_id), events in pending.items()])
+            except Exception:
+                # Не записалось — возвращаем нажатия в буфер, следующий сброс попробует снова
+                for (habit_id, user_id), events in pending.items():
+                    self._pending.setdefault((habit_id, user_id), [])[:0] = events
+                    self._users.add(user_id)
+                    self._entries += len(events)
+                raise
+            finally:
+                self._flushing_users = set()
+
+    async def flush_user(self, user_id):
+        if user_id in self._users or user_id in self._flushing_users:
+            await self.flush()
+
+    async def close(self):
+        if self._task is not None:
+            # Флаг — на случай, если wait_for проглотит отмену (см. ReminderScheduler.stop)
+            self._closing = True
+            self._wake.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+stats_buffer = StatsBuffer()
+
+
+def _user_reads(func, user_arg=0):
+    # Чтение данных одного пользователя: сперва дописываем его нажатия из буфера
+    @functools.wraps(func)
+    async def wrapper(*args):
+        await stats_buffer.flush_user(args[user_arg])
+        return await _read(func, *args)
+    return wrapper
+
+
+def _writes(func):
+    @functools.wraps(func)
+    async def wrapper(*args):
+        return await _write(func, *args)
+    return wrapper
+
+
+# --- Схема ---
+init_db = _writes(database.init_db)
+
+# --- Изменения расписания напоминаний ---
+# Подписчик (reminder_scheduler.py) получает (habit_ids, user_id) после каждой записи,
+# которая могла сдвинуть время напоминания, и сам перечитывает нужные строки.
+# Другие копии бота узнают о том же из журнала schedule_changes (get_schedule_changes).
+_schedule_listeners = []
+
+
+def on_schedule_change(listener):
+    _schedule_listeners.append(listener)
+
+
+async def _schedule_changed(habit_ids=(), user_id=None):
+    habit_ids = list(habit_ids)
+    if habit_ids or user_id is not None:
+        try:
+            await _write(database.log_schedule_changes, habit_ids, user_id)
+        except Exception:
+            # Другие копии всё равно подхватят изменение при полной перезагрузке колеса
+            logger.exception("Failed to log schedule change")
+    for listener in _schedule_listeners:
+        try:
+            await listener(habit_ids, user_id)
+        except Exception:
+            logger.exception("Schedule listener failed")
+
+
+# --- Привычки ---
+get_all_user_habits = _user_reads(database.get_all_user_habits)
+get_user_habits_page = _user_reads(database.get_user_habits_page)
+get_user_habit = _user_reads(database.get_user_habit, user_arg=1)
+
+
+async def update_habit_stats(habit_id, user_id, is_done):
+    # Возвращается сразу: запись уйдёт с ближайшим сбросом stats_buffer
+    stats_buffer.add(habit_id, user_id, is_done)
+
+
+async def add_habit(user_id, name, freq, time):
+    habit_id = await _write(database.add_habit, user_id, name, freq, time)
+    await _schedule_changed([habit_id])
+    return habit_id
+
+
+async def delete_habit(habit_id, user_id):
+    deleted = await _write(database.delete_habit, habit_id, user_id)
+    if deleted:
+        await _schedule_changed([habit_id])
+    return deleted
+
+
+async def update_habit_time(habit_id, user_id, new_time):
+    updated = await _write(database.update_habit_time, habit_id, user_id, new_time)
+    if updated:
+        await _schedule_changed([habit_id])
+    return updated
+
+# --- История и статистика ---
+get_user_stats_page = _user_reads(database.get_user_stats_page)
+get_user_events_page = _user_reads(database.get_user_events_page)
+get_last_user_event = _user_reads(database.get_last_user_event)
+
+# --- Профили пользователей (через кэш) ---
+profile_cache = UserProfileCache()
+
+
+async def get_user_profile(user_id):
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        version = profile_cache.version
+        row = await _read(database.get_user_profile, user_id)
+        profile = UserProfile.from_row(row)
+        profile_cache.put_many({user_id: profile}, version)
+    return profile
+
+
+async def load_user_profiles(user_ids):
+    # Прогрев кэша одним запросом (например, для всех получателей напоминаний в тике)
+    missing = profile_cache.missing(set(user_ids))
+    if not missing:
+        return
+    version = profile_cache.version
+    rows = await _read(database.get_user_profiles, missing)
+    profile_cache.put_many({user_id: UserProfile.from_row(rows.get(user_id)) for user_id in missing}, version)
+
+
+# --- Интеграции ---
+async def set_user_sheet(user_id, link):
+    try:
+        return await _write(database.set_user_sheet, user_id, link)
+    finally:
+        profile_cache.invalidate(user_id)
+
+
+async def get_user_sheet(user_id):
+    return (await get_user_profile(user_id)).sheet_link
+
+# --- Недоступные пользователи ---
+async def mark_users_inactive(user_ids):
+    user_ids = list(user_ids)
+    try:
+        habit_ids = await _write(database.mark_users_inactive, user_ids)
+    finally:
+        for user_id in user_ids:
+            profile_cache.invalidate(user_id)
+    await _schedule_changed(habit_ids=habit_ids)
+    return habit_ids
+
+
+async def is_user_inactive(user_id):
+    # Флаг — прямо из базы: его могла поставить или снять другая копия бота, а кэш профилей
+    # у каждой копии свой. Разошёлся с кэшем — выбрасываем профиль из кэша.
+    inactive = await _read(database.is_user_inactive, user_id)
+    cached = profile_cache.peek(user_id)
+    if cached is not None and cached.inactive != inactive:
+        profile_cache.invalidate(user_id)
+    return inactive
+
+
+async def reactivate_user(user_id):
+    try:
+        changed = await _write(database.reactivate_user, user_id)
+    finally:
+        profile_cache.invalidate(user_id)
+    if changed:
+        await _schedule_changed(user_id=user_id)
+    return changed
+
+
+archive_inactive_users = _writes(database.archive_inactive_users)
+
+
+async def incremental_vacuum(max_pages):
+    # Не через писателя: incremental_vacuum — вне транзакции, на своём соединении
+    return await asyncio.to_thread(database.incremental_vacuum, max_pages)
+
+# --- Состояния диалогов (FSM) ---
+load_fsm_record = _reads(database.load_fsm_record)
+save_fsm_records = _writes(database.save_fsm_records)
+purge_fsm_records = _writes(database.purge_fsm_records)
+
+# --- Очередь записи в Google Sheets ---
+enqueue_sheet_row = _writes(database.enqueue_sheet_row)
+get_pending_sheets = _reads(database.get_pending_sheets)
+get_pending_sheet_rows = _reads(database.get_pending_sheet_rows)
+count_pending_sheet_rows = _reads(database.count_pending_sheet_rows)
+delete_sheet_rows = _writes(database.delete_sheet_rows)
+mark_sheet_rows_attempted = _writes(database.mark_sheet_rows_attempted)
+
+# --- Часовой пояс ---
+async def set_user_timezone(user_id, zone_name):
+    try:
+        result = await _write(database.set_user_timezone, user_id, zone_name)
+    finally:
+        profile_cache.invalidate(user_id)
+    await _schedule_changed(user_id=user_id)
+    return result
+
+
+async def is_timezone_confirmed(user_id):
+    return (await get_user_profile(user_id)).timezone_confirmed
+
+
+async def get_user_timezone(user_id):
+    return (await get_user_profile(user_id)).timezone
+
+# --- Еженедельные сводки ---
+get_digest_zones = _reads(database.get_digest_zones)
+get_zone_users_page = _reads(database.get_zone_users_page)
+get_weekly_summary = _reads(database.get_weekly_summary)
+save_weekly_digests = _writes(database.save_weekly_digests)
+get_due_digests = _reads(database.get_due_digests)
+mark_digests_sent = _writes(database.mark_digests_sent)
+prune_weekly_digests = _writes(database.prune_weekly_digests)
+
+# --- Рассылки ---
+create_broadcast = _writes(database.create_broadcast)
+get_broadcast = _reads(database.get_broadcast)
+set_broadcast_status = _writes(database.set_broadcast_status)
+claim_broadcasts = _writes(database.claim_broadcasts)
+checkpoint_broadcast = _writes(database.checkpoint_broadcast)
+get_user_ids_page = _reads(database.get_user_ids_page)
+
+# --- Напоминания ---
+get_due_habits = _reads(database.get_due_habits)
+get_reminder_habits = _reads(database.get_reminder_habits)
+get_schedule_changes = _reads(database.get_schedule_changes)
+get_last_schedule_change_id = _reads(database.get_last_schedule_change_id)
+prune_schedule_changes = _writes(database.prune_schedule_changes)
+get_habit_schedules = _reads(database.get_habit_schedules)
+get_user_habit_ids = _reads(database.get_user_habit_ids)
+get_scheduler_state = _reads(database.get_scheduler_state)
+set_scheduler_state = _writes(database.set_scheduler_state)
+claim_reminders = _writes(database.claim_reminders)
+prune_reminder_claims = _writes(database.prune_reminder_claims)
+
+# --- Несколько воркеров ---
+heartbeat_worker = _writes(database.heartbeat_worker)
+mark_partitions_fired = _writes(database.mark_partitions_fired)
+release_worker = _writes(database.release_worker)
+
+
+async def close():
+    # Дописываем буфер нажатий и очередь, закрываем соединения
+    await stats_buffer.close()
+    await asyncio.get_running_loop().run_in_executor(None, _writer.close)
+    _read_executor.shutdown(wait=True)
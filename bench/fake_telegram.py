@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Локальная замена Telegram Bot API для нагрузочных тестов.
+# Отвечает на /bot<token>/<method>, считает вызовы и умеет имитировать
+# задержку сети, 429 (Too Many Requests) и 403 (бот заблокирован).
+
+
+class FakeTelegram:
+    def __init__(self, latency_ms=(0.0, 0.0), rate_429=0.0, rate_403=0.0, retry_after=1, seed=None):
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.rate_403 = rate_403
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.chats = Counter()
+        self._message_id = 0
+        self._runner = None
+
+    def stats(self):
+        return {"calls": dict(self.calls), "errors": dict(self.errors), "distinct_chats": len(self.chats)}
+
+    def reset(self):
+        self.calls.clear()
+        self.errors.clear()
+        self.chats.clear()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+
+        low, high = self.latency_ms
+        if high > 0:
+            await asyncio.sleep(self.random.uniform(low, high) / 1000)
+
+        roll = self.random.random()
+        if roll < self.rate_429:
+            self.errors[429] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        if method == "sendMessage" and roll < self.rate_429 + self.rate_403:
+            self.errors[403] += 1
+            return web.json_response({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(params.get("chat_id", 0))
+            self.chats[chat_id] += 1
+            self._message_id += 1
+            message = {
+                "message_id": int(params.get("message_id") or self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+            if "text" in params:
+                message["text"] = params["text"]
+            return message
+        if method == "getUpdates":
+            return []
+        return True
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8081):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, nargs=2, default=(0.0, 0.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-403", type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeTelegram(tuple(args.latency_ms), args.rate_429, args.rate_403)
+    web.run_app(fake.app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import database
+
+# Синтетическая база для нагрузочных тестов: N пользователей в разных часовых поясах
+# и M привычек. Часть напоминаний специально кучкуется на 08:00 — это наш пик.
+#   python -m bench.generate_data --db bench_habits.db --users 100000 --habits 1000000
+
+FREQUENCIES = ["Каждый день", database.FREQ_WEEKDAYS, database.FREQ_WEEKLY]
+FREQUENCY_WEIGHTS = [6, 3, 1]
+PEAK_TIME = "08:00"
+NO_REMINDER_VALUE = "Без напоминаний"
+CHUNK = 50_000
+# Большинство — в "наших" поясах; остальные — пояса с летним временем и нецелыми смещениями
+MAIN_ZONES = ["Europe/Kaliningrad", "Europe/Moscow", "Europe/Moscow", "Europe/Moscow", "Europe/Samara", "Asia/Yekaterinburg", "Asia/Novosibirsk"]
+OTHER_ZONES = [
+    "America/Los_Angeles", "America/New_York", "America/Sao_Paulo", "Europe/London", "Europe/Berlin",
+    "Asia/Kolkata", "Asia/Kathmandu", "Asia/Tokyo", "Australia/Adelaide", "Pacific/Auckland", "UTC+05:00", "UTC-03:30",
+]
+
+
+def random_time(rng, peak_share):
+    if rng.random() < peak_share:
+        return PEAK_TIME
+    if rng.random() < 0.05:
+        return NO_REMINDER_VALUE
+    return f"{rng.randrange(24):02d}:{rng.choice((0, 15, 30, 45)):02d}"
+
+
+def generate(db_path, users, habits, peak_share=0.2, events_per_habit=0, seed=42):
+    rng = random.Random(seed)
+    database.DB_NAME = db_path
+    database.init_db()
+    database.close_connection()
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    started = time.perf_counter()
+
+    zones = {}
+    conn.execute("BEGIN")
+    user_rows = []
+    for user_id in range(1, users + 1):
+        zone_name = rng.choice(MAIN_ZONES) if rng.random() < 0.7 else rng.choice(OTHER_ZONES)
+        zones[user_id] = zone_name
+        user_rows.append((user_id, None, zone_name, 1))
+    conn.executemany(
+        'INSERT OR REPLACE INTO users (user_id, sheet_link, timezone, timezone_confirmed) VALUES (?, ?, ?, ?)',
+        user_rows,
+    )
+    conn.execute("COMMIT")
+
+    start_day = datetime.now() - timedelta(days=365)
+    for chunk_start in range(0, habits, CHUNK):
+        rows = []
+        for _ in range(chunk_start, min(habits, chunk_start + CHUNK)):
+            user_id = rng.randint(1, users)
+            freq = rng.choices(FREQUENCIES, FREQUENCY_WEIGHTS)[0]
+            habit_time = random_time(rng, peak_share)
+            start_date = (start_day + timedelta(days=rng.randrange(365))).strftime("%d.%m.%Y")
+            remind_minute, remind_days = database.build_reminder_schedule(habit_time, freq, start_date)
+            done, skip = rng.randrange(200), rng.randrange(100)
+            rows.append((user_id, f"Привычка {rng.randrange(10_000)}", freq, habit_time, done, skip, start_date, remind_minute, remind_days, zones[user_id]))
+        conn.execute("BEGIN")
+        conn.executemany(
+            '''INSERT INTO habits (user_id, name, frequency, time, done_count, skip_count, start_date, remind_minute, remind_days, timezone)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            rows,
+        )
+        conn.execute("COMMIT")
+
+    if events_per_habit:
+        now = int(time.time())
+        conn.execute("BEGIN")
+        cursor = conn.execute("SELECT id, user_id FROM habits")
+        while True:
+            batch = cursor.fetchmany(CHUNK)
+            if not batch:
+                break
+            conn.executemany(
+                "INSERT INTO habit_events (habit_id, user_id, ts, status) VALUES (?, ?, ?, ?)",
+                [
+                    (habit_id, user_id, now - rng.randrange(365 * 86400), int(rng.random() < 0.7))
+                    for habit_id, user_id in batch
+                    for _ in range(events_per_habit)
+                ],
+            )
+        conn.execute("COMMIT")
+
+    conn.execute("ANALYZE")
+    conn.close()
+    return {"users": users, "habits": habits, "events": habits * events_per_habit, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill a habits database with synthetic data")
+    parser.add_argument("--db", default="bench_habits.db")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--habits", type=int, default=100_000)
+    parser.add_argument("--peak-share", type=float, default=0.2, help=f"share of habits reminding at {PEAK_TIME}")
+    parser.add_argument("--events-per-habit", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    print(generate(args.db, args.users, args.habits, args.peak_share, args.events_per_habit, args.seed))
+
+
+if __name__ == "__main__":
+    main()
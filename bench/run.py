@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import database
+from bench.fake_telegram import FakeTelegram
+from bench.generate_data import generate
+from timezones import get_zone
+
+# Нагрузочный прогон бота против локального фейкового Bot API.
+#   python -m bench.generate_data --db bench_habits.db --users 100000 --habits 1000000
+#   python -m bench.run --db bench_habits.db --out bench_results.json
+# Результат — JSON: длительность тика на пиковой минуте, p50/p99 обработчиков, пик памяти.
+# Сравнивайте файлы между версиями, чтобы видеть регрессии.
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def busiest_minute(db_path):
+    # Самая людная локальная минута -> ближайший её момент в UTC, (момент, число привычек)
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(
+            "SELECT timezone, remind_minute, COUNT(*) FROM habits WHERE remind_minute IS NOT NULL "
+            "GROUP BY timezone, remind_minute ORDER BY COUNT(*) DESC LIMIT 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return datetime.utcnow(), 0
+    zone_name, minute, count = row
+    local = datetime.now(get_zone(zone_name)).replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    return local.astimezone(timezone.utc).replace(tzinfo=None), count
+
+
+def sample_habits(db_path, count, seed):
+    conn = sqlite3.connect(db_path)
+    try:
+        max_id = conn.execute("SELECT MAX(id) FROM habits").fetchone()[0] or 0
+        rng = random.Random(seed)
+        ids = [rng.randint(1, max_id) for _ in range(count)] if max_id else []
+        rows = []
+        for start in range(0, len(ids), 900):
+            chunk = ids[start:start + 900]
+            rows += conn.execute(f"SELECT id, user_id FROM habits WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        return rows
+    finally:
+        conn.close()
+
+
+def message_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "🔔",
+            },
+        },
+    }
+
+
+async def measure_updates(bot_main, updates, trace_memory):
+    if trace_memory:
+        tracemalloc.reset_peak()
+    latencies = []
+    for update in updates:
+        started = time.perf_counter()
+        await bot_main.dp.feed_raw_update(bot_main.bot, update)
+        latencies.append(time.perf_counter() - started)
+    result = percentiles(latencies)
+    if trace_memory:
+        result["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+    return result
+
+
+async def run(args):
+    fake = FakeTelegram(tuple(args.latency_ms), args.rate_429, args.rate_403, seed=args.seed)
+    api_url = await fake.start(port=args.port)
+    os.environ.update(BOT_TOKEN="123456:bench-token", TELEGRAM_API_URL=api_url, HABITS_DB=args.db)
+    database.DB_NAME = args.db
+    bot_main = importlib.import_module("main")
+
+    results = {
+        "version": git_version(),
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "dataset": {"db": args.db},
+        "scenarios": {},
+    }
+    if args.trace_memory:
+        tracemalloc.start()
+
+    await bot_main.init_db()
+    await bot_main.storage.start()
+    await bot_main.partitions.start()
+    if args.unthrottled:
+        # Меряем собственную скорость тика, а не лимиты Telegram
+        bot_main.sender.bucket.rate = bot_main.sender.bucket.capacity = 1e9
+        bot_main.sender.per_chat.interval = 0
+    try:
+        conn = sqlite3.connect(args.db)
+        results["dataset"]["users"] = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        results["dataset"]["habits"] = conn.execute("SELECT COUNT(*) FROM habits").fetchone()[0]
+        conn.execute("DELETE FROM reminder_claims")
+        conn.commit()
+        conn.close()
+
+        # 1. Тик напоминаний на самой загруженной минуте
+        now_utc, due = busiest_minute(args.db)
+        if args.trace_memory:
+            tracemalloc.reset_peak()
+        fake.reset()
+        started = time.perf_counter()
+        await bot_main.check_reminders(now_utc)
+        tick = {
+            "utc_minute": now_utc.strftime("%H:%M"),
+            "scheduled_habits": due,
+            "duration_s": round(time.perf_counter() - started, 3),
+            "telegram": fake.stats(),
+        }
+        if args.trace_memory:
+            tick["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        results["scenarios"]["reminder_tick"] = tick
+
+        # 2. Кнопки "Сделано"/"Пропуск"
+        habits = sample_habits(args.db, args.samples, args.seed)
+        updates = [
+            callback_update(i, user_id, f"{'done' if i % 3 else 'skip'}_{habit_id}")
+            for i, (habit_id, user_id) in enumerate(habits, start=1)
+        ]
+        results["scenarios"]["done_skip_callback"] = await measure_updates(bot_main, updates, args.trace_memory)
+
+        # 3. Отрисовка меню и статистики
+        users = [user_id for _, user_id in habits]
+        menu = [message_update(i, user_id, "Мои привычки 📋") for i, user_id in enumerate(users, start=1)]
+        results["scenarios"]["habits_menu"] = await measure_updates(bot_main, menu, args.trace_memory)
+        stats = [message_update(i, user_id, "Моя статистика 📊") for i, user_id in enumerate(users, start=1)]
+        results["scenarios"]["stats_view"] = await measure_updates(bot_main, stats, args.trace_memory)
+    finally:
+        await bot_main.partitions.stop()
+        await bot_main.storage.close()
+        await bot_main.close_database()
+        await bot_main.bot.session.close()
+        await fake.stop()
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the habit bot against a fake Telegram Bot API")
+    parser.add_argument("--db", default="bench_habits.db")
+    parser.add_argument("--generate", action="store_true", help="(re)generate the database first")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--habits", type=int, default=100_000)
+    parser.add_argument("--samples", type=int, default=1000, help="updates per handler scenario")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, nargs=2, default=(0.0, 0.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-403", type=float, default=0.0)
+    parser.add_argument("--unthrottled", action="store_true", help="disable the 30 msg/s limiter during the tick")
+    parser.add_argument("--trace-memory", action="store_true", help="per-scenario tracemalloc peaks (slower)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    if args.generate or not os.path.exists(args.db):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+        print("Generating:", generate(args.db, args.users, args.habits, seed=args.seed))
+
+    results = asyncio.run(run(args))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import time
+from typing import NamedTuple, Optional
+
+from async_database import (
+    claim_broadcasts,
+    checkpoint_broadcast,
+    create_broadcast,
+    get_broadcast,
+    get_user_ids_page,
+    mark_users_inactive,
+    set_broadcast_status,
+)
+from metrics import BROADCAST_MESSAGES
+from sender import OutgoingMessage, SendStats
+
+logger = logging.getLogger(__name__)
+
+# Рассылка всем пользователям: id получателей читаются из users страницами по порядку,
+# отправка идёт через общий MessageSender (его лимит 30 сообщений/с делится с напоминаниями).
+# Прогресс — "всем с id <= last_user_id уже отправлено" — пишется в broadcasts раз в
+# CHECKPOINT_INTERVAL: после падения повторно уйдут только сообщения последних секунд.
+PAGE_SIZE = 1000
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+CHECKPOINT_INTERVAL = 2.0
+PROGRESS_INTERVAL = 5.0
+# Аренда рассылки копией бота; не продлили — рассылку подхватит другая копия
+LEASE_TTL = 60.0
+POLL_INTERVAL = 30.0
+# Чтение получателей (например, "database is locked") повторяем с паузой 1, 2, 4, 8 с; не вышло —
+# рассылка останавливается со статусом 'failed' и продолжается с отметки по кнопке админа
+PAGE_ATTEMPTS = 5
+PAGE_RETRY_DELAY = 1.0
+
+
+class BroadcastState(NamedTuple):
+    id: int
+    text: str
+    status: str
+    created_by: Optional[int]
+    chat_id: Optional[int]
+    message_id: Optional[int]
+    total: int
+    last_user_id: int
+    sent: int
+    failed: int
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row) if row is not None else None
+
+
+class Progress(NamedTuple):
+    state: BroadcastState
+    rate: float
+    eta: Optional[float]
+    finished: bool = False
+
+
+class BroadcastRun:
+    def __init__(self, state, sender, owner, report=None, concurrency=CONCURRENCY):
+        self.state = state
+        self.sender = sender
+        self.owner = owner
+        self.report = report
+        self.concurrency = concurrency
+        self.stats = SendStats()
+        self.task = None
+        self._stop = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=concurrency * 2)
+        self._in_flight = set()
+        self._dispatched = state.last_user_id
+        self._exhausted = False
+        self._marked = 0
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def watermark(self):
+        # Всем с id <= watermark сообщение уже отправлено (или отправить не удалось)
+        return min(self._in_flight) - 1 if self._in_flight else self._dispatched
+
+    def progress(self, finished=False):
+        sent = self.state.sent + self.stats.sent
+        failed = self.state.failed + self.stats.failed + len(self.stats.unreachable)
+        elapsed = time.monotonic() - self.stats.started
+        done = self.stats.sent + self.stats.failed + len(self.stats.unreachable)
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.state.total - sent - failed, 0)
+        eta = remaining / rate if rate > 0 else None
+        state = self.state._replace(last_user_id=self.watermark, sent=sent, failed=failed)
+        return Progress(state, rate, eta, finished)
+
+    async def run(self):
+        producer = asyncio.create_task(self._produce())
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        last_progress = 0.0
+        try:
+            while True:
+                # asyncio.timeout, а не wait_for: тот в 3.11 может проглотить отмену задачи
+                try:
+                    async with asyncio.timeout(CHECKPOINT_INTERVAL):
+                        await self._stop.wait()
+                except TimeoutError:
+                    pass
+                status = await self._checkpoint()
+                # Производитель закончился, не дочитав получателей, — значит, упал
+                if self._stop.is_set() or self._finished() or status != "running" or (producer.done() and not self._exhausted):
+                    break
+                if self.report and time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await self._report()
+        finally:
+            # Новые сообщения не берём, уже начатые доотправляем и сохраняем точный прогресс
+            self._stop.set()
+            producer.cancel()
+            results = await asyncio.gather(producer, *workers, return_exceptions=True)
+            status = await self._checkpoint()
+        for error in results:
+            if isinstance(error, Exception):
+                logger.error("Broadcast %s task failed", self.state.id, exc_info=error)
+        if status == "running" and isinstance(results[0], Exception):
+            await set_broadcast_status(self.state.id, "failed")
+            status = "failed"
+        elif status == "running" and self._finished():
+            await set_broadcast_status(self.state.id, "done")
+            status = "done"
+        self.state = self.state._replace(status=status or self.state.status)
+        if self.report:
+            await self._report(finished=True)
+        logger.info("Broadcast %s stopped (%s): %s", self.state.id, status, self.stats.finish())
+        return status
+
+    def _finished(self):
+        return self._exhausted and self._queue.empty() and not self._in_flight
+
+    async def _produce(self):
+        after = self.state.last_user_id
+        while True:
+            page = await self._read_page(after)
+            for user_id in page:
+                await self._queue.put(user_id)
+            if len(page) < PAGE_SIZE:
+                self._exhausted = True
+                return
+            after = page[-1]
+
+    async def _read_page(self, after):
+        for attempt in range(1, PAGE_ATTEMPTS + 1):
+            try:
+                return await get_user_ids_page(after, PAGE_SIZE)
+            except Exception as e:
+                if attempt == PAGE_ATTEMPTS:
+                    raise
+                delay = PAGE_RETRY_DELAY * 2 ** (attempt - 1)
+                logger.warning("Broadcast %s: reading recipients after %s failed (%s), retry in %.0fs", self.state.id, after, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while not self._stop.is_set():
+            try:
+                async with asyncio.timeout(CHECKPOINT_INTERVAL):
+                    user_id = await self._queue.get()
+            except TimeoutError:
+                if self._exhausted:
+                    return
+                continue
+            if self._stop.is_set():
+                return
+            # Очередь FIFO, id растут: всё, что раньше взято из очереди, меньше user_id
+            self._in_flight.add(user_id)
+            self._dispatched = user_id
+            try:
+                ok = await self.sender.send(OutgoingMessage(user_id, self.state.text), self.stats)
+                BROADCAST_MESSAGES.labels("sent" if ok else "failed").inc()
+            finally:
+                self._in_flight.discard(user_id)
+
+    async def _checkpoint(self):
+        progress = self.progress()
+        try:
+            # Заблокировавших бота убираем из напоминаний и следующих рассылок
+            unreachable = self.stats.unreachable[self._marked:]
+            if unreachable:
+                await mark_users_inactive(unreachable)
+                self._marked += len(unreachable)
+            return await checkpoint_broadcast(
+                self.state.id, self.owner, progress.state.last_user_id, progress.state.sent, progress.state.failed, LEASE_TTL
+            )
+        except Exception:
+            logger.exception("Failed to checkpoint broadcast %s", self.state.id)
+            return "running"
+
+    async def _report(self, finished=False):
+        try:
+            await self.report(self.progress(finished))
+        except Exception as e:
+            logger.warning("Broadcast %s progress report failed: %s", self.state.id, e)
+
+
+class Broadcaster:
+    # Запускает рассылки, которыми владеет эта копия бота, и раз в POLL_INTERVAL подбирает
+    # брошенные (после падения или перезапуска). report(progress) показывает прогресс админу.
+    def __init__(self, sender, owner, report=None):
+        self.sender = sender
+        self.owner = owner
+        self.report = report
+        self.runs = {}
+        self._task = None
+
+    async def start(self):
+        await self.resume_orphans()
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Статус остаётся 'running': после перезапуска рассылка продолжится с отметки
+        for run in list(self.runs.values()):
+            run.stop()
+        tasks = [run.task for run in self.runs.values()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def create(self, text, created_by, chat_id, message_id):
+        # message_id — сообщение админу, в котором показывается прогресс
+        broadcast_id = await create_broadcast(text, created_by, chat_id, message_id)
+        await self.resume_orphans()
+        return broadcast_id
+
+    async def pause(self, broadcast_id):
+        return await self._set_status(broadcast_id, "paused")
+
+    async def cancel(self, broadcast_id):
+        return await self._set_status(broadcast_id, "cancelled")
+
+    async def resume(self, broadcast_id):
+        changed = await set_broadcast_status(broadcast_id, "running")
+        if changed:
+            await self.resume_orphans()
+        return changed
+
+    async def _set_status(self, broadcast_id, status):
+        changed = await set_broadcast_status(broadcast_id, status)
+        run = self.runs.get(broadcast_id)
+        if run is not None:
+            # Рассылка идёт здесь — останавливаем сразу, не дожидаясь отметки
+            run.stop()
+        return changed
+
+    async def get(self, broadcast_id):
+        run = self.runs.get(broadcast_id)
+        if run is not None:
+            return run.progress().state
+        return BroadcastState.from_row(await get_broadcast(broadcast_id))
+
+    async def resume_orphans(self):
+        for row in await claim_broadcasts(self.owner, LEASE_TTL):
+            state = BroadcastState.from_row(row)
+            if state.id in self.runs:
+                continue
+            run = BroadcastRun(state, self.sender, self.owner, self.report)
+            run.task = asyncio.create_task(self._execute(run))
+            self.runs[state.id] = run
+            logger.info("Broadcast %s started from user %s (%s/%s sent)", state.id, state.last_user_id, state.sent, state.total)
+
+    async def _execute(self, run):
+        try:
+            await run.run()
+        except Exception:
+            logger.exception("Broadcast %s failed", run.state.id)
+        finally:
+            self.runs.pop(run.state.id, None)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            try:
+                await self.resume_orphans()
+            except Exception:
+                logger.exception("Failed to pick up broadcasts")
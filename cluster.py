@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from async_database import heartbeat_worker, release_worker
+
+logger = logging.getLogger(__name__)
+
+# Напоминания делятся на партиции по user_id % PARTITION_COUNT. Каждая копия бота
+# арендует свою долю партиций в SQLite и продлевает аренду heartbeat'ом; партиции
+# упавшего воркера достаются остальным, когда истечёт LEASE_TTL. Пока партиция без
+# владельца, её напоминания никто не шлёт: новый владелец узнаёт о ней через on_acquire
+# и догоняет пропущенные минуты с отметки fired_through.
+PARTITION_COUNT = int(os.getenv("SCHEDULER_PARTITIONS", 16))
+LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", 30))
+HEARTBEAT_INTERVAL = float(os.getenv("SCHEDULER_HEARTBEAT", 10))
+
+
+def default_worker_id():
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class PartitionManager:
+    def __init__(self, worker_id=None, partition_count=PARTITION_COUNT, lease_ttl=LEASE_TTL, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.worker_id = worker_id or default_worker_id()
+        self.partition_count = partition_count
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._owned = frozenset()
+        self._expires_at = 0.0
+        self._task = None
+        self._acquire_listeners = []
+
+    @property
+    def owned(self):
+        # Если heartbeat давно не проходил, аренда могла уйти другому — ничего не считаем своим
+        if time.time() >= self._expires_at:
+            return frozenset()
+        return self._owned
+
+    def owns(self, user_id):
+        return user_id % self.partition_count in self.owned
+
+    def on_acquire(self, listener):
+        # listener({партиция: fired_through}) — партиции, которых до этого heartbeat у нас не было
+        # (новые или вернувшиеся после просроченной аренды). Вызывается из цикла heartbeat:
+        # долгую работу listener запускает отдельной задачей.
+        self._acquire_listeners.append(listener)
+
+    async def heartbeat(self):
+        previous = self.owned
+        owned, expires_at, marks = await heartbeat_worker(self.worker_id, self.partition_count, self.lease_ttl)
+        owned = frozenset(owned)
+        if owned != self._owned:
+            logger.info("Worker %s now owns partitions %s", self.worker_id, sorted(owned))
+        self._owned, self._expires_at = owned, expires_at
+        acquired = {partition: marks.get(partition) for partition in owned - previous}
+        if acquired:
+            for listener in self._acquire_listeners:
+                try:
+                    await listener(acquired)
+                except Exception:
+                    logger.exception("Partition acquire listener failed")
+
+    async def start(self):
+        # Первый heartbeat — сразу, чтобы первый тик уже знал свои партиции
+        await self.heartbeat()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception:
+                logger.exception("Partition heartbeat failed for %s", self.worker_id)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Отдаём партиции сразу, не дожидаясь истечения аренды
+        self._owned, self._expires_at = frozenset(), 0.0
+        await release_worker(self.worker_id)
@@ -1,20 +1,93 @@
+import json
+import logging
+import os
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
 from contextlib import contextmanager
 
-DB_NAME = 'habits.db'
+from metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS, timed
+from timezones import DEFAULT_TIMEZONE, fixed_offset_name, get_zone, local_now, local_slots
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = os.getenv('HABITS_DB', 'habits.db')
+
+FREQ_WEEKDAYS = "По будням"
+FREQ_WEEKLY = "Раз в неделю"
+
+# Битовая маска дней недели: бит 0 — понедельник, ..., бит 6 — воскресенье
+ALL_DAYS_MASK = 0b1111111
+WEEKDAYS_MASK = 0b0011111
+MINUTES_PER_DAY = 24 * 60
+
+
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def _open_connection():
+    # Долгоживущее соединение на поток: WAL (читатели не ждут писателя),
+    # транзакциями управляем сами (isolation_level=None), подготовленные запросы кэшируются
+    conn = sqlite3.connect(
+        DB_NAME, timeout=5, isolation_level=None, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+    )
+    # Действует только на новой базе (до первой таблицы); старую переводит enable_incremental_vacuum
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 
 @contextmanager
 def get_connection():
-    conn = sqlite3.connect(DB_NAME, timeout=5)
+    # Внешний вызов открывает транзакцию, вложенные — SAVEPOINT. Так несколько операций
+    # можно склеить в одну транзакцию (см. async_database), а ошибка одной откатит только её.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _open_connection()
+        _local.depth = 0
+    depth = _local.depth
+    conn.execute("BEGIN" if depth == 0 else f"SAVEPOINT sp{depth}")
+    _local.depth = depth + 1
     try:
         yield conn
-        conn.commit()
+    except BaseException:
+        if depth == 0:
+            conn.execute("ROLLBACK")
+        else:
+            conn.execute(f"ROLLBACK TO sp{depth}")
+            conn.execute(f"RELEASE sp{depth}")
+        raise
+    else:
+        if depth == 0:
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        else:
+            conn.execute(f"RELEASE sp{depth}")
     finally:
+        _local.depth = depth
+
+
+def _query(func):
+    # Время и число вызовов каждой функции базы попадают в /metrics (db_query_seconds{query=...})
+    return timed(DB_QUERY_SECONDS, DB_QUERY_ERRORS, func.__name__)(func)
+
+
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
         conn.close()
+        _local.conn = None
 
 
+@_query
 def init_db():
     with get_connection() as conn:
         cursor = conn.cursor()
@@ -30,31 +103,321 @@ def init_db():
                 start_date TEXT
             )
         ''')
+        # Списки привычек пользователя и постраничная навигация (keyset по id)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_habits_user_id ON habits(user_id, id)")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 sheet_link TEXT,
                 utc_offset INTEGER DEFAULT 3,
-                timezone_confirmed INTEGER DEFAULT 0
+                timezone_confirmed INTEGER DEFAULT 0,
+                timezone TEXT
             )
         ''')
         cursor.execute("PRAGMA table_info(users)")
         columns = {row[1] for row in cursor.fetchall()}
         if "timezone_confirmed" not in columns:
             cursor.execute("ALTER TABLE users ADD COLUMN timezone_confirmed INTEGER DEFAULT 0")
+        if "inactive_since" not in columns:
+            # Когда Telegram ответил "бот заблокирован"/"чат не найден"; NULL — пользователь активен
+            cursor.execute("ALTER TABLE users ADD COLUMN inactive_since REAL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_inactive_since ON users(inactive_since) WHERE inactive_since IS NOT NULL")
+        if "timezone" not in columns:
+            # Раньше хранили только целое смещение в часах (utc_offset) — переводим в "UTC+03:00"
+            cursor.execute("ALTER TABLE users ADD COLUMN timezone TEXT")
+            cursor.execute("SELECT user_id, utc_offset FROM users")
+            cursor.executemany(
+                'UPDATE users SET timezone = ? WHERE user_id = ?',
+                [(fixed_offset_name((offset if offset is not None else 3) * 60), user_id) for user_id, offset in cursor.fetchall()],
+            )
+        # Сводки идут по поясам: пользователи пояса по порядку id (см. get_zone_users_page)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_timezone ON users(timezone, user_id) WHERE inactive_since IS NULL")
+
+        # Расписание напоминаний: минута локальных суток + маска локальных дней недели
+        # и пояс пользователя (копия users.timezone) — тик ищет привычки по (пояс, минута)
+        cursor.execute("PRAGMA table_info(habits)")
+        columns = {row[1] for row in cursor.fetchall()}
+        needs_backfill = False
+        if "remind_minute" not in columns:
+            cursor.execute("ALTER TABLE habits ADD COLUMN remind_minute INTEGER")
+            needs_backfill = True
+        if "remind_days" not in columns:
+            cursor.execute("ALTER TABLE habits ADD COLUMN remind_days INTEGER")
+            needs_backfill = True
+        if "timezone" not in columns:
+            # Старые remind_minute/remind_days были в UTC — пересчитываем в локальные
+            cursor.execute("ALTER TABLE habits ADD COLUMN timezone TEXT")
+            needs_backfill = True
+        if "inactive" not in columns:
+            # Копия "пользователь недоступен": такие привычки не попадают в индекс напоминаний
+            cursor.execute("ALTER TABLE habits ADD COLUMN inactive INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("DROP INDEX IF EXISTS idx_habits_remind_minute")
+        cursor.execute("DROP INDEX IF EXISTS idx_habits_timezone_minute")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_habits_due ON habits(timezone, remind_minute) WHERE inactive = 0")
+        if needs_backfill:
+            _backfill_reminder_schedule(cursor)
+
+        # История отметок (только добавление) и готовые агрегаты по дням/неделям/месяцам
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS habit_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                habit_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                status INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_habit_events_habit_ts ON habit_events(habit_id, ts)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_habit_events_user_ts ON habit_events(user_id, ts)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS habit_rollups (
+                habit_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                period_key TEXT NOT NULL,
+                done_count INTEGER DEFAULT 0,
+                skip_count INTEGER DEFAULT 0,
+                PRIMARY KEY (habit_id, period, period_key)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("PRAGMA table_info(habits)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if "current_streak" not in columns:
+            cursor.execute("ALTER TABLE habits ADD COLUMN current_streak INTEGER DEFAULT 0")
+        if "best_streak" not in columns:
+            cursor.execute("ALTER TABLE habits ADD COLUMN best_streak INTEGER DEFAULT 0")
+        if "streak_period" not in columns:
+            cursor.execute("ALTER TABLE habits ADD COLUMN streak_period INTEGER")
+
+        # Несколько копий бота: живые воркеры, аренда партиций и отметки "напоминание уже взято"
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduler_workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS partition_leases (
+                partition INTEGER PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL DEFAULT 0,
+                fired_through INTEGER
+            )
+        ''')
+        cursor.execute("PRAGMA table_info(partition_leases)")
+        if "fired_through" not in {row[1] for row in cursor.fetchall()}:
+            # UTC-минута, до которой напоминания партиции уже взяты в reminder_claims:
+            # новый владелец партиции догоняет пропущенное с неё (см. ReminderScheduler.replay)
+            cursor.execute("ALTER TABLE partition_leases ADD COLUMN fired_through INTEGER")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reminder_claims (
+                habit_id INTEGER NOT NULL,
+                fire_key TEXT NOT NULL,
+                owner TEXT,
+                claimed_at REAL NOT NULL,
+                PRIMARY KEY (habit_id, fire_key)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminder_claims_claimed_at ON reminder_claims(claimed_at)")
+        # Служебные значения планировщика (например, до какой минуты напоминания уже разосланы)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scheduler_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            ) WITHOUT ROWID
+        ''')
+        # Журнал изменений расписания: по нему колёса напоминаний других копий бота
+        # подхватывают новые и изменённые привычки, не дожидаясь полной перезагрузки
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schedule_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                habit_id INTEGER,
+                user_id INTEGER,
+                changed_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_schedule_changes_changed_at ON schedule_changes(changed_at)")
+
+        # Состояния диалогов (FSM aiogram), см. fsm_storage.py
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_state (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL,
+                user_id INTEGER
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("PRAGMA table_info(fsm_state)")
+        if "user_id" not in {row[1] for row in cursor.fetchall()}:
+            # Чей диалог: по нему состояния удаляются вместе с пользователем (см. _archive_user)
+            cursor.execute("ALTER TABLE fsm_state ADD COLUMN user_id INTEGER")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state(updated_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_user_id ON fsm_state(user_id)")
+
+        # Очередь строк для Google Sheets, переживает перезапуск бота
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sheet_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sheet_url TEXT NOT NULL,
+                row_json TEXT NOT NULL,
+                chat_id INTEGER,
+                message_id INTEGER,
+                message_text TEXT,
+                attempts INTEGER DEFAULT 0,
+                created_at REAL
+            )
+        ''')
+        # Строки одной таблицы по порядку: SheetsWriter читает очередь по таблицам
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sheet_outbox_url ON sheet_outbox(sheet_url, id)")
+
+        # Рассылки администратора: прогресс — id последнего пользователя, до которого всё отправлено.
+        # owner/lease_until — какая копия бота сейчас шлёт (аренда продлевается на каждой отметке)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                created_by INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                total INTEGER DEFAULT 0,
+                last_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                owner TEXT,
+                lease_until REAL DEFAULT 0,
+                created_at REAL,
+                finished_at REAL
+            )
+        ''')
+        # Еженедельные сводки: готовый текст и момент отправки (утро понедельника по местному времени)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS weekly_digests (
+                user_id INTEGER NOT NULL,
+                week TEXT NOT NULL,
+                send_at REAL NOT NULL,
+                text TEXT NOT NULL,
+                sent_at REAL,
+                PRIMARY KEY (user_id, week)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_weekly_digests_due ON weekly_digests(send_at) WHERE sent_at IS NULL")
+        # Давно недоступные пользователи: все их строки одним сжатым JSON (см. archive_inactive_users)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_users (
+                user_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                archived_at REAL NOT NULL
+            )
+        ''')
+
+
+# --- Расписание напоминаний ---
+def parse_reminder_time(time_str):
+    # "ЧЧ:ММ" -> минута суток, всё остальное ("Без напоминаний", мусор) -> None
+    try:
+        hours, minutes = map(int, (time_str or "").strip().split(":"))
+    except ValueError:
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return hours * 60 + minutes
+
+
+def build_reminder_schedule(time_str, frequency, start_date=None):
+    # -> (минута локальных суток, маска локальных дней недели); без напоминания — (None, None).
+    # В UTC не переводим: смещение пояса меняется при переходе на летнее время.
+    local_minute = parse_reminder_time(time_str)
+    if local_minute is None:
+        return None, None
+
+    if frequency == FREQ_WEEKDAYS:
+        local_mask = WEEKDAYS_MASK
+    elif frequency == FREQ_WEEKLY:
+        # Раз в неделю — в тот же день недели, в который привычка была создана
+        try:
+            weekday = datetime.strptime(start_date, "%d.%m.%Y").weekday()
+        except (TypeError, ValueError):
+            weekday = datetime.now().weekday()
+        local_mask = 1 << weekday
+    else:
+        local_mask = ALL_DAYS_MASK
+    return local_minute, local_mask
+
+
+def _get_user_timezone(cursor, user_id):
+    cursor.execute('SELECT timezone FROM users WHERE user_id = ?', (user_id,))
+    res = cursor.fetchone()
+    return res[0] if res and res[0] else DEFAULT_TIMEZONE
+
+
+def _backfill_reminder_schedule(cursor):
+    cursor.execute(
+        '''SELECT h.id, h.time, h.frequency, h.start_date, u.timezone
+           FROM habits h LEFT JOIN users u ON u.user_id = h.user_id'''
+    )
+    updates = [
+        (*build_reminder_schedule(time_str, freq, start_date), zone or DEFAULT_TIMEZONE, habit_id)
+        for habit_id, time_str, freq, start_date, zone in cursor.fetchall()
+    ]
+    cursor.executemany('UPDATE habits SET remind_minute = ?, remind_days = ?, timezone = ? WHERE id = ?', updates)
 
 
 # --- Привычки ---
+@_query
 def add_habit(user_id, name, freq, time):
     start_date = datetime.now().strftime("%d.%m.%Y")
     with get_connection() as conn:
         cursor = conn.cursor()
+        remind_minute, remind_days = build_reminder_schedule(time, freq, start_date)
         cursor.execute(
-            '''INSERT INTO habits (user_id, name, frequency, time, start_date) VALUES (?, ?, ?, ?, ?)''',
-            (user_id, name, freq, time, start_date),
+            '''INSERT INTO habits (user_id, name, frequency, time, start_date, remind_minute, remind_days, timezone)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            (user_id, name, freq, time, start_date, remind_minute, remind_days, _get_user_timezone(cursor, user_id)),
+        )
+        return cursor.lastrowid
+
+
+def _fetch_page(cursor, query, params, user_id, after_id, before_id, limit):
+    # Keyset-страница по индексу (user_id, id): query — SELECT ... WHERE h.user_id = ? {bounds} ORDER BY h.id {order}.
+    # after_id — следующая страница после этого id, before_id — предыдущая перед ним.
+    # Возвращает (rows, has_prev, has_next); первая колонка строк — id привычки.
+    if before_id is not None:
+        bounds, order, bound_params = 'AND h.id < ?', 'DESC', [before_id]
+    elif after_id is not None:
+        bounds, order, bound_params = 'AND h.id > ?', 'ASC', [after_id]
+    else:
+        bounds, order, bound_params = '', 'ASC', []
+    cursor.execute(query.format(bounds=bounds, order=order) + ' LIMIT ?', [*params, user_id, *bound_params, limit + 1])
+    rows = cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if order == 'DESC':
+        rows.reverse()
+    if not rows:
+        return rows, False, False
+
+    def exists(condition, habit_id):
+        cursor.execute(f'SELECT EXISTS(SELECT 1 FROM habits WHERE user_id = ? AND id {condition} ?)', (user_id, habit_id))
+        return bool(cursor.fetchone()[0])
+
+    if order == 'DESC':
+        return rows, more, exists('>', rows[-1][0])
+    return rows, after_id is not None and exists('<', rows[0][0]), more
+
+
+@_query
+def get_user_habits_page(user_id, after_id=None, before_id=None, limit=10):
+    with get_connection() as conn:
+        return _fetch_page(
+            conn.cursor(),
+            '''SELECT h.id, h.name, h.frequency, h.time, h.done_count, h.skip_count, h.start_date
+               FROM habits h WHERE h.user_id = ? {bounds} ORDER BY h.id {order}''',
+            [], user_id, after_id, before_id, limit,
         )
 
 
+@_query
 def get_all_user_habits(user_id):
     with get_connection() as conn:
         cursor = conn.cursor()
@@ -65,6 +428,7 @@ def get_all_user_habits(user_id):
         return cursor.fetchall()
 
 
+@_query
 def get_user_habit(habit_id, user_id):
     with get_connection() as conn:
         cursor = conn.cursor()
@@ -75,31 +439,213 @@ def get_user_habit(habit_id, user_id):
         return cursor.fetchone()
 
 
-def update_habit_stats(habit_id, user_id, is_done):
+def update_habit_stats(habit_id, user_id, is_done, ts=None):
+    # Без @_query: время и так попадает в метрики через apply_habit_stats
+    ts = int(ts if ts is not None else time.time())
+    return bool(apply_habit_stats([(habit_id, user_id, [(ts, is_done)])]))
+
+
+@_query
+def apply_habit_stats(batch):
+    # batch — [(habit_id, user_id, [(ts, is_done), ...])]: накопленные нажатия, по одной записи на пару (привычка, пользователь).
+    # Счётчики — одним UPDATE на привычку, агрегаты — одним upsert на период. Возвращает применённые id.
+    applied = []
+    zones = {}
     with get_connection() as conn:
         cursor = conn.cursor()
-        if is_done:
-            cursor.execute('UPDATE habits SET done_count = done_count + 1 WHERE id = ? AND user_id = ?', (habit_id, user_id))
-        else:
-            cursor.execute('UPDATE habits SET skip_count = skip_count + 1 WHERE id = ? AND user_id = ?', (habit_id, user_id))
-        return cursor.rowcount > 0
+        for habit_id, user_id, events in batch:
+            done = sum(1 for _, is_done in events if is_done)
+            cursor.execute(
+                'UPDATE habits SET done_count = done_count + ?, skip_count = skip_count + ? WHERE id = ? AND user_id = ?',
+                (done, len(events) - done, habit_id, user_id),
+            )
+            if cursor.rowcount == 0:
+                continue
+            if user_id not in zones:
+                zones[user_id] = _get_user_timezone(cursor, user_id)
+            _record_habit_events(cursor, habit_id, user_id, sorted(events), zones[user_id])
+            applied.append(habit_id)
+    return applied
 
 
+@_query
 def delete_habit(habit_id, user_id):
     with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM habits WHERE id = ? AND user_id = ?', (habit_id, user_id))
-        return cursor.rowcount > 0
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('DELETE FROM habit_events WHERE habit_id = ?', (habit_id,))
+        cursor.execute('DELETE FROM habit_rollups WHERE habit_id = ?', (habit_id,))
+        return True
 
 
+@_query
 def update_habit_time(habit_id, user_id, new_time):
     with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('UPDATE habits SET time = ? WHERE id = ? AND user_id = ?', (new_time, habit_id, user_id))
+        cursor.execute('SELECT frequency, start_date FROM habits WHERE id = ? AND user_id = ?', (habit_id, user_id))
+        res = cursor.fetchone()
+        if not res:
+            return False
+        remind_minute, remind_days = build_reminder_schedule(new_time, res[0], res[1])
+        cursor.execute(
+            'UPDATE habits SET time = ?, remind_minute = ?, remind_days = ? WHERE id = ? AND user_id = ?',
+            (new_time, remind_minute, remind_days, habit_id, user_id),
+        )
         return cursor.rowcount > 0
 
 
+# --- История и статистика ---
+def period_keys(local_dt):
+    # Ключи агрегатов: день, ISO-неделя, месяц (по местному времени пользователя)
+    iso_year, iso_week, _ = local_dt.isocalendar()
+    return {
+        "day": local_dt.strftime("%Y-%m-%d"),
+        "week": f"{iso_year}-W{iso_week:02d}",
+        "month": local_dt.strftime("%Y-%m"),
+    }
+
+
+def streak_period_index(frequency, local_dt):
+    # Номер "периода" привычки: серия растёт, когда отметки идут в соседних периодах
+    ordinal = local_dt.date().toordinal()
+    if frequency == FREQ_WEEKLY:
+        return (ordinal - 1) // 7
+    if frequency == FREQ_WEEKDAYS:
+        # Рабочие дни подряд: пятница и следующий понедельник — соседи
+        return (ordinal - 1) // 7 * 5 + min(local_dt.weekday(), 4)
+    return ordinal
+
+
+def effective_streak(frequency, current_streak, streak_period, local_dt):
+    # Серия, которую не продлили в прошлом периоде, уже прервана
+    if not current_streak or streak_period is None:
+        return 0
+    return current_streak if streak_period >= streak_period_index(frequency, local_dt) - 1 else 0
+
+
+def _record_habit_events(cursor, habit_id, user_id, events, zone_name):
+    # events — [(ts, is_done)] по возрастанию ts
+    cursor.executemany(
+        'INSERT INTO habit_events (habit_id, user_id, ts, status) VALUES (?, ?, ?, ?)',
+        [(habit_id, user_id, ts, 1 if is_done else 0) for ts, is_done in events],
+    )
+
+    local_events = [(local_now(zone_name, ts), is_done) for ts, is_done in events]
+    rollups = {}
+    for local_dt, is_done in local_events:
+        for period, key in period_keys(local_dt).items():
+            counts = rollups.setdefault((period, key), [0, 0])
+            counts[0 if is_done else 1] += 1
+    cursor.executemany(
+        '''INSERT INTO habit_rollups (habit_id, period, period_key, done_count, skip_count) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(habit_id, period, period_key) DO UPDATE SET
+               done_count = done_count + excluded.done_count,
+               skip_count = skip_count + excluded.skip_count''',
+        [(habit_id, period, key, done, skip) for (period, key), (done, skip) in rollups.items()],
+    )
+
+    cursor.execute('SELECT frequency, current_streak, best_streak, streak_period FROM habits WHERE id = ?', (habit_id,))
+    frequency, current, best, last_period = cursor.fetchone()
+    current, best = current or 0, best or 0
+    changed = False
+    for local_dt, is_done in local_events:
+        period = streak_period_index(frequency, local_dt)
+        if last_period is not None and period <= last_period:
+            # В этом периоде уже отмечали "сделано" — серия не меняется
+            continue
+        if is_done:
+            current = current + 1 if last_period == period - 1 else 1
+            best = max(best, current)
+            last_period = period
+        else:
+            current = 0
+        changed = True
+    if changed:
+        cursor.execute(
+            'UPDATE habits SET current_streak = ?, best_streak = ?, streak_period = ? WHERE id = ?',
+            (current, best, last_period, habit_id),
+        )
+
+
+USER_STATS_QUERY = '''SELECT h.id, h.name, h.frequency, h.done_count, h.skip_count, h.start_date,
+                             h.current_streak, h.best_streak, h.streak_period,
+                             COALESCE(w.done_count, 0), COALESCE(w.skip_count, 0),
+                             COALESCE(lw.done_count, 0), COALESCE(lw.skip_count, 0),
+                             COALESCE(m.done_count, 0), COALESCE(m.skip_count, 0)
+                      FROM habits h
+                      LEFT JOIN habit_rollups w ON w.habit_id = h.id AND w.period = 'week' AND w.period_key = ?
+                      LEFT JOIN habit_rollups lw ON lw.habit_id = h.id AND lw.period = 'week' AND lw.period_key = ?
+                      LEFT JOIN habit_rollups m ON m.habit_id = h.id AND m.period = 'month' AND m.period_key = ?
+                      WHERE h.user_id = ? {bounds}
+                      ORDER BY h.id {order}'''
+
+
+def _stats_periods(cursor, user_id):
+    now = local_now(_get_user_timezone(cursor, user_id))
+    this_period = period_keys(now)
+    last_week = period_keys(now - timedelta(days=7))["week"]
+    return now, [this_period["week"], last_week, this_period["month"]]
+
+
+def _stats_rows(rows, now):
+    return [
+        (*row[:6], effective_streak(row[2], row[6], row[8], now), row[7] or 0, *row[9:])
+        for row in rows
+    ]
+
+
+@_query
+def get_user_stats_page(user_id, after_id=None, before_id=None, limit=5):
+    # Страница "Моей статистики" одним запросом: счётчики, серии и готовые агрегаты
+    # за текущую/прошлую неделю и месяц. Сырая история не читается. -> (rows, has_prev, has_next)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        now, params = _stats_periods(cursor, user_id)
+        rows, has_prev, has_next = _fetch_page(cursor, USER_STATS_QUERY, params, user_id, after_id, before_id, limit)
+        return _stats_rows(rows, now), has_prev, has_next
+
+
+@_query
+def get_user_events_page(user_id, after=None, through=None, limit=5000):
+    # Одна страница истории в хронологическом порядке: (ts, event_id, habit_id, habit_name, status).
+    # Keyset по (ts, id) идёт по индексу idx_habit_events_user_ts — страница стоит одинаково
+    # и в начале, и в конце длинной истории. after — (ts, id) последней строки прошлой страницы,
+    # through — (ts, id) последней строки, которую ещё берём (включительно).
+    query = '''SELECT e.ts, e.id, e.habit_id, h.name, e.status FROM habit_events e
+               JOIN habits h ON h.id = e.habit_id
+               WHERE e.user_id = ?'''
+    params = [user_id]
+    if after is not None:
+        query += ' AND (e.ts, e.id) > (?, ?)'
+        params += list(after)
+    if through is not None:
+        query += ' AND (e.ts, e.id) <= (?, ?)'
+        params += list(through)
+    query += ' ORDER BY e.ts, e.id LIMIT ?'
+    params.append(limit)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+
+@_query
+def get_last_user_event(user_id):
+    # (ts, id) последнего события пользователя или None. Граница по одному ts неоднозначна:
+    # в ту же секунду могут быть события и до, и после неё.
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT ts, id FROM habit_events WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT 1',
+            (user_id,),
+        )
+        return cursor.fetchone()
+
+
 # --- Интеграции ---
+@_query
 def set_user_sheet(user_id, link):
     with get_connection() as conn:
         cursor = conn.cursor()
@@ -112,6 +658,7 @@ def set_user_sheet(user_id, link):
         )
 
 
+@_query
 def get_user_sheet(user_id):
     with get_connection() as conn:
         cursor = conn.cursor()
@@ -120,19 +667,168 @@ def get_user_sheet(user_id):
         return res[0] if res else None
 
 
+# --- Профиль пользователя (часовой пояс, подтверждение, таблица) ---
+PROFILE_COLUMNS = 'user_id, timezone, timezone_confirmed, sheet_link, inactive_since IS NOT NULL'
+# Профиль пользователя из архива: строки в users нет, но он "недоступен" — первое же сообщение его вернёт
+ARCHIVED_PROFILE_COLUMNS = 'user_id, NULL, 0, NULL, 1'
+SQLITE_MAX_VARIABLES = 900
+
+
+@_query
+def get_user_profile(user_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {PROFILE_COLUMNS} FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(f'SELECT {ARCHIVED_PROFILE_COLUMNS} FROM archived_users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+        return row
+
+
+@_query
+def is_user_inactive(user_id):
+    # Только флаг, без профиля: две выборки по первичному ключу
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''SELECT EXISTS(SELECT 1 FROM users WHERE user_id = ? AND inactive_since IS NOT NULL)
+                      OR EXISTS(SELECT 1 FROM archived_users WHERE user_id = ?)''',
+            (user_id, user_id),
+        )
+        return bool(cursor.fetchone()[0])
+
+
+@_query
+def get_user_profiles(user_ids):
+    # Пачкой: {user_id: (user_id, timezone, timezone_confirmed, sheet_link, inactive)}
+    user_ids = list(user_ids)
+    profiles = {}
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Каждый id в запросе дважды (users и archived_users) — пачки вдвое меньше
+        step = SQLITE_MAX_VARIABLES // 2
+        for start in range(0, len(user_ids), step):
+            chunk = user_ids[start:start + step]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f'''SELECT {PROFILE_COLUMNS} FROM users WHERE user_id IN ({placeholders})
+                    UNION ALL SELECT {ARCHIVED_PROFILE_COLUMNS} FROM archived_users WHERE user_id IN ({placeholders})''',
+                chunk + chunk,
+            )
+            profiles.update((row[0], row) for row in cursor.fetchall())
+    return profiles
+
+
+# --- Состояния диалогов (FSM) ---
+@_query
+def load_fsm_record(key):
+    # (state, data_json, updated_at) или None
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT state, data, updated_at FROM fsm_state WHERE key = ?', (key,))
+        return cursor.fetchone()
+
+
+@_query
+def save_fsm_records(records):
+    # records — [(key, user_id, state, data_json, updated_at)]; пустая запись (нет ни состояния, ни данных) удаляется
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            '''INSERT INTO fsm_state (key, user_id, state, data, updated_at) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET user_id = excluded.user_id, state = excluded.state,
+                                             data = excluded.data, updated_at = excluded.updated_at''',
+            [r for r in records if r[2] is not None or r[3] is not None],
+        )
+        cursor.executemany(
+            'DELETE FROM fsm_state WHERE key = ?',
+            [(r[0],) for r in records if r[2] is None and r[3] is None],
+        )
+
+
+@_query
+def purge_fsm_records(older_than):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM fsm_state WHERE updated_at < ?', (older_than,))
+        return cursor.rowcount
+
+
+# --- Очередь записи в Google Sheets ---
+@_query
+def enqueue_sheet_row(sheet_url, row, chat_id=None, message_id=None, message_text=None):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''INSERT INTO sheet_outbox (sheet_url, row_json, chat_id, message_id, message_text, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (sheet_url, json.dumps(row, ensure_ascii=False), chat_id, message_id, message_text, time.time()),
+        )
+        return cursor.lastrowid
+
+
+@_query
+def get_pending_sheets():
+    # [(sheet_url, число строк)] — таблицы с очередью, сначала та, чья строка ждёт дольше всех
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT sheet_url, COUNT(*) FROM sheet_outbox GROUP BY sheet_url ORDER BY MIN(id)')
+        return cursor.fetchall()
+
+
+@_query
+def get_pending_sheet_rows(sheet_url, limit=500):
+    # (id, sheet_url, row, chat_id, message_id, message_text, attempts) одной таблицы в порядке добавления
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''SELECT id, sheet_url, row_json, chat_id, message_id, message_text, attempts
+               FROM sheet_outbox WHERE sheet_url = ? ORDER BY id LIMIT ?''',
+            (sheet_url, limit),
+        )
+        return [(r[0], r[1], json.loads(r[2]), *r[3:]) for r in cursor.fetchall()]
+
+
+@_query
+def count_pending_sheet_rows():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM sheet_outbox')
+        return cursor.fetchone()[0]
+
+
+@_query
+def delete_sheet_rows(row_ids):
+    with get_connection() as conn:
+        conn.executemany('DELETE FROM sheet_outbox WHERE id = ?', [(row_id,) for row_id in row_ids])
+
+
+@_query
+def mark_sheet_rows_attempted(row_ids):
+    with get_connection() as conn:
+        conn.executemany('UPDATE sheet_outbox SET attempts = attempts + 1 WHERE id = ?', [(row_id,) for row_id in row_ids])
+
+
 # --- Часовой пояс ---
-def set_user_timezone(user_id, offset):
+@_query
+def set_user_timezone(user_id, zone_name):
+    # zone_name — имя IANA или "UTC+05:30". Локальное время напоминаний не меняется,
+    # у привычек обновляется только копия пояса.
+    get_zone(zone_name)
     with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
             '''
-            INSERT INTO users (user_id, utc_offset, timezone_confirmed) VALUES (?, ?, 1)
-            ON CONFLICT(user_id) DO UPDATE SET utc_offset=excluded.utc_offset, timezone_confirmed=1
+            INSERT INTO users (user_id, timezone, timezone_confirmed) VALUES (?, ?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET timezone=excluded.timezone, timezone_confirmed=1
             ''',
-            (user_id, offset),
+            (user_id, zone_name),
         )
+        cursor.execute('UPDATE habits SET timezone = ? WHERE user_id = ?', (zone_name, user_id))
 
 
+@_query
 def is_timezone_confirmed(user_id):
     with get_connection() as conn:
         cursor = conn.cursor()
@@ -141,16 +837,635 @@ def is_timezone_confirmed(user_id):
         return bool(res and res[0])
 
 
+@_query
 def get_user_timezone(user_id):
     with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT utc_offset FROM users WHERE user_id = ?', (user_id,))
+        return _get_user_timezone(cursor, user_id)
+
+
+def _reminder_zones(cursor):
+    # Различные пояса по индексу idx_habits_due: skip-scan, по одному шагу на пояс,
+    # а не проход по всем привычкам
+    cursor.execute(
+        '''WITH RECURSIVE zones(name) AS (
+               SELECT MIN(timezone) FROM habits WHERE inactive = 0
+               UNION ALL
+               SELECT (SELECT MIN(timezone) FROM habits WHERE inactive = 0 AND timezone > zones.name) FROM zones
+               WHERE zones.name IS NOT NULL
+           )
+           SELECT name FROM zones WHERE name IS NOT NULL'''
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+@_query
+def get_due_habits(utc_minute, partitions=None, partition_count=None):
+    # utc_minute — unix time // 60. Локальное время считается один раз на пояс, дальше —
+    # индексный запрос (пояс, минута): стоимость зависит от числа поясов, а не привычек.
+    # partitions — номера партиций (user_id % partition_count), которыми владеет этот воркер.
+    # -> [(id, user_id, name, time_str, fire_key)]; fire_key — локальная минута "%Y%m%d%H%M".
+    query = '''SELECT id, user_id, name, time FROM habits
+               WHERE timezone = ? AND remind_minute = ? AND inactive = 0 AND (remind_days & ?) != 0'''
+    extra = []
+    if partitions is not None:
+        partitions = sorted(partitions)
+        if not partitions:
+            return []
+        query += f' AND (user_id % ?) IN ({",".join("?" * len(partitions))})'
+        extra = [partition_count, *partitions]
+    due = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for zone_name in _reminder_zones(cursor):
+            try:
+                slots = local_slots(zone_name, utc_minute)
+            except ValueError:
+                logger.warning("Unknown timezone in habits: %s", zone_name)
+                continue
+            for local_minute, weekday, fire_key in slots:
+                cursor.execute(query, [zone_name, local_minute, 1 << weekday, *extra])
+                due += [(*row, fire_key) for row in cursor.fetchall()]
+    return due
+
+
+@_query
+def get_reminder_habits(due, utc_minute, partitions=None, partition_count=None):
+    # Привычки по готовому списку {habit_id: fire_key} (его даёт колесо reminder_scheduler.py):
+    # (id, user_id, name, time_str). Колесо могло отстать от базы — привычку изменили, удалили или
+    # выключили на другой копии бота, — поэтому расписание каждой проверяем заново: её пояс,
+    # минута и дни должны давать на utc_minute тот же слот с тем же fire_key.
+    habit_ids = list(due)
+    habits = []
+    slots = {}
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(habit_ids), SQLITE_MAX_VARIABLES):
+            chunk = habit_ids[start:start + SQLITE_MAX_VARIABLES]
+            cursor.execute(
+                f'''SELECT id, user_id, name, time, timezone, remind_minute, remind_days FROM habits
+                    WHERE inactive = 0 AND remind_minute IS NOT NULL AND id IN ({",".join("?" * len(chunk))})''',
+                chunk,
+            )
+            for habit_id, user_id, name, habit_time, zone_name, minute, days in cursor.fetchall():
+                if zone_name not in slots:
+                    try:
+                        slots[zone_name] = local_slots(zone_name, utc_minute)
+                    except ValueError:
+                        slots[zone_name] = []
+                if any(
+                    local_minute == minute and days & (1 << weekday) and fire_key == due[habit_id]
+                    for local_minute, weekday, fire_key in slots[zone_name]
+                ):
+                    habits.append((habit_id, user_id, name, habit_time))
+    if partitions is not None:
+        habits = [habit for habit in habits if habit[1] % partition_count in partitions]
+    return habits
+
+
+@_query
+def iter_reminder_schedules():
+    # Всё расписание одним проходом, без списка на миллион кортежей:
+    # (id, timezone, remind_minute, remind_days)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, timezone, remind_minute, remind_days FROM habits WHERE remind_minute IS NOT NULL AND inactive = 0')
+        yield from cursor
+
+
+@_query
+def get_habit_schedules(habit_ids):
+    # {habit_id: (timezone, remind_minute, remind_days)}; удалённых привычек в ответе нет,
+    # у привычек недоступных пользователей минута — None (напоминать не нужно)
+    habit_ids = list(habit_ids)
+    schedules = {}
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(habit_ids), SQLITE_MAX_VARIABLES):
+            chunk = habit_ids[start:start + SQLITE_MAX_VARIABLES]
+            cursor.execute(
+                f'SELECT id, timezone, CASE WHEN inactive = 0 THEN remind_minute END, remind_days FROM habits WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk,
+            )
+            schedules.update((row[0], row[1:]) for row in cursor.fetchall())
+    return schedules
+
+
+@_query
+def get_user_habit_ids(user_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM habits WHERE user_id = ?', (user_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+@_query
+def log_schedule_changes(habit_ids=(), user_id=None):
+    # Строка на привычку; изменение у пользователя целиком (пояс, недоступность) — одна строка с user_id
+    now = time.time()
+    rows = [(habit_id, None, now) for habit_id in habit_ids]
+    if user_id is not None:
+        rows.append((None, user_id, now))
+    with get_connection() as conn:
+        conn.executemany('INSERT INTO schedule_changes (habit_id, user_id, changed_at) VALUES (?, ?, ?)', rows)
+
+
+@_query
+def get_schedule_changes(after_id, limit=1000):
+    # -> (id последней прочитанной строки, id затронутых привычек). Строки пользователя
+    # раскрываются в его привычки; удалённых привычек уже нет — их id приходят своими строками.
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, habit_id, user_id FROM schedule_changes WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit))
+        rows = cursor.fetchall()
+        if not rows:
+            return after_id, []
+        habit_ids = {habit_id for _, habit_id, _ in rows if habit_id is not None}
+        for user_id in {user_id for _, _, user_id in rows if user_id is not None}:
+            cursor.execute('SELECT id FROM habits WHERE user_id = ?', (user_id,))
+            habit_ids.update(row[0] for row in cursor.fetchall())
+        return rows[-1][0], sorted(habit_ids)
+
+
+@_query
+def get_last_schedule_change_id():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM schedule_changes')
+        return cursor.fetchone()[0]
+
+
+@_query
+def prune_schedule_changes(older_than):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM schedule_changes WHERE changed_at < ?', (older_than,))
+        return cursor.rowcount
+
+
+@_query
+def get_scheduler_state(key):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM scheduler_state WHERE key = ?', (key,))
         res = cursor.fetchone()
-        return res[0] if res and res[0] is not None else 3
+        return res[0] if res else None
+
+
+@_query
+def set_scheduler_state(key, value):
+    with get_connection() as conn:
+        conn.execute(
+            '''INSERT INTO scheduler_state (key, value) VALUES (?, ?)
+               ON CONFLICT(key) DO UPDATE SET value = excluded.value''',
+            (key, value),
+        )
+
+
+# --- Недоступные пользователи (заблокировали бота, удалили аккаунт) ---
+ARCHIVE_TABLES = ('users', 'habits', 'habit_events', 'habit_rollups')
+# Короткоживущие строки пользователя: при архивации удаляются, а не переносятся — к его
+# возвращению они бессмысленны (историю в таблицу перенесёт кнопка "Перенести историю")
+PURGED_ON_ARCHIVE = (
+    ('weekly_digests', 'user_id = ?'),
+    ('fsm_state', 'user_id = ?'),
+    ('sheet_outbox', 'chat_id = ?'),
+)
+
+
+@_query
+def mark_users_inactive(user_ids, now=None):
+    # Возвращает id привычек, которые выпали из расписания напоминаний
+    now = now if now is not None else time.time()
+    user_ids = list(user_ids)
+    habit_ids = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(user_ids), SQLITE_MAX_VARIABLES):
+            chunk = user_ids[start:start + SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.executemany(
+                '''INSERT INTO users (user_id, inactive_since) VALUES (?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET inactive_since = COALESCE(inactive_since, excluded.inactive_since)''',
+                [(user_id, now) for user_id in chunk],
+            )
+            cursor.execute(f'SELECT id FROM habits WHERE inactive = 0 AND user_id IN ({placeholders})', chunk)
+            habit_ids += [row[0] for row in cursor.fetchall()]
+            cursor.execute(f'UPDATE habits SET inactive = 1 WHERE inactive = 0 AND user_id IN ({placeholders})', chunk)
+    return habit_ids
+
+
+def _restore_user(cursor, user_id):
+    cursor.execute('SELECT data FROM archived_users WHERE user_id = ?', (user_id,))
+    res = cursor.fetchone()
+    if res is None:
+        return False
+    for table, (columns, rows) in json.loads(zlib.decompress(res[0])).items():
+        if rows:
+            cursor.executemany(
+                f'INSERT OR REPLACE INTO {table} ({", ".join(columns)}) VALUES ({",".join("?" * len(columns))})',
+                rows,
+            )
+    cursor.execute('DELETE FROM archived_users WHERE user_id = ?', (user_id,))
+    return True
+
+
+@_query
+def reactivate_user(user_id):
+    # Пользователь снова написал боту: возвращаем из архива или просто снимаем отметку.
+    # True — что-то изменилось (нужно перечитать его расписание)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        restored = _restore_user(cursor, user_id)
+        cursor.execute('UPDATE users SET inactive_since = NULL WHERE user_id = ? AND inactive_since IS NOT NULL', (user_id,))
+        changed = restored or cursor.rowcount > 0
+        if changed:
+            cursor.execute('UPDATE habits SET inactive = 0 WHERE user_id = ?', (user_id,))
+        return changed
+
+
+def _archive_user(cursor, user_id, now):
+    cursor.execute('SELECT id FROM habits WHERE user_id = ?', (user_id,))
+    habit_ids = [row[0] for row in cursor.fetchall()]
+    data = {}
+    for table in ARCHIVE_TABLES:
+        if table == 'habit_rollups':
+            # У агрегатов нет user_id — берём по привычкам
+            where = f'habit_id IN ({",".join("?" * len(habit_ids))})'
+            params = habit_ids
+        else:
+            where, params = 'user_id = ?', [user_id]
+        rows = []
+        if params:
+            cursor.execute(f'SELECT * FROM {table} WHERE {where}', params)
+            rows = cursor.fetchall()
+        data[table] = ([column[0] for column in cursor.description] if rows else [], rows)
+        if rows:
+            cursor.execute(f'DELETE FROM {table} WHERE {where}', params)
+    for table, where in PURGED_ON_ARCHIVE:
+        cursor.execute(f'DELETE FROM {table} WHERE {where}', (user_id,))
+    if habit_ids:
+        cursor.execute(f'DELETE FROM reminder_claims WHERE habit_id IN ({",".join("?" * len(habit_ids))})', habit_ids)
+    blob = zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    cursor.execute(
+        'INSERT OR REPLACE INTO archived_users (user_id, data, archived_at) VALUES (?, ?, ?)', (user_id, blob, now)
+    )
+
+
+@_query
+def archive_inactive_users(older_than, limit=500, now=None):
+    # Переносим в archived_users тех, кто недоступен с older_than: их строки больше не
+    # раздувают habits/habit_events. Возвращает число перенесённых пользователей.
+    now = now if now is not None else time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT user_id FROM users WHERE inactive_since IS NOT NULL AND inactive_since < ? LIMIT ?',
+            (older_than, limit),
+        )
+        user_ids = [row[0] for row in cursor.fetchall()]
+        for user_id in user_ids:
+            _archive_user(cursor, user_id, now)
+        return len(user_ids)
+
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+@_query
+def incremental_vacuum(max_pages):
+    # Отдаём ОС до max_pages свободных страниц файла — запись блокируется ненадолго.
+    # Своё соединение вне транзакции. Возвращает число освобождённых страниц,
+    # None — база ещё не переведена в auto_vacuum=INCREMENTAL (см. enable_incremental_vacuum).
+    conn = sqlite3.connect(DB_NAME, timeout=5, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            return None
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript, а не execute: прагма освобождает по странице за шаг, execute делает один шаг
+        conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+
+
+@_query
+def enable_incremental_vacuum():
+    # Разовый перевод старой базы в auto_vacuum=INCREMENTAL: полный VACUUM переписывает файл
+    # и всё это время держит запись. Запускать при остановленном боте: python maintenance.py --enable-incremental-vacuum
+    conn = sqlite3.connect(DB_NAME, timeout=60, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+
+# --- Еженедельные сводки ---
+@_query
+def get_digest_zones():
+    # Пояса активных пользователей: skip-scan по idx_users_timezone, шаг на пояс.
+    # None — пользователи, так и не выбравшие пояс (живут по DEFAULT_TIMEZONE)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''WITH RECURSIVE zones(name) AS (
+                   SELECT MIN(timezone) FROM users WHERE inactive_since IS NULL
+                   UNION ALL
+                   SELECT (SELECT MIN(timezone) FROM users WHERE inactive_since IS NULL AND timezone > zones.name) FROM zones
+                   WHERE zones.name IS NOT NULL
+               )
+               SELECT name FROM zones WHERE name IS NOT NULL'''
+        )
+        zones = [row[0] for row in cursor.fetchall()]
+        cursor.execute('SELECT 1 FROM users WHERE timezone IS NULL AND inactive_since IS NULL LIMIT 1')
+        if cursor.fetchone():
+            zones.append(None)
+        return zones
+
+
+@_query
+def get_zone_users_page(zone_name, after_user_id=0, limit=500):
+    # zone_name=None — пользователи без пояса
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''SELECT user_id FROM users
+               WHERE timezone IS ? AND inactive_since IS NULL AND user_id > ?
+               ORDER BY user_id LIMIT ?''',
+            (zone_name, after_user_id, limit),
+        )
+        return [row[0] for row in cursor.fetchall()]
 
 
-def get_all_habits_with_users():
+@_query
+def get_weekly_summary(user_ids, week, previous_week):
+    # Одним запросом на пачку пользователей: готовые недельные агрегаты, без сырой истории.
+    # -> [(user_id, name, done, skip, prev_done, prev_skip, current_streak)] по user_id, id
+    user_ids = list(user_ids)
+    rows = []
     with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT id, user_id, name, time FROM habits')
+        for start in range(0, len(user_ids), SQLITE_MAX_VARIABLES):
+            chunk = user_ids[start:start + SQLITE_MAX_VARIABLES]
+            cursor.execute(
+                f'''SELECT h.user_id, h.name,
+                           COALESCE(w.done_count, 0), COALESCE(w.skip_count, 0),
+                           COALESCE(pw.done_count, 0), COALESCE(pw.skip_count, 0),
+                           h.current_streak
+                    FROM habits h
+                    LEFT JOIN habit_rollups w ON w.habit_id = h.id AND w.period = 'week' AND w.period_key = ?
+                    LEFT JOIN habit_rollups pw ON pw.habit_id = h.id AND pw.period = 'week' AND pw.period_key = ?
+                    WHERE h.user_id IN ({",".join("?" * len(chunk))})
+                    ORDER BY h.user_id, h.id''',
+                [week, previous_week, *chunk],
+            )
+            rows += cursor.fetchall()
+    return rows
+
+
+@_query
+def save_weekly_digests(digests):
+    # digests — [(user_id, week, send_at, text)]; уже подготовленные не перезаписываем
+    with get_connection() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO weekly_digests (user_id, week, send_at, text) VALUES (?, ?, ?, ?)', digests
+        )
+
+
+@_query
+def get_due_digests(now, max_delay, partitions=None, partition_count=None, limit=500):
+    # Сводки, чьё время пришло, но не раньше now - max_delay (опоздавшие уже не актуальны)
+    query = '''SELECT user_id, week, text FROM weekly_digests
+               WHERE sent_at IS NULL AND send_at BETWEEN ? AND ?'''
+    params = [now - max_delay, now]
+    if partitions is not None:
+        partitions = sorted(partitions)
+        if not partitions:
+            return []
+        query += f' AND (user_id % ?) IN ({",".join("?" * len(partitions))})'
+        params += [partition_count, *partitions]
+    query += ' ORDER BY send_at LIMIT ?'
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, [*params, limit])
         return cursor.fetchall()
+
+
+@_query
+def mark_digests_sent(keys, now=None):
+    # keys — [(user_id, week)]
+    now = now if now is not None else time.time()
+    with get_connection() as conn:
+        conn.executemany(
+            'UPDATE weekly_digests SET sent_at = ? WHERE user_id = ? AND week = ?',
+            [(now, user_id, week) for user_id, week in keys],
+        )
+
+
+@_query
+def prune_weekly_digests(older_than):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM weekly_digests WHERE send_at < ?', (older_than,))
+        return cursor.rowcount
+
+
+# --- Рассылки ---
+BROADCAST_COLUMNS = 'id, text, status, created_by, chat_id, message_id, total, last_user_id, sent, failed'
+
+
+@_query
+def create_broadcast(text, created_by, chat_id, message_id, now=None):
+    now = now if now is not None else time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM users WHERE inactive_since IS NULL')
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            '''INSERT INTO broadcasts (text, status, created_by, chat_id, message_id, total, created_at)
+               VALUES (?, 'running', ?, ?, ?, ?, ?)''',
+            (text, created_by, chat_id, message_id, total, now),
+        )
+        return cursor.lastrowid
+
+
+@_query
+def get_broadcast(broadcast_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?', (broadcast_id,))
+        return cursor.fetchone()
+
+
+@_query
+def set_broadcast_status(broadcast_id, status, now=None):
+    # 'running' снимает владельца: рассылку подхватит первая свободная копия бота.
+    # Законченную или отменённую рассылку больше не трогаем; остановленную из-за ошибки
+    # ('failed') можно продолжить или отменить. True — статус изменён.
+    now = now if now is not None else time.time()
+    finished_at = now if status in ('done', 'cancelled') else None
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''UPDATE broadcasts SET status = ?, finished_at = ?, owner = CASE WHEN ? = 'running' THEN NULL ELSE owner END
+               WHERE id = ? AND status IN ('running', 'paused', 'failed')''',
+            (status, finished_at, status, broadcast_id),
+        )
+        return cursor.rowcount > 0
+
+
+@_query
+def claim_broadcasts(owner, lease_ttl, now=None):
+    # Забираем идущие рассылки без живого владельца (новые, после resume или после падения копии)
+    now = now if now is not None else time.time()
+    claimed = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM broadcasts WHERE status = 'running' AND (owner IS NULL OR owner = ? OR lease_until < ?)",
+            (owner, now),
+        )
+        for (broadcast_id,) in cursor.fetchall():
+            cursor.execute(
+                '''UPDATE broadcasts SET owner = ?, lease_until = ?
+                   WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR lease_until < ?)''',
+                (owner, now + lease_ttl, broadcast_id, owner, now),
+            )
+            if cursor.rowcount:
+                cursor.execute(f'SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?', (broadcast_id,))
+                claimed.append(cursor.fetchone())
+    return claimed
+
+
+@_query
+def checkpoint_broadcast(broadcast_id, owner, last_user_id, sent, failed, lease_ttl, now=None):
+    # Сохраняем прогресс и продлеваем аренду. Возвращает текущий статус рассылки
+    # (его могли поменять кнопки в другой копии бота) или None, если аренду забрали.
+    now = now if now is not None else time.time()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, lease_until = ?
+               WHERE id = ? AND owner = ?''',
+            (last_user_id, sent, failed, now + lease_ttl, broadcast_id, owner),
+        )
+        if not cursor.rowcount:
+            return None
+        cursor.execute('SELECT status FROM broadcasts WHERE id = ?', (broadcast_id,))
+        return cursor.fetchone()[0]
+
+
+@_query
+def get_user_ids_page(after_user_id=0, limit=1000):
+    # Получатели рассылки по порядку id (keyset по первичному ключу users), без недоступных
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT user_id FROM users WHERE user_id > ? AND inactive_since IS NULL ORDER BY user_id LIMIT ?',
+            (after_user_id, limit),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+# --- Несколько воркеров: аренда партиций ---
+@_query
+def heartbeat_worker(worker_id, partition_count, lease_ttl, now=None):
+    # Одна транзакция: отмечаемся живыми, продлеваем свои партиции, отдаём лишние
+    # и забираем свободные/просроченные до своей доли.
+    # Возвращает (партиции, срок аренды, {партиция: fired_through}).
+    now = now if now is not None else time.time()
+    expires_at = now + lease_ttl
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Первая операция — запись: транзакция сразу берёт блокировку на запись
+        cursor.execute(
+            '''INSERT INTO scheduler_workers (worker_id, heartbeat_at) VALUES (?, ?)
+               ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at''',
+            (worker_id, now),
+        )
+        cursor.execute('DELETE FROM scheduler_workers WHERE heartbeat_at < ?', (now - lease_ttl,))
+        cursor.executemany(
+            'INSERT OR IGNORE INTO partition_leases (partition, owner, expires_at) VALUES (?, NULL, 0)',
+            [(p,) for p in range(partition_count)],
+        )
+        cursor.execute('SELECT COUNT(*) FROM scheduler_workers')
+        live_workers = cursor.fetchone()[0]
+        fair_share = -(-partition_count // max(live_workers, 1))
+
+        cursor.execute('UPDATE partition_leases SET expires_at = ? WHERE owner = ? AND partition < ?', (expires_at, worker_id, partition_count))
+        cursor.execute('SELECT partition FROM partition_leases WHERE owner = ? AND partition < ? ORDER BY partition', (worker_id, partition_count))
+        owned = [row[0] for row in cursor.fetchall()]
+
+        if len(owned) > fair_share:
+            # Появились новые воркеры — освобождаем лишнее, они подхватят
+            extra = owned[fair_share:]
+            owned = owned[:fair_share]
+            cursor.executemany('UPDATE partition_leases SET owner = NULL, expires_at = 0 WHERE partition = ? AND owner = ?', [(p, worker_id) for p in extra])
+        elif len(owned) < fair_share:
+            cursor.execute(
+                '''SELECT partition FROM partition_leases
+                   WHERE partition < ? AND (owner IS NULL OR expires_at < ?) ORDER BY partition LIMIT ?''',
+                (partition_count, now, fair_share - len(owned)),
+            )
+            free = [row[0] for row in cursor.fetchall()]
+            cursor.executemany('UPDATE partition_leases SET owner = ?, expires_at = ? WHERE partition = ?', [(worker_id, expires_at, p) for p in free])
+            owned += free
+        owned.sort()
+        marks = {}
+        if owned:
+            cursor.execute(
+                f'SELECT partition, fired_through FROM partition_leases WHERE partition IN ({",".join("?" * len(owned))})', owned
+            )
+            marks = dict(cursor.fetchall())
+        return owned, expires_at, marks
+
+
+@_query
+def release_worker(worker_id):
+    with get_connection() as conn:
+        conn.execute('UPDATE partition_leases SET owner = NULL, expires_at = 0 WHERE owner = ?', (worker_id,))
+        conn.execute('DELETE FROM scheduler_workers WHERE worker_id = ?', (worker_id,))
+
+
+@_query
+def mark_partitions_fired(partitions, minute, worker_id):
+    # Напоминания партиций до UTC-минуты minute включительно взяты; чужие партиции не трогаем
+    partitions = sorted(partitions)
+    if not partitions:
+        return
+    with get_connection() as conn:
+        conn.execute(
+            f'''UPDATE partition_leases SET fired_through = MAX(COALESCE(fired_through, 0), ?)
+                WHERE owner = ? AND partition IN ({",".join("?" * len(partitions))})''',
+            [minute, worker_id, *partitions],
+        )
+
+
+@_query
+def claim_reminders(keys, owner, now=None):
+    # keys — [(habit_id, fire_key)]. Возвращает только те, что удалось взять первыми:
+    # при перебалансировке два воркера могут увидеть одну партицию, но отправит один.
+    now = now if now is not None else time.time()
+    claimed = []
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for habit_id, fire_key in keys:
+            cursor.execute(
+                'INSERT OR IGNORE INTO reminder_claims (habit_id, fire_key, owner, claimed_at) VALUES (?, ?, ?, ?)',
+                (habit_id, fire_key, owner, now),
+            )
+            if cursor.rowcount:
+                claimed.append((habit_id, fire_key))
+    return claimed
+
+
+@_query
+def prune_reminder_claims(older_than):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM reminder_claims WHERE claimed_at < ?', (older_than,))
+        return cursor.rowcount
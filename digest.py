@@ -0,0 +1,171 @@
+import asyncio
+import html
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from async_database import (
+    get_digest_zones,
+    get_due_digests,
+    get_scheduler_state,
+    get_weekly_summary,
+    get_zone_users_page,
+    mark_digests_sent,
+    mark_users_inactive,
+    prune_weekly_digests,
+    save_weekly_digests,
+    set_scheduler_state,
+)
+from database import period_keys
+from metrics import WEEKLY_DIGESTS
+from sender import OutgoingMessage
+from timezones import local_now, local_to_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Еженедельная сводка. Подготовка: когда в поясе наступил понедельник, его пользователи
+# пачками по CHUNK_SIZE проходят через один агрегатный запрос по habit_rollups, тексты
+# сохраняются в weekly_digests. Отправка: каждому — в своё время внутри окна
+# WINDOW_START_HOUR..+WINDOW_MINUTES по местному времени, чтобы не было пика.
+CHUNK_SIZE = 500
+WINDOW_START_HOUR = int(os.getenv("DIGEST_WINDOW_START_HOUR", 10))
+WINDOW_MINUTES = int(os.getenv("DIGEST_WINDOW_MINUTES", 120))
+# Не успели отправить за это время (бот лежал) — сводка уже неактуальна
+MAX_DELAY = 6 * 3600
+DELIVERY_INTERVAL = 30.0
+DELIVERY_BATCH = 500
+MAX_HABITS_SHOWN = 15
+KEEP_WEEKS = 4
+PREPARED_KEY = "digest_prepared:{}"
+
+
+def _percent(done, skip):
+    total = done + skip
+    return round(done * 100 / total) if total else None
+
+
+def render_digest(week, habits):
+    # habits — [(name, done, skip, prev_done, prev_skip, streak)]; None — отчитываться не о чем
+    done = sum(h[1] for h in habits)
+    skip = sum(h[2] for h in habits)
+    if not done and not skip:
+        return None
+    percent = _percent(done, skip)
+    lines = [f"<b>🗓 Итоги недели {week}</b>", f"Выполнено {done} из {done + skip} отметок — {percent}%"]
+    previous = _percent(sum(h[3] for h in habits), sum(h[4] for h in habits))
+    if previous is not None:
+        diff = percent - previous
+        trend = f"на {diff} п.п. лучше" if diff > 0 else f"на {-diff} п.п. хуже" if diff < 0 else "так же"
+        lines.append(f"Это {trend}, чем неделей раньше ({previous}%)")
+    lines.append("")
+    for name, h_done, h_skip, _, _, streak in habits[:MAX_HABITS_SHOWN]:
+        h_percent = _percent(h_done, h_skip)
+        result = f"✅ {h_done} | ❌ {h_skip} — {h_percent}%" if h_percent is not None else "нет отметок"
+        lines.append(f"🔹 {html.escape(name)}: {result}" + (f" 🔥{streak}" if streak else ""))
+    if len(habits) > MAX_HABITS_SHOWN:
+        lines.append(f"... и ещё {len(habits) - MAX_HABITS_SHOWN}")
+    return "\n".join(lines)
+
+
+def send_time(zone_name, monday, user_id):
+    # Момент отправки внутри окна: по user_id, равномерно и одинаково при повторной подготовке
+    spread = (user_id * 2654435761) % (WINDOW_MINUTES * 60)
+    local = datetime.combine(monday, datetime.min.time()) + timedelta(hours=WINDOW_START_HOUR, seconds=spread)
+    return local_to_timestamp(zone_name, local)
+
+
+async def prepare_zone(zone_name, monday):
+    last_week = monday - timedelta(days=7)
+    week = period_keys(datetime.combine(last_week, datetime.min.time()))["week"]
+    previous_week = period_keys(datetime.combine(last_week - timedelta(days=7), datetime.min.time()))["week"]
+    prepared, after = 0, 0
+    while True:
+        user_ids = await get_zone_users_page(zone_name, after, CHUNK_SIZE)
+        if not user_ids:
+            break
+        by_user = {}
+        for user_id, name, done, skip, prev_done, prev_skip, streak in await get_weekly_summary(user_ids, week, previous_week):
+            by_user.setdefault(user_id, []).append((name, done, skip, prev_done, prev_skip, streak))
+        digests = []
+        for user_id, habits in by_user.items():
+            text = render_digest(week, habits)
+            if text is not None:
+                digests.append((user_id, week, send_time(zone_name, monday, user_id), text))
+        if digests:
+            await save_weekly_digests(digests)
+        prepared += len(digests)
+        if len(user_ids) < CHUNK_SIZE:
+            break
+        after = user_ids[-1]
+    return prepared
+
+
+async def prepare_weekly_digests():
+    # Периодическая задача: готовит сводки поясам, где уже понедельник. Повторный запуск
+    # ничего не дублирует (отметка в scheduler_state и INSERT OR IGNORE).
+    started = time.monotonic()
+    total = 0
+    for zone_name in await get_digest_zones():
+        # zone_name=None — пользователи без пояса: local_now и send_time берут DEFAULT_TIMEZONE
+        try:
+            today = local_now(zone_name).date()
+        except ValueError:
+            continue
+        if today.weekday() != 0:
+            continue
+        key = PREPARED_KEY.format(zone_name or "default")
+        if await get_scheduler_state(key) == today.toordinal():
+            continue
+        count = await prepare_zone(zone_name, today)
+        await set_scheduler_state(key, today.toordinal())
+        WEEKLY_DIGESTS.labels("prepared").inc(count)
+        total += count
+    if total:
+        logger.info("Prepared %s weekly digests in %.1fs", total, time.monotonic() - started)
+    await prune_weekly_digests(time.time() - KEEP_WEEKS * 7 * 86400)
+
+
+class DigestSender:
+    # Раз в DELIVERY_INTERVAL забирает сводки, чьё время пришло (только своих партиций),
+    # и отправляет через общий MessageSender
+    def __init__(self, sender, partitions, interval=DELIVERY_INTERVAL):
+        self.sender = sender
+        self.partitions = partitions
+        self.interval = interval
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.deliver() == DELIVERY_BATCH:
+                    pass
+            except Exception:
+                logger.exception("Weekly digest delivery failed")
+            await asyncio.sleep(self.interval)
+
+    async def deliver(self):
+        owned = self.partitions.owned
+        due = await get_due_digests(time.time(), MAX_DELAY, owned, self.partitions.partition_count, DELIVERY_BATCH)
+        if not due:
+            return 0
+        stats = await self.sender.send_many(OutgoingMessage(user_id, text) for user_id, _, text in due)
+        # Неудачные тоже помечаем: сводку не повторяем, напоминания важнее
+        await mark_digests_sent([(user_id, week) for user_id, week, _ in due])
+        if stats.unreachable:
+            await mark_users_inactive(set(stats.unreachable))
+        WEEKLY_DIGESTS.labels("sent").inc(stats.sent)
+        WEEKLY_DIGESTS.labels("failed").inc(stats.failed + len(stats.unreachable))
+        return len(due)
@@ -0,0 +1,148 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+import tempfile
+
+import database
+from async_database import get_user_events_page, stats_buffer
+from google_manager import append_rows, build_row, is_retryable_error
+from timezones import local_now
+
+logger = logging.getLogger(__name__)
+
+# Выгрузка истории: страницы из базы -> строки -> временный файл (или Google Sheets).
+# В памяти одновременно не больше одной страницы, сколько бы ни было событий.
+PAGE_SIZE = 5000
+EXPORT_FORMATS = ("csv", "jsonl")
+STATUS_TEXT = {1: "ВЫПОЛНЕНО", 0: "ПРОПУЩЕНО"}
+# Строк в одном append_rows при выгрузке в таблицу: чем больше, тем меньше запросов к квоте
+BACKFILL_CHUNK_ROWS = 10_000
+BACKFILL_ATTEMPTS = 5
+BACKFILL_BACKOFF = 10.0
+
+
+def iter_user_events(user_id, through=None, page_size=PAGE_SIZE):
+    # (ts, habit_id, habit_name, status) по всей истории, страницами по page_size
+    after = None
+    while True:
+        page = database.get_user_events_page(user_id, after, through, page_size)
+        for ts, _, habit_id, habit_name, status in page:
+            yield ts, habit_id, habit_name, status
+        if len(page) < page_size:
+            return
+        after = page[-1][:2]
+
+
+def iter_csv_rows(user_id, zone_name):
+    yield ["date", "time", "habit", "status"]
+    for ts, _, habit_name, status in iter_user_events(user_id):
+        yield build_row(habit_name, STATUS_TEXT[status], local_now(zone_name, ts))
+
+
+def iter_jsonl_records(user_id, zone_name):
+    # Сначала сами привычки, потом события — файл можно читать построчно
+    for habit_id, name, freq, habit_time, done, skip, start_date in database.get_all_user_habits(user_id):
+        yield {
+            "type": "habit", "id": habit_id, "name": name, "frequency": freq, "time": habit_time,
+            "done": done, "skip": skip, "start_date": start_date,
+        }
+    for ts, habit_id, habit_name, status in iter_user_events(user_id):
+        yield {
+            "type": "event", "habit_id": habit_id, "habit": habit_name, "ts": ts,
+            "local_time": local_now(zone_name, ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "status": "done" if status else "skip",
+        }
+
+
+def write_export(user_id, fmt, zone_name, path):
+    # Возвращает число выгруженных событий истории (без заголовка CSV и записей о привычках)
+    count = 0
+    try:
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if fmt == "csv":
+                f.write("\ufeff")  # BOM — чтобы Excel сразу понял UTF-8
+                writer = csv.writer(f)
+                for count, row in enumerate(iter_csv_rows(user_id, zone_name)):
+                    writer.writerow(row)
+            else:
+                for record in iter_jsonl_records(user_id, zone_name):
+                    f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+                    f.write("\n")
+                    count += record["type"] == "event"
+    finally:
+        database.close_connection()
+    return count
+
+
+async def export_user_history(user_id, fmt, zone_name):
+    # -> (путь к временному файлу, число строк). Файл удаляет вызывающий, когда отправит.
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    # Файл пишется из потока напрямую через database.py — сначала дописываем буфер нажатий
+    await stats_buffer.flush_user(user_id)
+    fd, path = tempfile.mkstemp(prefix=f"habits_{user_id}_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(write_export, user_id, fmt, zone_name, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, count
+
+
+async def _append_with_retry(sheet_url, rows):
+    for attempt in range(1, BACKFILL_ATTEMPTS + 1):
+        try:
+            await append_rows(sheet_url, rows)
+            return
+        except Exception as e:
+            if not is_retryable_error(e) or attempt == BACKFILL_ATTEMPTS:
+                raise
+            delay = BACKFILL_BACKOFF * 2 ** (attempt - 1)
+            logger.warning("Backfill to %s failed (%s), retry in %.0fs", sheet_url, e, delay)
+            await asyncio.sleep(delay)
+
+
+async def backfill_user_sheet(sheet_url, user_id, zone_name, through, progress=None):
+    # Вся история по through — (ts, id) последнего события на момент подключения таблицы,
+    # дальше пишет SheetsWriter — крупными append_rows: обычно это один-два запроса
+    # к Sheets API на пользователя. progress(total) — после каждой отправленной пачки.
+    chunk, total, after = [], 0, None
+    while True:
+        page = await get_user_events_page(user_id, after, through, PAGE_SIZE)
+        for ts, _, _, habit_name, status in page:
+            chunk.append(build_row(habit_name, STATUS_TEXT[status], local_now(zone_name, ts)))
+        if len(chunk) >= BACKFILL_CHUNK_ROWS or (chunk and len(page) < PAGE_SIZE):
+            await _append_with_retry(sheet_url, chunk)
+            total += len(chunk)
+            chunk = []
+            if progress is not None:
+                await progress(total)
+        if len(page) < PAGE_SIZE:
+            return total
+        after = page[-1][:2]
+
+
+class HistoryBackfills:
+    # Перенос истории идёт минутами (квота Sheets API, ретраи), поэтому не в обработчике
+    # апдейта — иначе очередь пользователя (user_queue.py) стоит всё это время.
+    # Не больше одного переноса на пользователя; при остановке бота незавершённые отменяются.
+    def __init__(self):
+        self._tasks = {}
+
+    def running(self, user_id):
+        return user_id in self._tasks
+
+    def start(self, user_id, coro):
+        task = asyncio.create_task(coro)
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user_id, None))
+        return task
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from async_database import load_fsm_record, save_fsm_records, purge_fsm_records
+
+logger = logging.getLogger(__name__)
+
+# Недописанный диалог (например, бросили на вводе времени) забываем через сутки
+STATE_TTL = 24 * 3600
+# Изменения копятся в памяти и уходят в SQLite одной транзакцией раз в FLUSH_INTERVAL
+FLUSH_INTERVAL = 0.5
+PURGE_INTERVAL = 3600
+MAX_CACHED = 50_000
+
+
+class _Record:
+    __slots__ = ("state", "data", "touched", "loaded_at", "user_id")
+
+    def __init__(self, state=None, data=None, touched=0.0, loaded_at=0.0, user_id=None):
+        self.state = state
+        self.data = data or {}
+        self.touched = touched
+        self.loaded_at = loaded_at
+        self.user_id = user_id
+
+
+def _dumps(data):
+    # Компактно: без пробелов, кириллица без \\uXXXX; пустые данные не пишем вовсе
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM-хранилище: горячие состояния живут в памяти (чтение — обращение к dict),
+    # изменения пачками пишутся в таблицу fsm_state и переживают перезапуск.
+    # cache_ttl — сколько секунд доверять кэшу без перечитывания из базы; при нескольких
+    # процессах задайте небольшое значение (и flush_interval=0), чтобы видеть чужие изменения.
+    def __init__(
+        self,
+        key_builder: Optional[KeyBuilder] = None,
+        state_ttl: float = STATE_TTL,
+        flush_interval: float = FLUSH_INTERVAL,
+        cache_ttl: Optional[float] = None,
+        max_cached: int = MAX_CACHED,
+    ):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        self._dirty: Dict[str, _Record] = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._purge_task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+        self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def close(self) -> None:
+        for task in (self._task, self._purge_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._purge_task = None
+        await self.flush()
+
+    # --- чтение/запись ---
+    async def _get_record(self, key: StorageKey) -> _Record:
+        str_key = self.key_builder.build(key)
+        now = time.time()
+        record = self._cache.get(str_key)
+        stale = record is not None and self.cache_ttl is not None and str_key not in self._dirty and now - record.loaded_at > self.cache_ttl
+        if record is None or stale:
+            row = await load_fsm_record(str_key)
+            # Пока ждали базу, запись могли изменить — тогда верим памяти
+            record = self._cache.get(str_key) if str_key in self._dirty else None
+            if record is None:
+                if row is None:
+                    record = _Record(loaded_at=now, user_id=key.user_id)
+                else:
+                    state, data, updated_at = row
+                    record = _Record(state, json.loads(data) if data else {}, updated_at, now, key.user_id)
+                self._cache[str_key] = record
+        self._cache.move_to_end(str_key)
+        if (record.state is not None or record.data) and now - record.touched > self.state_ttl:
+            # Брошенный диалог — начинаем с чистого листа
+            record.state, record.data = None, {}
+            self._mark_dirty(str_key, record, now)
+        self._evict()
+        return record
+
+    def _mark_dirty(self, str_key, record, now):
+        record.touched = now
+        self._dirty[str_key] = record
+        if self.flush_interval <= 0:
+            self._wake.set()
+
+    def _evict(self):
+        # Вытесняем самые давние записи, но только уже сохранённые
+        overflow = len(self._cache) - self.max_cached
+        if overflow <= 0:
+            return
+        for str_key in list(self._cache)[:overflow]:
+            if str_key not in self._dirty:
+                del self._cache[str_key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(self.key_builder.build(key), record, time.time())
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(self.key_builder.build(key), record, time.time())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_record(key)).data.copy()
+
+    # --- фоновая запись ---
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            records = [(k, r.user_id, r.state, _dumps(r.data), r.touched) for k, r in dirty.items()]
+            try:
+                await save_fsm_records(records)
+            except Exception:
+                # Не получилось — вернём в очередь, не затирая более свежие изменения
+                for str_key, record in dirty.items():
+                    self._dirty.setdefault(str_key, record)
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            if self.flush_interval > 0:
+                await asyncio.sleep(self.flush_interval)
+            else:
+                await self._wake.wait()
+                self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("FSM flush failed")
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL)
+            cutoff = time.time() - self.state_ttl
+            try:
+                await self.flush()
+                await purge_fsm_records(cutoff)
+            except Exception:
+                logger.exception("FSM purge failed")
+                continue
+            for str_key in [k for k, r in self._cache.items() if r.touched < cutoff and k not in self._dirty]:
+                del self._cache[str_key]
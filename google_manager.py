@@ -1,45 +1,294 @@
-import gspread
-from datetime import datetime
+import asyncio
 import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import aiohttp
+from cachetools import TTLCache
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Клиент Google Sheets поверх aiohttp: один пул keep-alive соединений, никакого блокирующего
+# I/O в event loop. Библиотеки Google (google.auth) грузятся только при первом обращении.
+KEY_FILE = os.getenv("GOOGLE_KEY_FILE", "google_key.json")
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SHEETS_API = "https://sheets.googleapis.com/v4/spreadsheets"
+DEFAULT_TOKEN_URI = "https://oauth2.googleapis.com/token"
+TOKEN_LIFETIME = 3600
+# За сколько секунд до истечения токена начинаем обновлять его в фоне
+TOKEN_REFRESH_MARGIN = 300
+POOL_SIZE = 20
+REQUEST_TIMEOUT = 30
+SPREADSHEET_ID_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)")
+
+
+class SheetsAPIError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+
+
+class ServiceAccountToken:
+    # Access-токен сервисного аккаунта. Ключ читается при первом запросе, а не при импорте;
+    # токен обновляется заранее в фоне, запросы ждут обновления, только если он уже истёк.
+    def __init__(self, key_file=KEY_FILE):
+        self.key_file = key_file
+        self._info = None
+        self._signer = None
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = None
+        self._refresh_task = None
+
+    def info(self):
+        if self._info is None:
+            try:
+                with open(self.key_file) as f:
+                    info = json.load(f)
+                info["client_email"], info["private_key"]
+            except (OSError, ValueError, KeyError) as e:
+                raise RuntimeError(f"Нет ключа Google ({self.key_file}): {e}") from e
+            self._info = info
+        return self._info
+
+    def _assertion(self):
+        # Подпись JWT (RSA) — в отдельном потоке вместе с ленивым импортом google.auth
+        from google.auth import crypt, jwt
+        info = self.info()
+        if self._signer is None:
+            self._signer = crypt.RSASigner.from_service_account_info(info)
+        now = int(time.time())
+        payload = {
+            "iss": info["client_email"],
+            "scope": " ".join(SCOPES),
+            "aud": info.get("token_uri", DEFAULT_TOKEN_URI),
+            "iat": now,
+            "exp": now + TOKEN_LIFETIME,
+        }
+        return jwt.encode(self._signer, payload).decode()
+
+    async def get(self, session, force=False):
+        now = time.time()
+        if not force and self._token and now < self._expires_at:
+            if now > self._expires_at - TOKEN_REFRESH_MARGIN and self._refresh_task is None:
+                self._refresh_task = asyncio.create_task(self._background_refresh(session))
+            return self._token
+        return await self.refresh(session)
+
+    async def _background_refresh(self, session):
+        try:
+            await self.refresh(session)
+        except Exception as e:
+            logger.warning("Google token refresh failed: %s", e)
+        finally:
+            self._refresh_task = None
+
+    async def refresh(self, session):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        expires_at = self._expires_at
+        async with self._lock:
+            if self._expires_at != expires_at and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN:
+                # Пока ждали lock, токен уже обновил кто-то другой
+                return self._token
+            with span("sheets.token"):
+                return await self._refresh(session)
+
+    async def _refresh(self, session):
+        assertion = await asyncio.to_thread(self._assertion)
+        data = {"grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer", "assertion": assertion}
+        async with session.post(self.info().get("token_uri", DEFAULT_TOKEN_URI), data=data) as response:
+            try:
+                body = await response.json(content_type=None)
+            except ValueError:
+                body = {}
+            if response.status != 200:
+                raise SheetsAPIError(response.status, body.get("error_description") or body.get("error"))
+        self._token = body["access_token"]
+        self._expires_at = time.time() + body.get("expires_in", TOKEN_LIFETIME)
+        return self._token
+
+
+class SheetsClient:
+    def __init__(self, token, pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT):
+        self.token = token
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+
+    def session(self):
+        # Сессия создаётся внутри работающего event loop, при первом запросе
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def request(self, method, url, **kwargs):
+        with span(f"sheets.{'append' if url.endswith(':append') else 'metadata'}"):
+            return await self._request(method, url, **kwargs)
+
+    async def _request(self, method, url, **kwargs):
+        session = self.session()
+        for attempt in range(2):
+            token = await self.token.get(session, force=attempt > 0)
+            headers = {"Authorization": f"Bearer {token}"}
+            async with session.request(method, url, headers=headers, **kwargs) as response:
+                if response.status == 401 and attempt == 0:
+                    # Токен отозван раньше срока — берём новый и повторяем один раз
+                    continue
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = {}
+                if response.status >= 400:
+                    error = body.get("error", {}) if isinstance(body, dict) else {}
+                    raise SheetsAPIError(response.status, error.get("message", response.reason))
+                return body
+
+    async def first_sheet_title(self, spreadsheet_id):
+        body = await self.request("GET", f"{SHEETS_API}/{spreadsheet_id}", params={"fields": "sheets.properties(title,index)"})
+        sheets = sorted(body.get("sheets", []), key=lambda sheet: sheet["properties"].get("index", 0))
+        if not sheets:
+            raise SheetsAPIError(404, "Spreadsheet has no sheets")
+        return sheets[0]["properties"]["title"]
+
+    async def append(self, spreadsheet_id, sheet_title, rows):
+        table = quote("'" + sheet_title.replace("'", "''") + "'", safe="")
+        return await self.request(
+            "POST",
+            f"{SHEETS_API}/{spreadsheet_id}/values/{table}:append",
+            params={"valueInputOption": "RAW"},
+            json={"values": rows},
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+client = SheetsClient(ServiceAccountToken())
 
-# Подключение
-try:
-    gc = gspread.service_account(filename='google_key.json')
-    # Загружаем json просто как текст, чтобы достать email
-    with open('google_key.json') as f:
-        creds = json.load(f)
-        BOT_EMAIL = creds.get('client_email', 'Не найден email')
-except Exception as e:
-    print(f"Ошибка с ключом Google: {e}")
-    gc = None
-    BOT_EMAIL = "Ошибка ключа"
 
 # 1. Функция: Получить Email бота (чтобы показать юзеру)
 def get_bot_email():
-    return BOT_EMAIL
+    try:
+        return client.token.info().get('client_email', 'Не найден email')
+    except Exception as e:
+        logger.error("Ошибка с ключом Google: %s", e)
+        return "Ошибка ключа"
+
+# Кэш таблиц: ссылка -> (id таблицы, название первого листа). Без кэша перед каждой
+# записью шёл бы запрос метаданных к Google.
+SHEET_CACHE_SIZE = 1024
+SHEET_CACHE_TTL = 15 * 60
+
+class SheetHandleCache:
+    def __init__(self, maxsize=SHEET_CACHE_SIZE, ttl=SHEET_CACHE_TTL):
+        # TTLCache вытесняет по LRU, когда переполнен, и сам забывает записи старше ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        with self._lock:
+            handles = self._cache.get(url)
+            if handles is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return handles
+
+    def put(self, url, handles):
+        with self._lock:
+            self._cache[url] = handles
+
+    def invalidate(self, url):
+        with self._lock:
+            self._cache.pop(url, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+sheet_cache = SheetHandleCache()
+
+def spreadsheet_id(sheet_url):
+    match = SPREADSHEET_ID_RE.search(sheet_url or "")
+    if not match:
+        raise ValueError("Не похоже на ссылку на Google-таблицу")
+    return match.group(1)
+
+async def get_worksheet(sheet_url, refresh=False):
+    handles = None if refresh else sheet_cache.get(sheet_url)
+    if handles is None:
+        sheet_id = spreadsheet_id(sheet_url)
+        handles = (sheet_id, await client.first_sheet_title(sheet_id))
+        sheet_cache.put(sheet_url, handles)
+    return handles
 
 # 2. Функция: Проверить доступ к таблице
-def check_sheet_access(link):
-    if not gc: return False
+async def check_sheet_access(link):
     try:
-        sh = gc.open_by_url(link)
+        # Всегда честно спрашиваем Google, заодно кладём свежий хэндл в кэш
+        await get_worksheet(link, refresh=True)
         return True
-    except:
+    except Exception as e:
+        logger.info("No access to %s: %s", link, e)
+        sheet_cache.invalidate(link)
         return False
 
-# 3. Функция: Запись
-def write_to_sheet(sheet_url, habit_name, status):
-    if not gc: return "❌ Ошибка: нет ключа"
+# 3. Функция: Строка отчёта (дата, время, привычка, статус)
+def build_row(habit_name, status, when=None):
+    when = when or datetime.now()
+    return [
+        when.strftime("%d.%m.%Y"),
+        when.strftime("%H:%M"),
+        habit_name,
+        status
+    ]
+
+# 4. Функция: Пакетная запись — один запрос на много строк. Ошибки пробрасываются наверх.
+async def append_rows(sheet_url, rows):
+    sheet_id, title = await get_worksheet(sheet_url)
     try:
-        sh = gc.open_by_url(sheet_url)
-        worksheet = sh.sheet1
-        now = datetime.now()
-        worksheet.append_row([
-            now.strftime("%d.%m.%Y"), 
-            now.strftime("%H:%M"), 
-            habit_name, 
-            status
-        ])
-        return "Записано в Google!"
+        await client.append(sheet_id, title, rows)
     except Exception as e:
-        return f"Ошибка записи: {e}"
\ No newline at end of file
+        # Доступ отозвали, таблицу удалили или переименовали лист — хэндл в кэше больше не годится
+        if error_status_code(e) in (400, 403, 404):
+            sheet_cache.invalidate(sheet_url)
+        raise
+
+async def close():
+    await client.close()
+
+# 5. Классификация ошибок: квоты/сбои Google можно повторить, нет доступа/таблицы — нельзя
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def error_status_code(error):
+    if isinstance(error, SheetsAPIError):
+        return error.code
+    return None
+
+def is_retryable_error(error):
+    code = error_status_code(error)
+    if code is None:
+        # Сетевые ошибки и таймауты — пробуем ещё раз; нет ключа или кривая ссылка — нет
+        return not isinstance(error, (ValueError, RuntimeError))
+    return code in RETRYABLE_STATUS_CODES
@@ -2,22 +2,27 @@ import asyncio
 import os
 import logging
 import html
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timezone
 from dotenv import load_dotenv, find_dotenv
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 
 # ИМПОРТЫ
-from database import (
+from async_database import (
     init_db,
     add_habit,
-    get_all_user_habits,
+    get_user_habits_page,
     get_user_habit,
+    get_user_stats_page,
     update_habit_stats,
     delete_habit,
     update_habit_time,
@@ -25,35 +30,112 @@ from database import (
     get_user_sheet,
     set_user_timezone,
     get_user_timezone,
-    get_all_habits_with_users,
+    get_last_user_event,
+    get_due_habits,
+    get_reminder_habits,
+    claim_reminders,
+    mark_partitions_fired,
+    prune_reminder_claims,
+    prune_schedule_changes,
     is_timezone_confirmed,
+    load_user_profiles,
+    mark_users_inactive,
+    close as close_database,
+    profile_cache,
+    stats_buffer,
+)
+from google_manager import get_bot_email, check_sheet_access, sheet_cache, close as close_google
+from sheets_writer import SheetsWriter
+from exporter import EXPORT_FORMATS, HistoryBackfills, export_user_history, backfill_user_sheet
+from sender import MessageSender, OutgoingMessage
+from cluster import PartitionManager
+from reminder_scheduler import ReminderScheduler
+from broadcast import Broadcaster
+from digest import DigestSender, prepare_weekly_digests
+from maintenance import ReactivationMiddleware, run_maintenance
+from user_queue import UPDATE_MAX_PENDING, UserQueueMiddleware
+from fsm_storage import SQLiteStorage
+from webhook import WebhookConfig, run_webhook
+from timezones import fixed_offset_name, is_valid_timezone, offset_from_local_time, utc_offset_label
+from tracing import HandlerSpanMiddleware, TelegramSpanMiddleware, TracingMiddleware, recorder, render
+from metrics import (
+    Gauge,
+    HandlerMetricsMiddleware,
+    REMINDERS,
+    TICK_LAG_SECONDS,
+    TICK_SECONDS,
+    start_metrics_server,
 )
-from google_manager import write_to_sheet, get_bot_email, check_sheet_access
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
+# Медленные апдейты видны в логе и при общем уровне ERROR
+logging.getLogger("tracing").setLevel(logging.WARNING)
 
+# .env необязателен, если переменные уже заданы в окружении (docker, бенчмарки)
 env_file = find_dotenv()
-if not env_file: exit("❌ .env не найден")
-load_dotenv(env_file)
+if env_file:
+    load_dotenv(env_file)
 
 token = os.getenv("BOT_TOKEN")
 if not token:
     exit("❌ Переменная окружения BOT_TOKEN не найдена. Пожалуйста, добавьте её в .env файл.")
-bot = Bot(token=token)
-
-dp = Dispatcher()
+# TELEGRAM_API_URL — свой Bot API сервер (например, локальный из bench/fake_telegram.py)
+api_url = os.getenv("TELEGRAM_API_URL")
+bot = Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else None)
+
+# Состояния диалогов хранятся в SQLite (fsm_state) и переживают перезапуск.
+# При нескольких копиях бота задайте FSM_CACHE_TTL (сек), чтобы перечитывать чужие изменения.
+fsm_cache_ttl = os.getenv("FSM_CACHE_TTL")
+storage = SQLiteStorage(
+    cache_ttl=float(fsm_cache_ttl) if fsm_cache_ttl else None,
+    flush_interval=0 if fsm_cache_ttl else 0.5,
+)
+# FSM-middleware регистрируется вручную за очередью апдейтов (см. UserQueueMiddleware.register)
+dp = Dispatcher(storage=storage, disable_fsm=True)
 scheduler = AsyncIOScheduler()
+sender = MessageSender(bot)
+partitions = PartitionManager()
+running_ticks = set()
+
+# Режим работы: "polling" (по умолчанию) или "webhook" (см. webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+SHUTDOWN_TIMEOUT = 30
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics; METRICS_PORT=0 — выключить
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+# Время каждого обработчика -> bot_handler_seconds{handler=...}
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+# Дерево спанов на каждый апдейт; медленные (TRACE_SLOW_MS) — в лог и в /slow
+dp.update.outer_middleware(TracingMiddleware())
+# Апдейты одного пользователя — по порядку, разных — параллельно (см. user_queue.py)
+update_queue = UserQueueMiddleware()
+update_queue.register(dp)
+# Заблокировал бота, а теперь снова пишет — возвращаем его напоминания
+dp.update.outer_middleware(ReactivationMiddleware())
+dp.message.middleware(HandlerSpanMiddleware())
+dp.callback_query.middleware(HandlerSpanMiddleware())
+bot.session.middleware(TelegramSpanMiddleware())
+# Telegram id администраторов через запятую: им доступна команда /slow
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+SLOW_TRACES_SHOWN = 5
 
 # --- СОСТОЯНИЯ ---
 class HabitForm(StatesGroup): name = State(); frequency = State(); time = State()
 class EditForm(StatesGroup): waiting_for_new_time = State()
 class IntegrationSetup(StatesGroup): waiting_for_link = State()
 class TimezoneSetup(StatesGroup): waiting_for_time = State() # Новое состояние
+class BroadcastSetup(StatesGroup): waiting_for_text = State()
 
 # --- МЕНЮ ---
 NO_REMINDER_LABEL = "Не напоминать 🔕"
 NO_REMINDER_VALUE = "Без напоминаний"
+# Списки листаются страницами: сообщение укладывается в лимит Telegram (4096 символов)
+HABITS_PAGE_SIZE = 10
+STATS_PAGE_SIZE = 5
+BUTTON_TEXT_LIMIT = 64
 
 kb_menu = [
     [KeyboardButton(text="Новая привычка ➕"), KeyboardButton(text="Мои привычки 📋")], 
@@ -75,7 +157,9 @@ def escape_html(text: str) -> str:
 TIMEZONE_PROMPT = (
     "Чтобы напоминания приходили вовремя, мне нужно знать твой часовой пояс.\n\n"
     "⏰ <b>Напиши мне, сколько у тебя сейчас времени?</b>\n"
-    "(Например: 14:30 или 09:15)"
+    "(Например: 14:30 или 09:15)\n\n"
+    "Если знаешь свой пояс, можно прислать его название — тогда я сам учту переход на летнее время "
+    "(например: Europe/Berlin или Asia/Kolkata)."
 )
 
 
@@ -87,13 +171,124 @@ async def start_timezone_setup(message: types.Message, state: FSMContext):
 # --- START ---
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    if not is_timezone_confirmed(message.from_user.id):
+    if not await is_timezone_confirmed(message.from_user.id):
         await message.answer("Привет! Сначала настроим время 🕒.")
         await start_timezone_setup(message, state)
         return
     await state.clear()
     await message.answer("Привет! Давай настроим твои привычки.", reply_markup=main_keyboard)
 
+@dp.message(Command("slow"))
+async def cmd_slow(message: types.Message):
+    # Худшие апдейты с момента запуска, с разбивкой по спанам
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    traces = recorder.worst()[:SLOW_TRACES_SHOWN]
+    if not traces:
+        await message.answer("Пока ничего не записано.")
+        return
+    for trace in traces:
+        when = datetime.fromtimestamp(trace.finished_at).strftime("%d.%m %H:%M:%S")
+        text = f"{when}, user {trace.user_id}\n{render(trace.root, limit=60)}"
+        if trace.profile:
+            text += "\n\n" + trace.profile
+        await message.answer(f"<pre>{escape_html(text[:3900])}</pre>", parse_mode="HTML")
+
+# --- РАССЫЛКА (только ADMIN_IDS) ---
+BROADCAST_STATUS_TEXT = {"running": "идёт", "paused": "на паузе", "done": "завершена", "cancelled": "отменена", "failed": "остановлена из-за ошибки"}
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    if minutes >= 60:
+        return f"{minutes // 60} ч {minutes % 60} мин"
+    return f"{minutes} мин" if minutes else f"{int(seconds)} с"
+
+def broadcast_keyboard(broadcast_id, status):
+    if status == "running":
+        buttons = [InlineKeyboardButton(text="Пауза ⏸", callback_data=f"bcast_pause_{broadcast_id}")]
+    elif status in ("paused", "failed"):
+        buttons = [InlineKeyboardButton(text="Продолжить ▶️", callback_data=f"bcast_resume_{broadcast_id}")]
+    else:
+        return None
+    buttons.append(InlineKeyboardButton(text="Отменить ✖️", callback_data=f"bcast_cancel_{broadcast_id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+def broadcast_text(state, rate=None, eta=None):
+    lines = [
+        f"📣 Рассылка #{state.id}: {BROADCAST_STATUS_TEXT.get(state.status, state.status)}",
+        f"Отправлено: {state.sent} из {state.total}, не доставлено: {state.failed}",
+    ]
+    if state.status == "running" and rate:
+        lines.append(f"Скорость: {rate:.1f} сообщ./с" + (f", осталось ~{format_duration(eta)}" if eta is not None else ""))
+    return "\n".join(lines)
+
+async def report_broadcast_progress(progress):
+    # Вызывается из Broadcaster раз в несколько секунд и в конце рассылки
+    state = progress.state
+    if state.chat_id is None or state.message_id is None:
+        return
+    await bot.edit_message_text(
+        broadcast_text(state, progress.rate, progress.eta), chat_id=state.chat_id, message_id=state.message_id,
+        reply_markup=broadcast_keyboard(state.id, state.status),
+    )
+
+broadcaster = Broadcaster(sender, partitions.worker_id, report=report_broadcast_progress)
+digests = DigestSender(sender, partitions)
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await state.set_state(BroadcastSetup.waiting_for_text)
+    await message.answer("Пришли текст рассылки (форматирование сохранится). /cancel — передумал.")
+
+@dp.message(BroadcastSetup.waiting_for_text)
+async def broadcast_preview(message: types.Message, state: FSMContext):
+    if message.text == "/cancel" or not message.text:
+        await state.clear()
+        await message.answer("Рассылка отменена.", reply_markup=main_keyboard)
+        return
+    await state.update_data(broadcast_text=message.html_text)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Разослать всем ✅", callback_data="bcast_confirm"),
+        InlineKeyboardButton(text="Отмена", callback_data="bcast_abort"),
+    ]])
+    await message.answer(f"Так увидят сообщение пользователи:\n\n{message.html_text}", parse_mode="HTML", reply_markup=kb)
+
+@dp.callback_query(F.data.in_({"bcast_confirm", "bcast_abort"}))
+async def broadcast_confirm(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    text = (await state.get_data()).get("broadcast_text")
+    await state.clear()
+    if callback.data == "bcast_abort" or not text:
+        await callback.message.edit_text("Рассылка отменена.")
+        await callback.answer()
+        return
+    status_message = await callback.message.answer("📣 Запускаю рассылку...")
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await broadcaster.create(text, callback.from_user.id, status_message.chat.id, status_message.message_id)
+    await callback.answer("Рассылка запущена")
+
+@dp.callback_query(F.data.startswith("bcast_"))
+async def broadcast_control(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+    _, action, broadcast_id = callback.data.split("_")
+    if action not in ("pause", "resume", "cancel"):
+        await callback.answer()
+        return
+    broadcast_id = int(broadcast_id)
+    changed = await getattr(broadcaster, action)(broadcast_id)
+    await callback.answer("Готово" if changed else "Рассылка уже завершена")
+    if broadcast_id not in broadcaster.runs:
+        # Здесь рассылка не идёт — обновляем сообщение сами (иначе это сделает её Broadcaster)
+        state = await broadcaster.get(broadcast_id)
+        if state is not None:
+            await callback.message.edit_text(broadcast_text(state), reply_markup=broadcast_keyboard(state.id, state.status))
+
 # ==========================================
 # БЛОК 0: НАСТРОЙКА ВРЕМЕНИ (НОВОЕ)
 # ==========================================
@@ -105,33 +300,30 @@ async def setup_timezone_start(message: types.Message, state: FSMContext):
 @dp.message(TimezoneSetup.waiting_for_time)
 async def setup_timezone_finish(message: types.Message, state: FSMContext):
     try:
-        # 1. Парсим время пользователя
-        user_time_str = message.text.strip()
-        user_h, user_m = map(int, user_time_str.split(":"))
-        
-        # 2. Берем текущее время сервера (UTC)
-        server_now = datetime.utcnow()
-        
-        # 3. Создаем объект времени пользователя "сегодня"
-        user_now = server_now.replace(hour=user_h, minute=user_m)
-        
-        # 4. Считаем разницу
-        # Если пользователь ввел 18:00, а на сервере 13:00 -> разница +5 часов
-        diff = user_now - server_now
-        
-        # Округляем до часов (чтобы убрать минуты погрешности ввода)
-        offset_hours = round(diff.total_seconds() / 3600)
+        user_input = message.text.strip()
+        if is_valid_timezone(user_input) and "/" in user_input:
+            # Имя пояса IANA (Europe/Berlin): смещение и летнее время берём из базы tzdata
+            zone_name = user_input
+        else:
+            # Пользователь написал, сколько у него времени: разница с UTC, округлённая до 15 минут
+            # (есть пояса +5:30, +5:45). Переходы на летнее время так не узнать — смещение фиксированное.
+            user_h, user_m = map(int, user_input.split(":"))
+            if not (0 <= user_h < 24 and 0 <= user_m < 60):
+                raise ValueError(user_input)
+            zone_name = fixed_offset_name(offset_from_local_time(user_h, user_m))
         
         # Сохраняем в базу
-        set_user_timezone(message.from_user.id, offset_hours)
+        await set_user_timezone(message.from_user.id, zone_name)
         
         await state.clear()
         
-        sign = "+" if offset_hours >= 0 else ""
-        await message.answer(f"✅ Понял! Твой часовой пояс: UTC{sign}{offset_hours}.\nТеперь напоминания будут приходить вовремя.", reply_markup=main_keyboard)
+        label = utc_offset_label(zone_name)
+        if "/" in zone_name:
+            label = f"{zone_name} ({label})"
+        await message.answer(f"✅ Понял! Твой часовой пояс: {label}.\nТеперь напоминания будут приходить вовремя.", reply_markup=main_keyboard)
         
     except Exception:
-        await message.answer("❌ Не понимаю формат. Пожалуйста, напиши время как ЧЧ:ММ (например 18:30).")
+        await message.answer("❌ Не понимаю формат. Пожалуйста, напиши время как ЧЧ:ММ (например 18:30) или название пояса (например Europe/Berlin).")
 
 # ==========================================
 # БЛОК 1: УПРАВЛЕНИЕ ПРИВЫЧКАМИ
@@ -160,35 +352,62 @@ async def process_time(message: types.Message, state: FSMContext):
     if final_time != NO_REMINDER_VALUE and ":" not in final_time:
         return await message.answer("❌ Формат ЧЧ:ММ")
     data = await state.get_data()
-    add_habit(message.from_user.id, data['habit_name'], data['habit_freq'], final_time)
+    await add_habit(message.from_user.id, data['habit_name'], data['habit_freq'], final_time)
     await state.clear()
     await message.answer(f"✅ '{data['habit_name']}' сохранена!", reply_markup=main_keyboard)
 
-async def send_habits_menu(chat_id: int, user_id: int):
-    habits = get_all_user_habits(user_id)
+def page_buttons(prefix, rows, has_prev, has_next):
+    # Кнопки листания: id первой/последней привычки на странице — ключ для keyset-запроса
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}_prev_{rows[0][0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"{prefix}_next_{rows[-1][0]}"))
+    return [buttons] if buttons else []
+
+def page_cursor(data):
+    # "habits_next_42" -> (after_id, before_id)
+    _, direction, habit_id = data.split("_", 2)
+    return (int(habit_id), None) if direction == "next" else (None, int(habit_id))
+
+async def render_habits_page(user_id: int, after_id=None, before_id=None):
+    # Одна страница списка: текст и клавиатура не растут с числом привычек
+    habits, has_prev, has_next = await get_user_habits_page(user_id, after_id, before_id, HABITS_PAGE_SIZE)
+    if not habits and (after_id or before_id):
+        habits, has_prev, has_next = await get_user_habits_page(user_id, None, None, HABITS_PAGE_SIZE)
     if not habits:
-        await bot.send_message(chat_id, "Список пуст.", reply_markup=main_keyboard)
-        return
-    text_report = "<b>Твои привычки:</b>\n\n"
+        return None, None
+    lines = ["<b>Твои привычки:</b>\n"]
     keyboard_buttons = []
     for h in habits:
         display_time = h[3] if h[3] != NO_REMINDER_VALUE else NO_REMINDER_LABEL
         safe_name = escape_html(h[1])
         safe_freq = escape_html(h[2])
         safe_time = escape_html(display_time)
-        text_report += f"🔹 <b>{safe_name}</b> ({safe_freq}) — ⏰ {safe_time}\n"
-        keyboard_buttons.append([InlineKeyboardButton(text=f"⚙️ {h[1]}", callback_data=f"open_{h[0]}")])
-    await bot.send_message(chat_id, text_report, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_buttons), parse_mode="HTML")
+        lines.append(f"🔹 <b>{safe_name}</b> ({safe_freq}) — ⏰ {safe_time}")
+        keyboard_buttons.append([InlineKeyboardButton(text=f"⚙️ {h[1]}"[:BUTTON_TEXT_LIMIT], callback_data=f"open_{h[0]}")])
+    keyboard_buttons += page_buttons("habits", habits, has_prev, has_next)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
 
 @dp.message(F.text == "Мои привычки 📋")
 async def show_habits_menu(message: types.Message):
-    await send_habits_menu(message.chat.id, message.from_user.id)
+    text, kb = await render_habits_page(message.from_user.id)
+    if text is None:
+        await message.answer("Список пуст.", reply_markup=main_keyboard)
+        return
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("habits_prev_") | F.data.startswith("habits_next_"))
+async def habits_page(callback: CallbackQuery):
+    text, kb = await render_habits_page(callback.from_user.id, *page_cursor(callback.data))
+    await callback.message.edit_text(text or "Список пуст.", reply_markup=kb, parse_mode="HTML")
+    await callback.answer()
 
 @dp.callback_query(F.data.startswith("open_"))
 async def open_habit_options(callback: CallbackQuery):
     habit_id = int(callback.data.split("_", 1)[1])
-    habit = get_user_habit(habit_id, callback.from_user.id)
+    habit = await get_user_habit(habit_id, callback.from_user.id)
     if not habit:
         await callback.answer("Привычка не найдена.", show_alert=True)
         return
@@ -202,14 +421,14 @@ async def open_habit_options(callback: CallbackQuery):
 
 @dp.callback_query(F.data == "back_to_list")
 async def back_to_list(callback: CallbackQuery):
-    await callback.message.delete()
-    await send_habits_menu(callback.message.chat.id, callback.from_user.id)
+    text, kb = await render_habits_page(callback.from_user.id)
+    await callback.message.edit_text(text or "Список пуст.", reply_markup=kb, parse_mode="HTML")
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("del_"))
 async def delete_habit_handler(callback: CallbackQuery):
     habit_id = int(callback.data.split("_", 1)[1])
-    if delete_habit(habit_id, callback.from_user.id):
+    if await delete_habit(habit_id, callback.from_user.id):
         await callback.message.edit_text("✅ Удалено.")
     else:
         await callback.answer("Привычка не найдена.", show_alert=True)
@@ -219,7 +438,7 @@ async def delete_habit_handler(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("edittime_"))
 async def edit_time_start(callback: CallbackQuery, state: FSMContext):
     habit_id = int(callback.data.split("_", 1)[1])
-    if not get_user_habit(habit_id, callback.from_user.id):
+    if not await get_user_habit(habit_id, callback.from_user.id):
         await callback.answer("Нет доступа к привычке.", show_alert=True)
         return
     await state.update_data(editing_habit_id=habit_id)
@@ -237,7 +456,7 @@ async def edit_time_finish(message: types.Message, state: FSMContext):
     if new_time != NO_REMINDER_VALUE and ":" not in new_time:
         return await message.answer("❌ Формат ЧЧ:ММ")
     data = await state.get_data()
-    updated = update_habit_time(data['editing_habit_id'], message.from_user.id, new_time)
+    updated = await update_habit_time(data['editing_habit_id'], message.from_user.id, new_time)
     await state.clear()
     if updated:
         await message.answer("✅ Время обновлено!", reply_markup=main_keyboard)
@@ -247,37 +466,76 @@ async def edit_time_finish(message: types.Message, state: FSMContext):
 # ==========================================
 # БЛОК 2: СТАТИСТИКА
 # ==========================================
-@dp.message(F.text == "Моя статистика 📊")
-async def show_detailed_stats(message: types.Message):
-    habits = get_all_user_habits(message.from_user.id)
-    if not habits: return await message.answer("Нет данных.")
-    report = "<b>📊 Твоя эффективность:</b>\n\n"
+async def render_stats_page(user_id: int, after_id=None, before_id=None):
+    # Только готовые агрегаты (habit_rollups) и серии — сырая история не читается
+    habits, has_prev, has_next = await get_user_stats_page(user_id, after_id, before_id, STATS_PAGE_SIZE)
+    if not habits and (after_id or before_id):
+        habits, has_prev, has_next = await get_user_stats_page(user_id, None, None, STATS_PAGE_SIZE)
+    if not habits:
+        return None, None
+    parts = ["<b>📊 Твоя эффективность:</b>\n\n"]
     for h in habits:
-        done = h[4]; skip = h[5]; total = done + skip
+        done = h[3]; skip = h[4]; total = done + skip
         percent = int((done/total)*100) if total > 0 else 0
         bars = "🟩" * (percent // 10) + "⬜" * ((100 - percent) // 10)
         safe_name = escape_html(h[1])
-        start_date = escape_html(h[6])
-        report += (
+        start_date = escape_html(h[5])
+        streak, best_streak = h[6], h[7]
+        week_done, week_skip, last_week_done, last_week_skip, month_done, month_skip = h[8:14]
+        parts.append(
             f"🔹 <b>{safe_name}</b>\n"
             f"📅 Старт: {start_date}\n"
             f"✅ Выполнено: {done} | ❌ Пропущено: {skip}\n"
             f"📈 Успех: {percent}%\n"
-            f"{bars}\n\n"
+            f"{bars}\n"
+            f"🔥 Серия: {streak} (рекорд: {best_streak})\n"
+            f"🗓 Неделя: ✅ {week_done} | ❌ {week_skip} (прошлая: ✅ {last_week_done} | ❌ {last_week_skip})\n"
+            f"📆 Месяц: ✅ {month_done} | ❌ {month_skip}\n\n"
         )
-    await message.answer(report, parse_mode="HTML")
+    buttons = page_buttons("stats", habits, has_prev, has_next)
+    return "".join(parts), InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+
+@dp.message(F.text == "Моя статистика 📊")
+async def show_detailed_stats(message: types.Message):
+    text, kb = await render_stats_page(message.from_user.id)
+    if text is None: return await message.answer("Нет данных.")
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("stats_prev_") | F.data.startswith("stats_next_"))
+async def stats_page(callback: CallbackQuery):
+    text, kb = await render_stats_page(callback.from_user.id, *page_cursor(callback.data))
+    await callback.message.edit_text(text or "Нет данных.", reply_markup=kb, parse_mode="HTML")
+    await callback.answer()
 
 # ==========================================
 # БЛОК 3: ИНТЕГРАЦИИ
 # ==========================================
 @dp.message(F.text == "Интеграции ⚙️")
 async def integrations_menu(message: types.Message):
-    current_link = get_user_sheet(message.from_user.id)
+    current_link = await get_user_sheet(message.from_user.id)
     status = "✅ Подключено" if current_link else "❌ Не подключено"
     text = f"<b>Настройки интеграций</b>\nСтатус Google Sheets: {status}\n\nКуда хочешь сохранять отчеты?"
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📄 Google Sheets", callback_data="setup_google")]])
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📄 Google Sheets", callback_data="setup_google")],
+        [InlineKeyboardButton(text="📤 Экспорт CSV", callback_data="export_csv"), InlineKeyboardButton(text="📤 Экспорт JSONL", callback_data="export_jsonl")],
+    ])
     await message.answer(text, reply_markup=kb, parse_mode="HTML")
 
+@dp.callback_query(F.data.startswith("export_"))
+async def export_history(callback: CallbackQuery):
+    # Файл собирается построчно во временный файл и уходит документом — память не зависит от объёма истории
+    fmt = callback.data.split("_", 1)[1]
+    if fmt not in EXPORT_FORMATS:
+        await callback.answer()
+        return
+    await callback.answer("Готовлю файл... 📦")
+    user_id = callback.from_user.id
+    path, count = await export_user_history(user_id, fmt, await get_user_timezone(user_id))
+    try:
+        await bot.send_document(callback.message.chat.id, FSInputFile(path, filename=f"habits.{fmt}"), caption=f"📤 Записей в истории: {count}")
+    finally:
+        os.remove(path)
+
 @dp.callback_query(F.data == "setup_google")
 async def setup_google_step1(callback: CallbackQuery):
     bot_email = get_bot_email()
@@ -298,77 +556,236 @@ async def setup_google_step2(callback: CallbackQuery, state: FSMContext):
 async def setup_google_finish(message: types.Message, state: FSMContext):
     link = message.text.strip()
     msg = await message.answer("Проверяю доступ... 🔄")
-    if check_sheet_access(link):
-        set_user_sheet(message.from_user.id, link)
-        await msg.edit_text("✅ <b>Успешно!</b> Таблица подключена.", parse_mode="HTML")
+    if await check_sheet_access(link):
+        await set_user_sheet(message.from_user.id, link)
+        # Новые отметки пойдут в таблицу сами; всё, что было до этого момента (по последнее
+        # событие включительно), можно перенести разом
+        last_event = await get_last_user_event(message.from_user.id)
+        kb = None
+        if last_event:
+            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬆️ Перенести историю", callback_data=f"backfill_{last_event[0]}_{last_event[1]}")]])
+        await msg.edit_text("✅ <b>Успешно!</b> Таблица подключена.", reply_markup=kb, parse_mode="HTML")
     else:
         await msg.edit_text("❌ <b>Ошибка доступа.</b>", parse_mode="HTML")
         return
     await state.clear()
 
+backfills = HistoryBackfills()
+
+def backfill_cutoff(data):
+    # backfill_<ts>_<id> — последнее событие на момент подключения, включительно
+    _, ts, event_id = data.split("_")
+    return int(ts), int(event_id)
+
+async def run_backfill(message, link, user_id, through):
+    async def progress(total):
+        # Прогресс — необязательная часть: из-за ошибки правки перенос не прерываем
+        try:
+            await message.edit_text(f"⬆️ Переношу историю в таблицу... {total}")
+        except TelegramAPIError:
+            pass
+
+    try:
+        count = await backfill_user_sheet(link, user_id, await get_user_timezone(user_id), through, progress)
+        text = f"✅ Перенесено в таблицу: {count}"
+    except Exception as e:
+        logger.warning("Backfill for %s failed: %s", user_id, e)
+        text = "❌ Не удалось перенести историю в таблицу."
+    # Итог — отдельным сообщением: за минуты переноса пользователь успевает уйти из этого диалога
+    try:
+        await bot.send_message(message.chat.id, text)
+    except TelegramAPIError as e:
+        logger.warning("Backfill result for %s not delivered: %s", user_id, e)
+
+@dp.callback_query(F.data.startswith("backfill_"))
+async def backfill_history(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    link = await get_user_sheet(user_id)
+    if not link:
+        await callback.answer("Таблица не подключена.", show_alert=True)
+        return
+    if backfills.running(user_id):
+        await callback.answer("История уже переносится.", show_alert=True)
+        return
+    # Убираем кнопку сразу, чтобы повторное нажатие не задвоило строки
+    await callback.message.edit_text("⬆️ Переношу историю в таблицу...")
+    await callback.answer()
+    # Перенос — в фоне: очередь апдейтов пользователя не ждёт Sheets API
+    backfills.start(user_id, run_backfill(callback.message, link, user_id, backfill_cutoff(callback.data)))
+
 # --- ОТЧЕТЫ И РАССЫЛКА (УМНАЯ) ---
 @dp.callback_query(F.data.startswith("done_") | F.data.startswith("skip_"))
 async def process_habit_action(callback: CallbackQuery):
     action, habit_id = callback.data.split("_", 1)
     habit_id = int(habit_id)
-    habit = get_user_habit(habit_id, callback.from_user.id)
+    habit = await get_user_habit(habit_id, callback.from_user.id)
     if not habit:
         await callback.answer("Привычка не найдена.", show_alert=True)
         return
     habit_name = habit[2]
     is_done = (action == "done")
-    update_habit_stats(habit_id, callback.from_user.id, is_done)
-    
-    status_text = "ВЫПОЛНЕНО" if is_done else "ПРОПУЩЕНО"
-    sheet_link = get_user_sheet(callback.from_user.id)
-    google_res = write_to_sheet(sheet_link, habit_name, status_text) if sheet_link else ""
+    await update_habit_stats(habit_id, callback.from_user.id, is_done)
     
+    # Отвечаем сразу, запись в Google уходит в фоновую очередь
     icon = "✅ Молодец!" if is_done else "😴 Эх..."
-    new_text = f"{icon} (Сохранено в Google)" if (sheet_link and "Записано" in google_res) else f"{icon}"
-    await callback.message.edit_text(new_text)
+    await callback.message.edit_text(icon)
     await callback.answer()
+    
+    sheet_link = await get_user_sheet(callback.from_user.id)
+    if sheet_link:
+        status_text = "ВЫПОЛНЕНО" if is_done else "ПРОПУЩЕНО"
+        await sheets_writer.enqueue(sheet_link, habit_name, status_text, callback.message.chat.id, callback.message.message_id, icon)
 
-async def check_reminders():
+async def report_sheet_status(chat_id, message_id, text, ok):
+    # Вызывается из SheetsWriter, когда строка записана в таблицу (или от неё пришлось отказаться)
+    new_text = f"{text} (Сохранено в Google)" if ok else f"{text} (⚠️ Не удалось сохранить в Google)"
+    await bot.edit_message_text(new_text, chat_id=chat_id, message_id=message_id)
+
+sheets_writer = SheetsWriter(report=report_sheet_status)
+
+async def check_reminders(now_utc=None, due=None, only_partitions=None):
+    tick_started = time.monotonic()
     # 1. Получаем текущее время сервера в UTC
-    now_utc = datetime.utcnow()
+    started_at = datetime.utcnow()
+    now_utc = now_utc or started_at
     # Округляем до минут (отбрасываем секунды), чтобы четко совпадало с базой
     now_utc = now_utc.replace(second=0, microsecond=0)
+    TICK_LAG_SECONDS.set((started_at - now_utc).total_seconds())
+    tick_key = now_utc.strftime("%Y%m%d%H%M")
+    
+    # 2. due — [(habit_id, fire_key)] из колеса reminder_scheduler на эту минуту; без него берём
+    # из базы по индексу (timezone, remind_minute) без недоступных пользователей: локальное
+    # время считается раз на пояс.
+    # fire_key — локальная минута привычки, при переводе часов назад она повторяется.
+    # Только партиции (user_id % N), которые сейчас арендует эта копия бота
+    # (only_partitions — повтор пропущенной минуты для только что полученных партиций).
+    owned = partitions.owned
+    if only_partitions is not None:
+        owned = owned & only_partitions
+    if not owned:
+        return
+    utc_minute = int(now_utc.replace(tzinfo=timezone.utc).timestamp() // 60)
+    if due is None:
+        due_habits = await get_due_habits(utc_minute, owned, partitions.partition_count) # (id, user_id, name, time_str, fire_key)
+    else:
+        fire_keys = dict(due)
+        due_habits = [(*habit, fire_keys[habit[0]]) for habit in await get_reminder_habits(fire_keys, utc_minute, owned, partitions.partition_count)]
     
-    # 2. Получаем ВСЕ привычки
-    all_habits = get_all_habits_with_users() # Возвращает (id, user_id, name, time_str)
+    # 3. Тики могут пересекаться, а при перебалансировке партицию могут видеть два воркера —
+    # поэтому каждое напоминание сначала "забираем" в reminder_claims. Отправляет тот, кто взял.
+    claimed = set(await claim_reminders([(habit[0], habit[4]) for habit in due_habits], partitions.worker_id))
+    due_habits = [habit for habit in due_habits if (habit[0], habit[4]) in claimed]
+    # Отметка для следующего владельца партиций: до этой минуты всё взято
+    await mark_partitions_fired(owned, utc_minute, partitions.worker_id)
+    # Получатели скоро нажмут "Сделано"/"Пропуск" — заранее подгружаем их профили одним запросом
+    await load_user_profiles({habit[1] for habit in due_habits})
     
-    # 3. Проверяем каждую привычку
-    for habit in all_habits:
-        habit_id, user_id, habit_name, habit_time_str = habit
-        
-        # Пропускаем, если "Не напоминать"
-        if habit_time_str == "Без напоминаний" or ":" not in habit_time_str:
-            continue
-            
-        # Узнаем часовой пояс пользователя (или берем +3 по дефолту)
-        offset = get_user_timezone(user_id)
-        
-        # Вычисляем время у пользователя: UTC сервера + его сдвиг
-        user_local_time = now_utc + timedelta(hours=offset)
-        user_time_str = user_local_time.strftime("%H:%M")
-        
-        # 4. Если время совпало — отправляем!
-        if user_time_str == habit_time_str:
+    def build_messages():
+        for habit_id, user_id, habit_name, habit_time_str, _ in due_habits:
             kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Сделано ✅", callback_data=f"done_{habit_id}"), InlineKeyboardButton(text="Пропуск ❌", callback_data=f"skip_{habit_id}")]])
-            try: 
-                safe_name = escape_html(habit_name)
-                await bot.send_message(user_id, f"🔔 <b>Пора: {safe_name}</b>", reply_markup=kb, parse_mode="HTML")
-                logger.info("Reminder sent to %s for habit %s", user_id, habit_name)
-            except Exception as e: 
-                logger.exception("Failed to send reminder to %s for habit %s", user_id, habit_name)
+            safe_name = escape_html(habit_name)
+            yield OutgoingMessage(user_id, f"🔔 <b>Пора: {safe_name}</b>", kb)
+    
+    # 4. Отправляем параллельно, с учётом лимитов Telegram
+    stats = await sender.send_many(build_messages())
+    tick_duration = time.monotonic() - tick_started
+    TICK_SECONDS.observe(tick_duration)
+    REMINDERS.labels("sent").inc(stats.sent)
+    REMINDERS.labels("failed").inc(stats.failed)
+    REMINDERS.labels("unreachable").inc(len(stats.unreachable))
+    REMINDERS.labels("rate_limited").inc(stats.rate_limited)
+    REMINDERS.labels("retried").inc(stats.retried)
+    log = logger.warning if tick_duration > 60 else logger.info
+    log("Reminder tick %s: %s due, %s, took %.2fs", tick_key, len(due_habits), stats, tick_duration)
+    # 5. Заблокировавшим бота больше не напоминаем, пока сами не напишут
+    if stats.unreachable:
+        await mark_users_inactive(set(stats.unreachable))
+
+async def reminder_tick(fire_at, due, only_partitions=None):
+    # Запоминаем идущие тики, чтобы при остановке дождаться их, а не обрывать рассылку
+    task = asyncio.current_task()
+    running_ticks.add(task)
+    try:
+        await check_reminders(fire_at, due, only_partitions)
+    except Exception:
+        logger.exception("Reminder tick %s failed", fire_at)
+    finally:
+        running_ticks.discard(task)
+
+reminders = ReminderScheduler(fire=reminder_tick)
+# Партиция досталась от другой копии (перебалансировка, падение) — догоняем её пропущенные минуты
+partitions.on_acquire(reminders.replay)
+
+async def cleanup_reminder_claims():
+    # Отметки старше суток уже не нужны для защиты от дублей
+    await prune_reminder_claims(time.time() - 24 * 3600)
+    # Журнал изменений расписания: колёса всех копий давно его прочитали или перезагрузились
+    await prune_schedule_changes(time.time() - 24 * 3600)
+
+async def stop_scheduler():
+    await reminders.stop()
+    scheduler.pause()
+    if running_ticks:
+        await asyncio.wait(set(running_ticks), timeout=SHUTDOWN_TIMEOUT)
+    scheduler.shutdown(wait=False)
+
+def register_runtime_gauges():
+    # Значения считаются в момент запроса /metrics — на горячем пути ничего не стоит
+    Gauge("user_profile_cache_hit_ratio", "User profile cache hit ratio", callback=lambda: profile_cache.stats()["hit_ratio"])
+    Gauge("sheet_handle_cache_hit_ratio", "Spreadsheet handle cache hit ratio", callback=lambda: sheet_cache.stats()["hit_ratio"])
+    Gauge("stats_buffer_pending", "Done/skip taps waiting to be written", callback=lambda: stats_buffer.pending)
+    Gauge("sheets_pending_rows", "Rows waiting in sheet_outbox", callback=lambda: sheets_writer.pending)
+    Gauge("scheduler_owned_partitions", "Reminder partitions leased by this worker", callback=lambda: len(partitions.owned))
+    Gauge("reminder_ticks_running", "Reminder ticks currently in progress", callback=lambda: len(running_ticks))
+    Gauge("reminder_wheel_habits", "Habits loaded into the reminder wheel", callback=lambda: len(reminders.wheel))
+    Gauge("update_queue_pending", "Updates queued or running", callback=lambda: update_queue.pending)
+    Gauge("update_queue_running", "Updates being handled right now", callback=lambda: update_queue.running)
+    Gauge("update_queue_users", "Users with queued or running updates", callback=lambda: update_queue.users)
+    Gauge("update_queue_max_depth", "Longest per-user update queue", callback=lambda: update_queue.max_depth)
 
 async def main():
-    init_db()
-    # Запускаем планировщик
-    scheduler.add_job(check_reminders, 'cron', minute='*')
+    # Настройки webhook проверяем до запуска фоновых задач: без WEBHOOK_SECRET бот не стартует
+    webhook_config = WebhookConfig.from_env() if BOT_MODE == "webhook" else None
+    await init_db()
+    await storage.start()
+    await sheets_writer.start()
+    await partitions.start()
+    metrics_runner = None
+    if METRICS_PORT:
+        register_runtime_gauges()
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    # Напоминания: колесо в памяти, спит до ближайшей минуты с привычками (см. reminder_scheduler.py).
+    # Тики могут пересекаться при больших рассылках — разрешаем это, дубли отсекает reminder_claims
+    await reminders.start()
+    # Рассылки, прерванные перезапуском, продолжаются с последней отметки
+    await broadcaster.start()
+    scheduler.add_job(cleanup_reminder_claims, 'interval', hours=1)
+    # Архив давно недоступных пользователей и возврат свободного места в файле базы
+    scheduler.add_job(run_maintenance, 'interval', hours=6)
+    # Еженедельные сводки: готовятся, когда в поясе наступает понедельник, уходят утром по местному времени
+    scheduler.add_job(prepare_weekly_digests, 'interval', minutes=30)
+    await digests.start()
     scheduler.start()
-    print("🤖 Бот (Версия: Умное время) запущен...")
-    await dp.start_polling(bot)
+    print(f"🤖 Бот (Версия: Умное время) запущен в режиме {BOT_MODE}...")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, webhook_config)
+        else:
+            await bot.delete_webhook()
+            # Больше UPDATE_MAX_PENDING необработанных апдейтов — не забираем новые у Telegram
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_MAX_PENDING)
+    finally:
+        await digests.stop()
+        await broadcaster.stop()
+        await backfills.stop()
+        await stop_scheduler()
+        await partitions.stop()
+        await sheets_writer.stop()
+        await close_google()
+        await close_database()
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     try: asyncio.run(main())
@@ -0,0 +1,64 @@
+import argparse
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+import database
+from async_database import archive_inactive_users, incremental_vacuum, is_user_inactive, reactivate_user
+
+logger = logging.getLogger(__name__)
+
+# Недоступные пользователи: отметку ставит отправка (бот заблокирован, чат не найден),
+# снимает первое же их сообщение. Кто недоступен дольше ARCHIVE_AFTER_DAYS, уезжает в archived_users.
+ARCHIVE_AFTER_DAYS = float(os.getenv("INACTIVE_ARCHIVE_DAYS", 90))
+ARCHIVE_BATCH = 500
+# Страниц (обычно по 4 КБ), возвращаемых ОС за один запуск: держим запись заблокированной недолго
+VACUUM_MAX_PAGES = int(os.getenv("VACUUM_MAX_PAGES", 5000))
+
+
+class ReactivationMiddleware(BaseMiddleware):
+    # Внешний middleware на dp.update. Флаг читается из базы, а не из кэша профилей:
+    # отметить пользователя недоступным или вернуть его могла другая копия бота.
+    # Это одна выборка по первичному ключу на апдейт.
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and await is_user_inactive(user.id):
+            if await reactivate_user(user.id):
+                logger.info("User %s is back, reminders restored", user.id)
+        return await handler(event, data)
+
+
+async def run_maintenance():
+    started = time.monotonic()
+    older_than = time.time() - ARCHIVE_AFTER_DAYS * 86400
+    archived = 0
+    while True:
+        # Пачками: каждая — отдельная короткая транзакция писателя
+        count = await archive_inactive_users(older_than, ARCHIVE_BATCH)
+        archived += count
+        if count < ARCHIVE_BATCH:
+            break
+    freed = await incremental_vacuum(VACUUM_MAX_PAGES)
+    if freed is None:
+        logger.warning("Database is not in auto_vacuum=INCREMENTAL mode, run maintenance.py --enable-incremental-vacuum while the bot is stopped")
+        freed = 0
+    logger.info("Maintenance: %s users archived, %s pages freed, took %.1fs", archived, freed, time.monotonic() - started)
+    return archived, freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline database maintenance (run while the bot is stopped)")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true", help="one-off full VACUUM into auto_vacuum=INCREMENTAL")
+    args = parser.parse_args()
+    if args.enable_incremental_vacuum:
+        started = time.monotonic()
+        changed = database.enable_incremental_vacuum()
+        print(f"Converted in {time.monotonic() - started:.1f}s" if changed else "Already in auto_vacuum=INCREMENTAL mode")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Минимальные метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+# Запись — несколько арифметических операций под незанятым lock'ом, доли микросекунды.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values, **kwargs):
+        key = values or tuple(kwargs[name] for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        # Метрика без меток — единственный "ребёнок" с пустым ключом
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, key, child):
+        yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, callback=None):
+        # callback() -> число или {tuple(labels): число}; вычисляется при каждом запросе /metrics
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception:
+                logger.exception("Gauge callback %s failed", self.name)
+                values = {}
+            if not isinstance(values, dict):
+                values = {(): values}
+            for key, value in values.items():
+                self.labels(*key).set(value)
+        return super().render()
+
+    def _render_child(self, key, child):
+        yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self.observe)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, key, child):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            le = (("le", _format_value(bound) if bound == float("inf") else repr(bound)),)
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(child.sum)}"
+        yield f"{self.name}_count{_format_labels(self.labelnames, key)} {child.count}"
+
+
+class _Timer:
+    __slots__ = ("observe", "started")
+
+    def __init__(self, observe):
+        self.observe = observe
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(time.perf_counter() - self.started)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Метрики бота ---
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Aiogram handler latency", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Aiogram handler exceptions", ["handler"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "database.py function latency", ["query"])
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "database.py function exceptions", ["query"])
+TICK_SECONDS = Histogram("reminder_tick_seconds", "Reminder tick duration", buckets=DEFAULT_BUCKETS + (120.0, 300.0))
+TICK_LAG_SECONDS = Gauge("reminder_tick_lag_seconds", "Delay between the scheduled minute and the tick start")
+REMINDERS = Counter("reminders_total", "Reminder deliveries by result", ["result"])
+SHEETS_WRITE_SECONDS = Histogram("sheets_write_seconds", "Google Sheets append_rows latency")
+SHEETS_ROWS = Counter("sheets_rows_total", "Rows handed to Google Sheets by result", ["result"])
+SHEETS_ERRORS = Counter("sheets_write_errors_total", "Google Sheets write errors", ["kind"])
+BROADCAST_MESSAGES = Counter("broadcast_messages_total", "Broadcast deliveries by result", ["result"])
+WEEKLY_DIGESTS = Counter("weekly_digests_total", "Weekly digests by stage and result", ["result"])
+UPDATE_QUEUE_WAIT_SECONDS = Histogram("update_queue_wait_seconds", "Time an update waits for its user's queue and a worker slot")
+
+
+def timed(histogram, errors, name):
+    # Декоратор для синхронных функций (database.py): время и ошибки с меткой name
+    child, error_child = histogram.labels(name), errors.labels(name)
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            # Генератор: считаем весь проход, а не только создание
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    yield from func(*args, **kwargs)
+                except Exception:
+                    error_child.inc()
+                    raise
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                error_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Вешается на dp.message / dp.callback_query: data["handler"] — выбранный обработчик
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+async def _metrics_view(request):
+    return web.Response(
+        body=REGISTRY.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server(host="127.0.0.1", port=9100):
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,307 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from array import array
+from datetime import datetime
+
+import database
+from timezones import is_valid_timezone, local_now, local_slots
+from async_database import (
+    get_habit_schedules,
+    get_last_schedule_change_id,
+    get_schedule_changes,
+    get_user_habit_ids,
+    get_scheduler_state,
+    set_scheduler_state,
+    on_schedule_change,
+)
+
+logger = logging.getLogger(__name__)
+
+SLOTS = database.MINUTES_PER_DAY
+DAY_BITS = 7
+NO_SLOT = -1
+# Насколько назад догоняем пропущенные минуты после зависания или перезапуска
+GRACE_MINUTES = int(os.getenv("REMINDER_GRACE_MINUTES", 15))
+# Полная перезагрузка колеса из базы — страховка на случай потерянных изменений
+RESYNC_INTERVAL = float(os.getenv("REMINDER_RESYNC_SECONDS", 3600))
+# Как часто читать журнал schedule_changes: изменения, сделанные другими копиями бота
+CHANGES_POLL_INTERVAL = float(os.getenv("REMINDER_CHANGES_POLL_SECONDS", 10))
+CHANGES_BATCH = 1000
+# Даже при пустом колесе просыпаемся хотя бы раз в MAX_SLEEP_MINUTES (переводы часов, resync)
+MAX_SLEEP_MINUTES = 5
+LAST_FIRED_KEY = "reminders_last_fired"
+
+
+class ReminderWheel:
+    # Колесо по поясам: у каждого пояса свои 1440 слотов локальных минут, слот — номер пояса * 1440
+    # + минута. Запись в слоте — одно 64-битное число habit_id << 7 | маска локальных дней недели;
+    # плюс индекс habit_id -> слот (4 байта) и маска (1 байт). Пустые слоты не хранятся.
+    def __init__(self):
+        self._slots = {}
+        self._slot_of = array("i")
+        self._days_of = array("B")
+        self._zones = []
+        self._zone_index = {}
+        # Номер пояса -> отсортированные непустые минуты (для поиска ближайшего слота)
+        self._minutes = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def set(self, habit_id, zone_name, minute, days):
+        self.discard(habit_id)
+        if minute is None or not days:
+            return
+        zone = self._zone_index.get(zone_name)
+        if zone is None:
+            if not is_valid_timezone(zone_name):
+                logger.warning("Habit %s has unknown timezone %r, no reminders", habit_id, zone_name)
+                return
+            zone = self._zone_index[zone_name] = len(self._zones)
+            self._zones.append(zone_name)
+        slot = zone * SLOTS + minute
+        entries = self._slots.get(slot)
+        if entries is None:
+            entries = self._slots[slot] = array("q")
+            bisect.insort(self._minutes.setdefault(zone, []), minute)
+        self._reserve(habit_id)
+        entries.append(habit_id << DAY_BITS | days)
+        self._slot_of[habit_id] = slot
+        self._days_of[habit_id] = days
+        self._size += 1
+
+    def discard(self, habit_id):
+        if habit_id >= len(self._slot_of):
+            return
+        slot = self._slot_of[habit_id]
+        if slot == NO_SLOT:
+            return
+        entries = self._slots[slot]
+        entries.remove(habit_id << DAY_BITS | self._days_of[habit_id])
+        if not entries:
+            del self._slots[slot]
+            zone, minute = divmod(slot, SLOTS)
+            minutes = self._minutes[zone]
+            del minutes[bisect.bisect_left(minutes, minute)]
+            if not minutes:
+                del self._minutes[zone]
+        self._slot_of[habit_id] = NO_SLOT
+        self._size -= 1
+
+    def _reserve(self, habit_id):
+        missing = habit_id + 1 - len(self._slot_of)
+        if missing > 0:
+            # Растём с запасом, чтобы новые привычки не копировали массив каждый раз
+            missing = max(missing, len(self._slot_of) // 4)
+            self._slot_of.extend(array("i", [NO_SLOT]) * missing)
+            self._days_of.extend(bytes(missing))
+
+    def zones(self):
+        # Пояса, в которых есть хоть одно напоминание
+        return [self._zones[zone] for zone in self._minutes]
+
+    def due(self, zone_name, minute, weekday):
+        zone = self._zone_index.get(zone_name)
+        if zone is None:
+            return []
+        bit = 1 << weekday
+        return [entry >> DAY_BITS for entry in self._slots.get(zone * SLOTS + minute, ()) if entry & bit]
+
+    def minutes_until_next(self, utc_minute):
+        # Через сколько минут после utc_minute (unix time // 60) ближайший непустой слот
+        # в каком-нибудь поясе; None — колесо пусто. Смещение пояса берём на текущий момент:
+        # если ночью переведут часы, сон всё равно ограничен MAX_SLEEP_MINUTES.
+        best = None
+        for zone, minutes in self._minutes.items():
+            local = local_now(self._zones[zone], utc_minute * 60)
+            minute = local.hour * 60 + local.minute
+            index = bisect.bisect_right(minutes, minute)
+            step = minutes[index] - minute if index < len(minutes) else minutes[0] + SLOTS - minute
+            if best is None or step < best:
+                best = step
+        return best
+
+
+def load_wheel():
+    # Выполняется в отдельном потоке: проход по всем привычкам не держит event loop
+    wheel = ReminderWheel()
+    try:
+        for habit_id, zone_name, minute, days in database.iter_reminder_schedules():
+            wheel.set(habit_id, zone_name, minute, days)
+    finally:
+        database.close_connection()
+    return wheel
+
+
+def current_minute():
+    return int(time.time() // 60)
+
+
+class ReminderScheduler:
+    # Вместо cron-опроса раз в минуту: спим до ближайшего непустого слота колеса и будим
+    # fire(fire_at, due) для каждой наступившей минуты, due — [(habit_id, fire_key)]. Если цикл проспал (долгий тик,
+    # зависание, перезапуск), догоняем пропущенные минуты не старше grace. Повторы отсекает
+    # reminder_claims, поэтому догонять одну минуту дважды безопасно.
+    def __init__(self, fire, grace=GRACE_MINUTES, resync_interval=RESYNC_INTERVAL, changes_interval=CHANGES_POLL_INTERVAL):
+        self.fire = fire
+        self.grace = grace
+        self.resync_interval = resync_interval
+        self.changes_interval = changes_interval
+        self._changes_after = 0
+        self.wheel = ReminderWheel()
+        self._last_fired = None
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        self._resync_task = None
+        self._changes_task = None
+        self._firing = set()
+        self._replay = None
+
+    async def start(self):
+        await self.reload()
+        on_schedule_change(self._on_schedule_change)
+        now = current_minute()
+        mark = await get_scheduler_state(LAST_FIRED_KEY)
+        self._last_fired = now - 1 if mark is None else max(mark, now - self.grace - 1)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        if self.resync_interval > 0:
+            self._resync_task = asyncio.create_task(self._resync_loop())
+        if self.changes_interval > 0:
+            self._changes_task = asyncio.create_task(self._changes_loop())
+
+    async def stop(self):
+        # Одного cancel() мало: wait_for в 3.11 проглатывает отмену, пришедшую вместе
+        # с _wake.set() (update/reload прямо перед остановкой), — цикл сам проверяет флаг
+        self._stopping = True
+        self._wake.set()
+        for task in (self._task, self._resync_task, self._changes_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._resync_task = self._changes_task = None
+
+    async def reload(self):
+        # Изменения, пришедшие во время загрузки, повторяем поверх нового колеса. Отметку в журнале
+        # берём до загрузки: записанное после неё перечитаем ещё раз, это безопасно.
+        self._replay = []
+        try:
+            changes_after = await get_last_schedule_change_id()
+            wheel = await asyncio.to_thread(load_wheel)
+            for habit_id, zone_name, minute, days in self._replay:
+                wheel.set(habit_id, zone_name, minute, days)
+            self.wheel = wheel
+            self._changes_after = changes_after
+        finally:
+            self._replay = None
+        self._wake.set()
+        logger.info("Reminder wheel loaded: %s habits", len(self.wheel))
+
+    def update(self, habit_id, zone_name, minute, days):
+        self.wheel.set(habit_id, zone_name, minute, days)
+        if self._replay is not None:
+            self._replay.append((habit_id, zone_name, minute, days))
+        self._wake.set()
+
+    async def _on_schedule_change(self, habit_ids, user_id):
+        habit_ids = list(habit_ids)
+        if user_id is not None:
+            habit_ids += await get_user_habit_ids(user_id)
+        schedules = await get_habit_schedules(habit_ids)
+        for habit_id in habit_ids:
+            zone_name, minute, days = schedules.get(habit_id, (None, None, None))
+            self.update(habit_id, zone_name, minute, days)
+
+    async def apply_changes(self):
+        # Изменения расписания из журнала, в том числе сделанные другими копиями бота
+        # (свои тоже — перечитать привычку повторно безопасно)
+        while True:
+            last_id, habit_ids = await get_schedule_changes(self._changes_after, CHANGES_BATCH)
+            if last_id == self._changes_after:
+                return
+            if habit_ids:
+                await self._on_schedule_change(habit_ids, None)
+            self._changes_after = last_id
+
+    async def _run(self):
+        while not self._stopping:
+            now = current_minute()
+            if now > self._last_fired:
+                first = max(self._last_fired + 1, now - self.grace)
+                if first > self._last_fired + 1:
+                    logger.warning("Reminders for %s minutes are older than the grace window, skipped", first - self._last_fired - 1)
+                for minute in range(first, now + 1):
+                    self._fire_minute(minute)
+                self._last_fired = now
+                try:
+                    await set_scheduler_state(LAST_FIRED_KEY, now)
+                except Exception:
+                    logger.exception("Failed to save reminder progress")
+
+            step = self.wheel.minutes_until_next(now) or MAX_SLEEP_MINUTES
+            timeout = (now + min(step, MAX_SLEEP_MINUTES)) * 60 - time.time()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def due_at(self, minute):
+        # Локальное время считаем один раз на пояс, а не на привычку. При переводе часов вперёд
+        # local_slots отдаёт и "перепрыгнутые" минуты, при переводе назад повтор отсечёт fire_key.
+        due = []
+        for zone_name in self.wheel.zones():
+            for local_minute, weekday, fire_key in local_slots(zone_name, minute):
+                due += [(habit_id, fire_key) for habit_id in self.wheel.due(zone_name, local_minute, weekday)]
+        return due
+
+    def _fire_minute(self, minute, partitions=None):
+        due = self.due_at(minute)
+        if not due:
+            return
+        fire_at = datetime.utcfromtimestamp(minute * 60)
+        # Рассылка может идти дольше минуты — не задерживаем следующие слоты
+        task = asyncio.create_task(self.fire(fire_at, due) if partitions is None else self.fire(fire_at, due, partitions))
+        self._firing.add(task)
+        task.add_done_callback(self._firing.discard)
+
+    async def replay(self, marks):
+        # marks — {партиция: fired_through} для партиций, только что доставшихся этой копии
+        # (см. PartitionManager.on_acquire). Минуты после отметки, но не старше grace, прежний
+        # владелец мог не успеть — повторяем их только для этих партиций, fire(fire_at, due, partitions).
+        # Что он всё же успел взять, отсечёт reminder_claims; минуты после _last_fired — обычный цикл.
+        if self._last_fired is None or self._stopping:
+            # Ещё не запущены: start() догонит всё с общей отметки
+            return
+        oldest = current_minute() - self.grace
+        firsts = {partition: oldest if mark is None else max(mark + 1, oldest) for partition, mark in marks.items()}
+        first = min(firsts.values(), default=self._last_fired + 1)
+        if first > self._last_fired:
+            return
+        logger.info("Replaying reminders for partitions %s from minute %s", sorted(marks), first)
+        for minute in range(first, self._last_fired + 1):
+            self._fire_minute(minute, frozenset(p for p, start in firsts.items() if start <= minute))
+
+    async def _changes_loop(self):
+        while not self._stopping:
+            await asyncio.sleep(self.changes_interval)
+            try:
+                await self.apply_changes()
+            except Exception:
+                logger.exception("Reminder schedule changes poll failed")
+
+    async def _resync_loop(self):
+        while not self._stopping:
+            await asyncio.sleep(self.resync_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Reminder wheel reload failed")
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import aiohttp
+
+# Локальная проверка webhook-режима: шлёт апдейты (JSON по одному на строку) на
+# http://localhost:8080/webhook так, как это делает Telegram.
+#   python replay_updates.py updates.jsonl --secret $WEBHOOK_SECRET --concurrency 20
+# Без файла генерирует простые сообщения "/start" от разных пользователей.
+
+
+def sample_updates(count, users):
+    for update_id in range(1, count + 1):
+        user_id = 100000 + update_id % users
+        yield {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+                "text": "/start",
+            },
+        }
+
+
+def read_updates(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def replay(url, updates, secret=None, concurrency=10):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses = Counter()
+    latencies = []
+    iterator = iter(updates)
+
+    async def worker(session):
+        for update in iterator:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    # Одна keep-alive сессия на все запросы, как у Telegram
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"Sent {total} updates in {elapsed:.2f}s ({total / elapsed:.0f}/s)" if elapsed else f"Sent {total} updates")
+    print("Statuses:", dict(statuses))
+    if latencies:
+        print(f"p50={latencies[total // 2] * 1000:.1f}ms p99={latencies[min(total - 1, int(total * 0.99))] * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Telegram updates against a local webhook")
+    parser.add_argument("file", nargs="?", help="JSON Lines file with updates")
+    parser.add_argument("--url", default="http://localhost:8080/webhook")
+    parser.add_argument("--secret")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--count", type=int, default=100, help="generated updates when no file is given")
+    parser.add_argument("--users", type=int, default=10, help="distinct users in generated updates")
+    args = parser.parse_args()
+
+    updates = read_updates(args.file) if args.file else sample_updates(args.count, args.users)
+    asyncio.run(replay(args.url, updates, args.secret, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
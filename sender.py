@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+MAX_CONCURRENCY = 50
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+class OutgoingMessage(NamedTuple):
+    chat_id: int
+    text: str
+    reply_markup: Optional[object] = None
+    parse_mode: Optional[str] = "HTML"
+
+
+class SendStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.retried = 0
+        # Чаты, куда доставить нельзя в принципе (бот заблокирован, чат удалён)
+        self.unreachable = []
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started
+        return self
+
+    def __repr__(self):
+        return (
+            f"SendStats(sent={self.sent}, failed={self.failed}, unreachable={len(self.unreachable)}, "
+            f"rate_limited={self.rate_limited}, retried={self.retried}, duration={self.duration:.2f}s)"
+        )
+
+
+class TokenBucket:
+    # Глобальный лимитер: rate токенов в секунду, не больше capacity про запас.
+    # Ожидающие обслуживаются по очереди (lock), поэтому никто не "голодает".
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds):
+        # После 429 Telegram просит подождать — тормозим всех отправителей разом
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = max(self._updated, self._paused_until)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    # Не чаще одного сообщения в interval секунд в один чат
+    def __init__(self, interval, max_tracked=100_000):
+        self.interval = interval
+        self.max_tracked = max_tracked
+        self._next_slot = OrderedDict()
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self._next_slot.pop(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+        if len(self._next_slot) > self.max_tracked:
+            self._prune(now)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _prune(self, now):
+        # Записи упорядочены по последнему использованию — старые лежат в начале
+        while self._next_slot:
+            chat_id, next_slot = next(iter(self._next_slot.items()))
+            if next_slot > now and len(self._next_slot) <= self.max_tracked:
+                break
+            self._next_slot.popitem(last=False)
+
+
+class MessageSender:
+    def __init__(
+        self,
+        bot: Bot,
+        rate=GLOBAL_RATE,
+        per_chat_interval=PER_CHAT_INTERVAL,
+        concurrency=MAX_CONCURRENCY,
+        max_attempts=MAX_ATTEMPTS,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.per_chat = PerChatLimiter(per_chat_interval)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+    async def send(self, message: OutgoingMessage, stats: Optional[SendStats] = None):
+        stats = stats or SendStats()
+        attempt = 0
+        while True:
+            await self.per_chat.wait(message.chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(
+                    message.chat_id, message.text, reply_markup=message.reply_markup, parse_mode=message.parse_mode
+                )
+                stats.sent += 1
+                return True
+            except TelegramRetryAfter as e:
+                # 429: ждём ровно столько, сколько сказал Telegram; это не считается неудачной попыткой
+                stats.rate_limited += 1
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                # Пользователь заблокировал бота или удалил аккаунт — повторять бессмысленно
+                stats.unreachable.append(message.chat_id)
+                return False
+            except TelegramBadRequest as e:
+                if "chat not found" not in str(e).lower():
+                    stats.failed += 1
+                    logger.exception("Failed to send message to %s", message.chat_id)
+                    return False
+                stats.unreachable.append(message.chat_id)
+                return False
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    stats.failed += 1
+                    logger.error("Giving up on message to %s after %s attempts: %s", message.chat_id, attempt, e)
+                    return False
+                stats.retried += 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+                await asyncio.sleep(delay * (0.5 + random.random() / 2))
+            except Exception:
+                stats.failed += 1
+                logger.exception("Failed to send message to %s", message.chat_id)
+                return False
+
+    async def send_many(self, messages: Iterable[OutgoingMessage]) -> SendStats:
+        # Фиксированное число воркеров тянут сообщения из общего итератора —
+        # память не зависит от размера рассылки
+        stats = SendStats()
+        iterator = iter(messages)
+
+        async def worker():
+            for message in iterator:
+                await self.send(message, stats)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return stats.finish()
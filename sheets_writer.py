@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from async_database import (
+    enqueue_sheet_row,
+    get_pending_sheets,
+    get_pending_sheet_rows,
+    count_pending_sheet_rows,
+    delete_sheet_rows,
+    mark_sheet_rows_attempted,
+)
+from google_manager import append_rows, build_row, is_retryable_error, error_status_code
+from metrics import SHEETS_ERRORS, SHEETS_ROWS, SHEETS_WRITE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Сбрасываем очередь, когда набралось BATCH_SIZE строк или прошло FLUSH_INTERVAL секунд
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 5.0
+MAX_ROWS_PER_REQUEST = 500
+PARALLEL_SHEETS = 4
+# Квота Sheets API на запись — 60 запросов в минуту, оставляем запас
+MAX_REQUESTS_PER_MINUTE = 50
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 600.0
+
+
+class SheetsWriter:
+    # Фоновая запись в Google Sheets: строки сначала попадают в SQLite (sheet_outbox),
+    # потом раз в FLUSH_INTERVAL уходят по таблицам, одним append_rows на MAX_ROWS_PER_REQUEST строк.
+    # Очередь читается отдельно по каждой таблице: отложенная (backoff) таблица с большим хвостом
+    # не занимает выборку остальных. report(chat_id, message_id, message_text, ok) вызывается,
+    # когда судьба строки решена.
+    def __init__(self, report=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.report = report
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Строк в sheet_outbox на последнем сбросе (их могли удалить и другие: архивация, другие копии)
+        self._pending = 0
+        # Добавлено с последнего сброса — чтобы не ждать FLUSH_INTERVAL, когда набралась пачка
+        self._enqueued = 0
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        self._flush_lock = asyncio.Lock()
+        self._requests = deque()
+        self._failures = {}
+        self._backoff_until = {}
+        self._paused_until = 0.0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    async def enqueue(self, sheet_url, habit_name, status, chat_id=None, message_id=None, message_text=None):
+        row = build_row(habit_name, status)
+        await enqueue_sheet_row(sheet_url, row, chat_id, message_id, message_text)
+        self._pending += 1
+        self._enqueued += 1
+        if self._enqueued >= self.batch_size:
+            self._wake.set()
+
+    async def start(self):
+        # Строки, не отправленные до перезапуска, лежат в базе — подхватываем их
+        self._pending = await count_pending_sheet_rows()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            # Флаг — на случай, если wait_for проглотит отмену (см. ReminderScheduler.stop)
+            self._stopping = True
+            self._wake.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Последняя попытка; всё, что не ушло, останется в sheet_outbox до следующего запуска
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Sheets flush failed")
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._enqueued = 0
+            sheets = await get_pending_sheets()
+            self._pending = sum(count for _, count in sheets)
+            now = time.monotonic()
+            # Отложенные таблицы даже не читаем
+            sheet_urls = [url for url, _ in sheets if now >= self._backoff_until.get(url, 0.0)]
+            if not sheet_urls or now < self._paused_until:
+                return
+
+            semaphore = asyncio.Semaphore(PARALLEL_SHEETS)
+
+            async def flush_one(sheet_url):
+                async with semaphore:
+                    while self._may_send(sheet_url):
+                        items = await get_pending_sheet_rows(sheet_url, MAX_ROWS_PER_REQUEST)
+                        if not items:
+                            self._release_request()
+                            return
+                        if not await self._flush_sheet(sheet_url, items) or len(items) < MAX_ROWS_PER_REQUEST:
+                            return
+
+            await asyncio.gather(*(flush_one(url) for url in sheet_urls))
+
+    def _may_send(self, sheet_url):
+        now = time.monotonic()
+        if now < self._paused_until or now < self._backoff_until.get(sheet_url, 0.0):
+            return False
+        while self._requests and now - self._requests[0] > 60:
+            self._requests.popleft()
+        if len(self._requests) >= MAX_REQUESTS_PER_MINUTE:
+            return False
+        self._requests.append(now)
+        return True
+
+    def _release_request(self):
+        # Место в квоте взяли, а отправлять оказалось нечего
+        self._requests.pop()
+
+    async def _flush_sheet(self, sheet_url, items):
+        row_ids = [item[0] for item in items]
+        started = time.perf_counter()
+        try:
+            await append_rows(sheet_url, [item[2] for item in items])
+        except Exception as e:
+            SHEETS_WRITE_SECONDS.observe(time.perf_counter() - started)
+            attempts = max(item[6] for item in items) + 1
+            if is_retryable_error(e) and attempts < MAX_ATTEMPTS:
+                SHEETS_ERRORS.labels("retryable").inc()
+                failures = self._failures[sheet_url] = self._failures.get(sheet_url, 0) + 1
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+                self._backoff_until[sheet_url] = time.monotonic() + delay
+                if error_status_code(e) == 429:
+                    # Квота общая на весь сервисный аккаунт — притормаживаем все таблицы
+                    self._paused_until = time.monotonic() + delay
+                await mark_sheet_rows_attempted(row_ids)
+                logger.warning("Sheets write to %s failed (%s), retry in %.0fs", sheet_url, e, delay)
+                return False
+            SHEETS_ERRORS.labels("permanent").inc()
+            SHEETS_ROWS.labels("dropped").inc(len(items))
+            logger.error("Dropping %s rows for %s: %s", len(row_ids), sheet_url, e)
+            await self._finish(items, ok=False)
+            return False
+        SHEETS_WRITE_SECONDS.observe(time.perf_counter() - started)
+        SHEETS_ROWS.labels("written").inc(len(items))
+        self._failures.pop(sheet_url, None)
+        self._backoff_until.pop(sheet_url, None)
+        await self._finish(items, ok=True)
+        return True
+
+    async def _finish(self, items, ok):
+        await delete_sheet_rows([item[0] for item in items])
+        self._pending = max(self._pending - len(items), 0)
+        if not self.report:
+            return
+        for _, _, _, chat_id, message_id, message_text, _ in items:
+            if chat_id is None or message_id is None:
+                continue
+            try:
+                await self.report(chat_id, message_id, message_text, ok)
+            except Exception:
+                logger.exception("Failed to report Sheets status to %s", chat_id)
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import async_database
+import database
+from user_cache import UserProfileCache
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # Отдельный файл базы на тест; соединение потока закрываем, чтобы следующий тест открыл своё
+    path = tmp_path / "habits.db"
+    monkeypatch.setattr(database, "DB_NAME", str(path))
+    database.close_connection()
+    yield path
+    database.close_connection()
+
+
+@pytest.fixture
+def adb(db, monkeypatch):
+    # async_database со своими потоками на тест: соединения потоков не переживают смену файла базы
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="test-db-read")
+    writer = async_database.BatchWriter()
+    monkeypatch.setattr(async_database, "_read_executor", executor)
+    monkeypatch.setattr(async_database, "_writer", writer)
+    monkeypatch.setattr(async_database, "stats_buffer", async_database.StatsBuffer())
+    monkeypatch.setattr(async_database, "profile_cache", UserProfileCache())
+    monkeypatch.setattr(async_database, "_schedule_listeners", [])
+    database.init_db()
+    yield async_database
+    writer.close()
+    executor.shutdown(wait=True)
@@ -0,0 +1,195 @@
+import asyncio
+
+import pytest
+
+import broadcast
+import database
+from broadcast import Broadcaster
+
+
+class FakeSender:
+    def __init__(self):
+        self.delivered = []
+
+    async def send(self, message, stats=None):
+        await asyncio.sleep(0)
+        self.delivered.append(message.chat_id)
+        stats.sent += 1
+        return True
+
+
+@pytest.fixture
+def fast_broadcasts(monkeypatch):
+    monkeypatch.setattr(broadcast, "CHECKPOINT_INTERVAL", 0.02)
+    monkeypatch.setattr(broadcast, "PAGE_RETRY_DELAY", 0)
+    monkeypatch.setattr(broadcast, "PAGE_SIZE", 2)
+
+
+def _users(*user_ids):
+    for user_id in user_ids:
+        database.set_user_timezone(user_id, "Europe/Berlin")
+
+
+async def _wait_runs(broadcaster):
+    while broadcaster.runs:
+        await asyncio.gather(*(run.task for run in list(broadcaster.runs.values())), return_exceptions=True)
+
+
+def test_recipient_read_is_retried(adb, fast_broadcasts, monkeypatch):
+    _users(1, 2, 3)
+    read = adb.get_user_ids_page
+    failures = iter([True, True])
+
+    async def flaky(after, limit):
+        if next(failures, False):
+            raise database.sqlite3.OperationalError("database is locked")
+        return await read(after, limit)
+
+    monkeypatch.setattr(broadcast, "get_user_ids_page", flaky)
+    sender = FakeSender()
+
+    async def scenario():
+        broadcaster = Broadcaster(sender, "worker-1")
+        broadcast_id = await broadcaster.create("Привет", 1, None, None)
+        await _wait_runs(broadcaster)
+        return await broadcaster.get(broadcast_id)
+
+    state = asyncio.run(scenario())
+
+    assert state.status == "done" and state.sent == 3
+    assert sorted(sender.delivered) == [1, 2, 3]
+
+
+def test_recipient_read_failure_stops_run_as_failed(adb, fast_broadcasts, monkeypatch):
+    _users(1, 2, 3)
+    read = adb.get_user_ids_page
+    broken = True
+
+    async def locked(after, limit):
+        if broken and after >= 2:
+            raise database.sqlite3.OperationalError("database is locked")
+        return await read(after, limit)
+
+    monkeypatch.setattr(broadcast, "get_user_ids_page", locked)
+    sender = FakeSender()
+
+    async def scenario():
+        nonlocal broken
+        broadcaster = Broadcaster(sender, "worker-1")
+        broadcast_id = await asyncio.wait_for(broadcaster.create("Привет", 1, None, None), 1)
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        failed = await broadcaster.get(broadcast_id)
+        # Админ нажал "Продолжить": рассылка идёт с отметки, без повторов
+        broken = False
+        assert await broadcaster.resume(broadcast_id)
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        return failed, await broadcaster.get(broadcast_id)
+
+    failed, finished = asyncio.run(scenario())
+
+    assert failed.status == "failed" and failed.last_user_id == 2 and failed.sent == 2
+    assert finished.status == "done" and finished.sent == 3
+    assert sender.delivered == [1, 2, 3]
+
+
+class PausingSender(FakeSender):
+    # На заданном получателе админ жмёт кнопку (pause/cancel) прямо посреди рассылки
+    def __init__(self, at, action):
+        super().__init__()
+        self.at = at
+        self.action = action
+
+    async def send(self, message, stats=None):
+        ok = await super().send(message, stats)
+        if message.chat_id == self.at:
+            await self.action()
+        return ok
+
+
+def test_lease_keeps_broadcast_with_one_owner(db):
+    database.init_db()
+    broadcast_id = database.create_broadcast("Привет", 1, None, None, now=100)
+
+    assert [row[0] for row in database.claim_broadcasts("worker-1", 60, now=100)] == [broadcast_id]
+    # Живая аренда: вторая копия рассылку не берёт, владелец продлевает свою
+    assert database.claim_broadcasts("worker-2", 60, now=150) == []
+    assert database.checkpoint_broadcast(broadcast_id, "worker-1", 5, 5, 0, 60, now=150) == "running"
+    assert database.claim_broadcasts("worker-2", 60, now=200) == []
+    # Владелец пропал — после истечения аренды рассылку забирает другая копия, с его отметкой
+    claimed = database.claim_broadcasts("worker-2", 60, now=211)
+    assert [(row[0], row[7], row[8]) for row in claimed] == [(broadcast_id, 5, 5)]
+    # Отметки старого владельца больше не принимаются
+    assert database.checkpoint_broadcast(broadcast_id, "worker-1", 9, 9, 0, 60, now=212) is None
+    assert database.get_broadcast(broadcast_id)[7] == 5
+
+
+def test_checkpoint_reports_status_changed_elsewhere(db):
+    database.init_db()
+    broadcast_id = database.create_broadcast("Привет", 1, None, None, now=100)
+    database.claim_broadcasts("worker-1", 60, now=100)
+
+    assert database.set_broadcast_status(broadcast_id, "paused", now=110)
+    assert database.checkpoint_broadcast(broadcast_id, "worker-1", 3, 3, 0, 60, now=120) == "paused"
+    assert database.claim_broadcasts("worker-2", 60, now=1000) == []
+
+
+def test_orphaned_broadcast_resumes_from_checkpoint(adb, fast_broadcasts):
+    _users(1, 2, 3, 4, 5)
+    # Первая копия разослала троим, отметилась и упала; аренда истекла
+    broadcast_id = database.create_broadcast("Привет", 1, None, None)
+    database.claim_broadcasts("worker-1", broadcast.LEASE_TTL, now=0)
+    database.checkpoint_broadcast(broadcast_id, "worker-1", 3, 3, 0, broadcast.LEASE_TTL, now=0)
+    sender = FakeSender()
+
+    async def scenario():
+        broadcaster = Broadcaster(sender, "worker-2")
+        await broadcaster.resume_orphans()
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        return await broadcaster.get(broadcast_id)
+
+    state = asyncio.run(scenario())
+
+    assert sender.delivered == [4, 5]
+    assert state.status == "done" and state.sent == 5 and state.last_user_id == 5
+
+
+def test_pause_stops_run_and_resume_continues_without_repeats(adb, fast_broadcasts):
+    _users(*range(1, 11))
+
+    async def scenario():
+        broadcaster = Broadcaster(None, "worker-1")
+        broadcaster.sender = sender = PausingSender(3, lambda: broadcaster.pause(broadcast_id))
+        broadcast_id = await broadcaster.create("Привет", 1, None, None)
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        paused = await broadcaster.get(broadcast_id)
+        delivered = list(sender.delivered)
+        sender.at = None
+        assert await broadcaster.resume(broadcast_id)
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        return paused, delivered, sender.delivered, await broadcaster.get(broadcast_id)
+
+    paused, before, delivered, finished = asyncio.run(scenario())
+
+    assert paused.status == "paused" and paused.last_user_id < 10
+    assert sorted(before) == list(range(1, paused.last_user_id + 1))
+    assert sorted(delivered) == list(range(1, 11))
+    assert finished.status == "done" and finished.sent == 10
+
+
+def test_cancel_stops_run_for_good(adb, fast_broadcasts):
+    _users(*range(1, 11))
+
+    async def scenario():
+        broadcaster = Broadcaster(None, "worker-1")
+        broadcaster.sender = sender = PausingSender(3, lambda: broadcaster.cancel(broadcast_id))
+        broadcast_id = await broadcaster.create("Привет", 1, None, None)
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        delivered = len(sender.delivered)
+        resumed = await broadcaster.resume(broadcast_id)
+        await asyncio.wait_for(_wait_runs(broadcaster), 2)
+        return resumed, delivered, sender.delivered, await broadcaster.get(broadcast_id)
+
+    resumed, count, delivered, state = asyncio.run(scenario())
+
+    assert not resumed and len(delivered) == count < 10
+    assert state.status == "cancelled"
@@ -0,0 +1,107 @@
+import asyncio
+
+import database
+import reminder_scheduler
+from cluster import PartitionManager
+from reminder_scheduler import ReminderScheduler
+
+PARTITIONS = 4
+TTL = 30
+
+
+def _heartbeat(worker_id, now):
+    return database.heartbeat_worker(worker_id, PARTITIONS, TTL, now=now)
+
+
+def test_partitions_are_split_when_a_worker_joins(db):
+    database.init_db()
+    assert _heartbeat("a", 100)[0] == [0, 1, 2, 3]
+    # Второй воркер живой, но свободных партиций пока нет
+    assert _heartbeat("b", 101)[0] == []
+    # a отдаёт лишнее на своём heartbeat, b забирает на своём
+    assert _heartbeat("a", 110)[0] == [0, 1]
+    assert _heartbeat("b", 111)[0] == [2, 3]
+    assert _heartbeat("a", 120)[0] == [0, 1]
+
+
+def test_partitions_of_a_dead_worker_move_after_the_lease(db):
+    database.init_db()
+    _heartbeat("a", 100)
+    _heartbeat("b", 101)
+    _heartbeat("a", 110)
+    _heartbeat("b", 111)
+    # a перестал отвечать: пока аренда не истекла, его партиции никто не берёт
+    assert _heartbeat("b", 121)[0] == [2, 3]
+    assert _heartbeat("b", 150)[0] == [0, 1, 2, 3]
+
+
+def test_heartbeat_returns_fired_marks_of_owned_partitions(db):
+    database.init_db()
+    _heartbeat("a", 100)
+    database.mark_partitions_fired([0, 1, 2], 500, "a")
+    database.mark_partitions_fired([1], 490, "a")
+    # Отметки чужих партиций не двигаются
+    database.mark_partitions_fired([0, 3], 600, "b")
+    database.release_worker("a")
+
+    owned, _, marks = _heartbeat("b", 110)
+
+    assert owned == [0, 1, 2, 3]
+    assert marks == {0: 500, 1: 500, 2: 500, 3: None}
+
+
+def test_reminder_claims_are_taken_once(db):
+    database.init_db()
+    keys = [(1, "202601010800"), (2, "202601010800")]
+    assert database.claim_reminders(keys, "a") == keys
+    assert database.claim_reminders(keys + [(1, "202601010801")], "b") == [(1, "202601010801")]
+
+
+def test_partition_manager_reports_only_newly_acquired_partitions(adb):
+    acquired = []
+
+    async def listener(marks):
+        acquired.append(marks)
+
+    async def scenario():
+        await adb.mark_partitions_fired([0], 123, "nobody")
+        manager = PartitionManager("a", partition_count=2, lease_ttl=TTL)
+        manager.on_acquire(listener)
+        await manager.heartbeat()
+        await adb.mark_partitions_fired([0, 1], 777, "a")
+        await manager.heartbeat()
+        # Аренда истекла локально (heartbeat не проходил) — вернувшиеся партиции снова "новые"
+        manager._expires_at = 0
+        await manager.heartbeat()
+
+    asyncio.run(scenario())
+
+    assert acquired == [{0: None, 1: None}, {0: 777, 1: 777}]
+
+
+def test_replay_fires_missed_minutes_only_for_acquired_partitions(monkeypatch):
+    now = 29_000_000
+    monkeypatch.setattr(reminder_scheduler, "current_minute", lambda: now)
+    fired = []
+
+    async def fire(fire_at, due, partitions=None):
+        fired.append((int(fire_at.timestamp() // 60), sorted(due), partitions))
+
+    async def scenario():
+        scheduler = ReminderScheduler(fire, grace=10, resync_interval=0)
+        for offset in range(-20, 1):
+            minute = (now + offset) % database.MINUTES_PER_DAY
+            scheduler.wheel.set(1000 + offset, "UTC", minute, database.ALL_DAYS_MASK)
+        scheduler._last_fired = now
+        await scheduler.replay({1: now - 3, 2: now - 1, 3: None})
+        await asyncio.gather(*scheduler._firing)
+
+    asyncio.run(scenario())
+
+    by_minute = {minute: (due, partitions) for minute, due, partitions in fired}
+    # Без отметки — всё окно grace; с отметкой — минуты после неё
+    assert sorted(by_minute) == list(range(now - 10, now + 1))
+    assert by_minute[now - 5][1] == frozenset({3})
+    assert by_minute[now - 2][1] == frozenset({1, 3})
+    assert by_minute[now][1] == frozenset({1, 2, 3})
+    assert [habit_id for habit_id, _ in by_minute[now][0]] == [1000]
@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import database
+import digest
+from timezones import DEFAULT_TIMEZONE, local_to_timestamp
+
+MONDAY = datetime(2026, 10, 19, 1, 0)
+LAST_WEEK = "2026-W42"
+
+
+@pytest.fixture
+def monday(monkeypatch):
+    monkeypatch.setattr(digest, "local_now", lambda zone_name, ts=None: MONDAY)
+
+
+def _seed_user(user_id, zone_name, done=1, skip=0):
+    if zone_name is None:
+        database.set_user_sheet(user_id, None)
+    else:
+        database.set_user_timezone(user_id, zone_name)
+    habit_id = database.add_habit(user_id, "Зарядка", "Каждый день", "08:00")
+    ts = int(local_to_timestamp(zone_name, datetime(2026, 10, 14, 12, 0)))
+    events = [(ts, True)] * done + [(ts, False)] * skip
+    if events:
+        database.apply_habit_stats([(habit_id, user_id, events)])
+
+
+def _digests():
+    with database.get_connection() as conn:
+        return {row[0]: row[1:] for row in conn.execute("SELECT user_id, week, send_at, text FROM weekly_digests")}
+
+
+def test_prepare_covers_every_zone_including_users_without_one(adb, monday):
+    _seed_user(1, "Europe/Berlin", done=2, skip=1)
+    _seed_user(2, None, done=1)
+    _seed_user(3, "Asia/Kolkata", done=0)
+
+    asyncio.run(digest.prepare_weekly_digests())
+
+    digests = _digests()
+    assert set(digests) == {1, 2}
+    week, send_at, text = digests[2]
+    assert week == LAST_WEEK
+    window_start = local_to_timestamp(DEFAULT_TIMEZONE, datetime(2026, 10, 19, digest.WINDOW_START_HOUR))
+    assert window_start <= send_at < window_start + digest.WINDOW_MINUTES * 60
+    assert "Выполнено 2 из 3" in digests[1][2]
+
+
+def test_prepare_is_idempotent(adb, monday):
+    _seed_user(1, None)
+    asyncio.run(digest.prepare_weekly_digests())
+    first = _digests()
+    database.apply_habit_stats([(1, 1, [(int(MONDAY.timestamp()) - 5 * 86400, True)])])
+
+    asyncio.run(digest.prepare_weekly_digests())
+
+    assert _digests() == first
+
+
+def test_inactive_users_get_no_digest(adb, monday):
+    _seed_user(1, None)
+    _seed_user(2, "Europe/Berlin")
+    database.mark_users_inactive([1, 2])
+
+    asyncio.run(digest.prepare_weekly_digests())
+
+    assert _digests() == {}
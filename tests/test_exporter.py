@@ -0,0 +1,65 @@
+import asyncio
+import os
+
+import database
+import exporter
+
+
+def test_backfill_splits_history_inside_one_second(adb, monkeypatch):
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "08:00")
+    database.update_habit_stats(habit_id, 1, True, ts=1_000_000)
+    database.update_habit_stats(habit_id, 1, True, ts=1_000_100)
+    # Таблицу подключили в ту же секунду, что и последнее нажатие
+    cutoff = database.get_last_user_event(1)
+    # Следующее нажатие в ту же секунду уже уходит в таблицу через SheetsWriter
+    database.update_habit_stats(habit_id, 1, False, ts=1_000_100)
+
+    sent, progress = [], []
+
+    async def append_rows(sheet_url, rows):
+        sent.extend(rows)
+
+    async def report(total):
+        progress.append(total)
+
+    monkeypatch.setattr(exporter, "append_rows", append_rows)
+    count = asyncio.run(exporter.backfill_user_sheet("sheet", 1, "Europe/Berlin", cutoff, report))
+
+    assert count == 2 and progress == [2]
+    assert [row[-1] for row in sent] == [exporter.STATUS_TEXT[1]] * 2
+    assert len(list(exporter.iter_user_events(1))) == 3
+
+
+def test_one_backfill_per_user_and_stop_cancels():
+    async def scenario():
+        backfills = exporter.HistoryBackfills()
+        release = asyncio.Event()
+        backfills.start(1, release.wait())
+        assert backfills.running(1) and not backfills.running(2)
+        await backfills.stop()
+        await asyncio.sleep(0)
+        return backfills.running(1)
+
+    assert not asyncio.run(scenario())
+
+
+def test_export_counts_only_history_events(adb):
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "08:00")
+    database.add_habit(1, "Чтение", "Каждый день", "21:00")
+    database.update_habit_stats(habit_id, 1, True, ts=1_000_000)
+
+    async def scenario():
+        counts = {}
+        for fmt in exporter.EXPORT_FORMATS:
+            path, counts[fmt] = await exporter.export_user_history(1, fmt, "Europe/Berlin")
+            with open(path, encoding="utf-8") as f:
+                counts[fmt, "lines"] = len(f.read().splitlines())
+            os.remove(path)
+        return counts
+
+    counts = asyncio.run(scenario())
+
+    assert counts["csv"] == counts["jsonl"] == 1
+    assert counts["csv", "lines"] == 2 and counts["jsonl", "lines"] == 3
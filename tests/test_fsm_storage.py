@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import database
+from fsm_storage import SQLiteStorage
+
+
+class Form(StatesGroup):
+    name = State()
+
+
+KEY = StorageKey(bot_id=1, chat_id=7, user_id=7)
+OTHER = StorageKey(bot_id=1, chat_id=8, user_id=8)
+
+
+def test_state_and_data_round_trip(adb):
+    async def scenario():
+        storage = SQLiteStorage()
+        await storage.set_state(KEY, Form.name)
+        await storage.set_data(KEY, {"name": "Зарядка"})
+        data = await storage.get_data(KEY)
+        # Наружу отдаём копию: правка результата не трогает хранилище
+        data["name"] = "испорчено"
+        return await storage.get_state(KEY), await storage.get_data(KEY), await storage.get_state(OTHER)
+
+    assert asyncio.run(scenario()) == ("Form:name", {"name": "Зарядка"}, None)
+
+
+def test_set_data_rejects_non_dict(adb):
+    async def scenario():
+        await SQLiteStorage().set_data(KEY, [("name", "Зарядка")])
+
+    with pytest.raises(DataNotDictLikeError):
+        asyncio.run(scenario())
+
+
+def test_changes_survive_restart_after_close(adb):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=60)
+        await storage.start()
+        await storage.set_state(KEY, "Form:name")
+        await storage.set_data(KEY, {"time": "08:00"})
+        # До сброса в базе пусто: изменения копятся в памяти
+        assert database.load_fsm_record("fsm:1:7:7:default") is None
+        await storage.close()
+
+        restarted = SQLiteStorage()
+        return await restarted.get_state(KEY), await restarted.get_data(KEY)
+
+    assert asyncio.run(scenario()) == ("Form:name", {"time": "08:00"})
+
+
+def test_cleared_record_is_deleted(adb):
+    async def scenario():
+        storage = SQLiteStorage()
+        await storage.set_state(KEY, "Form:name")
+        await storage.set_data(KEY, {"time": "08:00"})
+        await storage.flush()
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        await storage.flush()
+
+    asyncio.run(scenario())
+
+    assert database.load_fsm_record("fsm:1:7:7:default") is None
+
+
+def test_cache_ttl_picks_up_changes_from_another_worker(adb):
+    async def scenario():
+        first = SQLiteStorage(cache_ttl=0)
+        second = SQLiteStorage(cache_ttl=0)
+        assert await first.get_state(KEY) is None
+        await second.set_state(KEY, "Form:name")
+        await second.flush()
+        return await first.get_state(KEY)
+
+    assert asyncio.run(scenario()) == "Form:name"
+
+
+def test_without_cache_ttl_memory_wins(adb):
+    async def scenario():
+        first = SQLiteStorage()
+        second = SQLiteStorage()
+        assert await first.get_state(KEY) is None
+        await second.set_state(KEY, "Form:name")
+        await second.flush()
+        return await first.get_state(KEY)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_abandoned_dialog_expires(adb):
+    database.save_fsm_records([("fsm:1:7:7:default", 7, "Form:name", '{"time":"08:00"}', 1_000.0)])
+
+    async def scenario():
+        storage = SQLiteStorage(state_ttl=60)
+        state, data = await storage.get_state(KEY), await storage.get_data(KEY)
+        await storage.flush()
+        return state, data
+
+    assert asyncio.run(scenario()) == (None, {})
+    assert database.load_fsm_record("fsm:1:7:7:default") is None
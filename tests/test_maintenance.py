@@ -0,0 +1,160 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+from aiogram.fsm.storage.base import StorageKey
+
+import database
+from fsm_storage import SQLiteStorage
+from maintenance import ReactivationMiddleware
+
+
+async def _handler(event, data):
+    return "handled"
+
+
+def _update_from(user_id):
+    return {"event_from_user": SimpleNamespace(id=user_id)}
+
+
+def test_reactivation_sees_marks_made_by_another_worker(adb):
+    database.set_user_timezone(1, "Europe/Berlin")
+    database.add_habit(1, "Зарядка", "Каждый день", "08:00")
+
+    async def scenario():
+        # Профиль в кэше этой копии — "активен"; отметку ставит другая копия напрямую в базе
+        assert not (await adb.get_user_profile(1)).inactive
+        database.mark_users_inactive([1])
+        result = await ReactivationMiddleware()(_handler, None, _update_from(1))
+        return result, await adb.get_user_profile(1)
+
+    result, profile = asyncio.run(scenario())
+
+    assert result == "handled"
+    assert not profile.inactive
+    assert not database.is_user_inactive(1)
+
+
+def test_stale_inactive_profile_is_dropped_from_cache(adb):
+    database.set_user_timezone(1, "Europe/Berlin")
+    database.mark_users_inactive([1])
+
+    async def scenario():
+        assert (await adb.get_user_profile(1)).inactive
+        # Вернула другая копия
+        database.reactivate_user(1)
+        await ReactivationMiddleware()(_handler, None, _update_from(1))
+        return await adb.get_user_profile(1)
+
+    assert not asyncio.run(scenario()).inactive
+
+
+def test_unknown_user_is_not_inactive(adb):
+    assert asyncio.run(ReactivationMiddleware()(_handler, None, _update_from(42))) == "handled"
+    assert not database.is_user_inactive(42)
+
+
+def _fill_and_delete(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS filler (data BLOB)")
+    conn.executemany("INSERT INTO filler VALUES (?)", [(b"x" * 4000,) for _ in range(200)])
+    conn.commit()
+    conn.execute("DELETE FROM filler")
+    conn.commit()
+    conn.close()
+
+
+def test_new_database_frees_pages_without_full_vacuum(db):
+    database.init_db()
+    database.close_connection()
+    _fill_and_delete(db)
+
+    assert database.incremental_vacuum(50) == 50
+    assert database.incremental_vacuum(10_000) > 0
+    assert database.incremental_vacuum(10_000) == 0
+
+
+def test_old_database_is_left_alone_until_converted_offline(db):
+    # База, созданная до auto_vacuum=INCREMENTAL: таблицы уже есть
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE legacy (x)")
+    conn.close()
+    database.init_db()
+    database.close_connection()
+    _fill_and_delete(db)
+    size = db.stat().st_size
+
+    assert database.incremental_vacuum(10_000) is None
+    assert db.stat().st_size == size
+
+    assert database.enable_incremental_vacuum()
+    assert not database.enable_incremental_vacuum()
+    assert database.incremental_vacuum(10_000) == 0
+
+
+def _rows(table, where, params):
+    with database.get_connection() as conn:
+        return sorted(conn.execute(f"SELECT * FROM {table} WHERE {where}", params).fetchall(), key=repr)
+
+
+def _seed_archivable(user_id):
+    database.set_user_timezone(user_id, "Europe/Berlin")
+    habit_id = database.add_habit(user_id, "Зарядка", "Каждый день", "08:00")
+    database.apply_habit_stats([(habit_id, user_id, [(1_700_000_000, True), (1_700_090_000, False)])])
+    database.save_weekly_digests([(user_id, "2026-W42", 1_800_000_000.0, "итоги")])
+    database.save_fsm_records([(f"fsm:1:{user_id}:{user_id}:default", user_id, "HabitForm:name", None, 1_700_000_000.0)])
+    database.enqueue_sheet_row("https://example.com/sheet", ["01.01.2024"], user_id, 10, "✅")
+    database.claim_reminders([(habit_id, "202601010800")], "a")
+    return habit_id
+
+
+def test_archive_moves_user_rows_and_restore_brings_them_back(db):
+    database.init_db()
+    habit_id = _seed_archivable(1)
+    other_habit = _seed_archivable(2)
+    kept = {table: _rows(table, "user_id = ?", (1,)) for table in ("users", "habits", "habit_events")}
+    rollups = _rows("habit_rollups", "habit_id = ?", (habit_id,))
+    database.mark_users_inactive([1], now=1000)
+
+    assert database.archive_inactive_users(older_than=2000) == 1
+
+    for table in ("users", "habits", "habit_events", "weekly_digests", "fsm_state"):
+        assert _rows(table, "user_id = ?", (1,)) == []
+    assert _rows("habit_rollups", "habit_id = ?", (habit_id,)) == []
+    assert _rows("sheet_outbox", "chat_id = ?", (1,)) == []
+    assert _rows("reminder_claims", "habit_id = ?", (habit_id,)) == []
+    assert database.is_user_inactive(1)
+    assert database.get_user_profile(1)[-1] == 1
+    # Соседа не задело
+    assert _rows("habits", "user_id = ?", (2,)) and _rows("reminder_claims", "habit_id = ?", (other_habit,))
+    assert _rows("fsm_state", "user_id = ?", (2,)) and _rows("sheet_outbox", "chat_id = ?", (2,))
+
+    assert database.reactivate_user(1)
+
+    assert _rows("habit_events", "user_id = ?", (1,)) == kept["habit_events"]
+    assert _rows("habit_rollups", "habit_id = ?", (habit_id,)) == rollups
+    assert [row[:4] for row in _rows("habits", "user_id = ?", (1,))] == [row[:4] for row in kept["habits"]]
+    assert _rows("habits", "user_id = ? AND inactive = 0", (1,))
+    assert not database.is_user_inactive(1)
+    assert _rows("archived_users", "user_id = ?", (1,)) == []
+    assert not database.reactivate_user(1)
+
+
+def test_archive_skips_recently_inactive_users(db):
+    database.init_db()
+    _seed_archivable(1)
+    database.mark_users_inactive([1], now=5000)
+
+    assert database.archive_inactive_users(older_than=2000) == 0
+    assert _rows("habits", "user_id = ?", (1,))
+
+
+def test_fsm_records_remember_their_user(adb):
+    async def scenario():
+        storage = SQLiteStorage(flush_interval=0)
+        await storage.set_state(StorageKey(bot_id=1, chat_id=7, user_id=7), "HabitForm:name")
+        await storage.flush()
+
+    asyncio.run(scenario())
+
+    assert [(key, user_id) for key, _, _, _, user_id in _rows("fsm_state", "1", ())] == [("fsm:1:7:7:default", 7)]
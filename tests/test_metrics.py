@@ -0,0 +1,32 @@
+import inspect
+
+import database
+from metrics import Counter, Histogram, Registry, timed
+
+
+def test_timed_generator_covers_whole_iteration():
+    registry = Registry()
+    seconds = Histogram("seconds", "test", ["query"], registry=registry)
+    errors = Counter("errors", "test", ["query"], registry=registry)
+
+    @timed(seconds, errors, "rows")
+    def rows():
+        yield 1
+        yield 2
+
+    iterator = rows()
+    assert seconds.labels("rows").count == 0
+    assert list(iterator) == [1, 2]
+    assert seconds.labels("rows").count == 1
+
+
+def test_database_queries_are_timed():
+    # Всё, что ходит в базу, попадает в db_query_seconds
+    untimed = []
+    for name, func in vars(database).items():
+        if not inspect.isfunction(func) or func.__module__ != "database" or name.startswith("_"):
+            continue
+        source = inspect.getsource(func)
+        if ("get_connection()" in source or "sqlite3.connect(" in source) and not hasattr(func, "__wrapped__"):
+            untimed.append(name)
+    assert untimed == []
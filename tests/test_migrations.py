@@ -0,0 +1,85 @@
+import sqlite3
+
+import database
+
+# Схема и данные в том виде, как их создавал самый первый database.py
+BASELINE_SCHEMA = '''
+    CREATE TABLE habits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        name TEXT,
+        frequency TEXT,
+        time TEXT,
+        done_count INTEGER DEFAULT 0,
+        skip_count INTEGER DEFAULT 0,
+        start_date TEXT
+    );
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        sheet_link TEXT,
+        utc_offset INTEGER DEFAULT 3,
+        timezone_confirmed INTEGER DEFAULT 0
+    );
+'''
+
+
+def _create_baseline(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO users (user_id, sheet_link, utc_offset, timezone_confirmed) VALUES (?, ?, ?, ?)",
+        [(1, None, 5, 1), (2, "https://example.com/sheet", -4, 1), (3, None, None, 0)],
+    )
+    conn.executemany(
+        "INSERT INTO habits (user_id, name, frequency, time, done_count, skip_count, start_date) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, "Зарядка", "Каждый день", "07:30", 3, 1, "01.01.2024"),
+            (2, "Отчёт", database.FREQ_WEEKDAYS, "18:00", 0, 0, "01.01.2024"),
+            (3, "Чтение", "Каждый день", "Без напоминаний", 0, 0, "01.01.2024"),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_init_db_migrates_baseline_schema(db):
+    _create_baseline(db)
+
+    database.init_db()
+
+    conn = sqlite3.connect(db)
+    assert {"timezone", "inactive_since"} <= _columns(conn, "users")
+    assert {"remind_minute", "remind_days", "timezone", "inactive", "current_streak"} <= _columns(conn, "habits")
+    assert dict(conn.execute("SELECT user_id, timezone FROM users")) == {1: "UTC+05:00", 2: "UTC-04:00", 3: "UTC+03:00"}
+    habits = {name: (minute, days, zone) for name, minute, days, zone in conn.execute(
+        "SELECT name, remind_minute, remind_days, timezone FROM habits"
+    )}
+    assert habits["Зарядка"] == (7 * 60 + 30, database.ALL_DAYS_MASK, "UTC+05:00")
+    assert habits["Отчёт"] == (18 * 60, database.WEEKDAYS_MASK, "UTC-04:00")
+    assert habits["Чтение"][:2] == (None, None)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_users_timezone", "idx_habits_due", "idx_users_inactive_since"} <= indexes
+    conn.close()
+
+
+def test_init_db_is_idempotent(db):
+    _create_baseline(db)
+    database.init_db()
+    database.close_connection()
+
+    database.init_db()
+
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT COUNT(*) FROM habits").fetchone() == (3,)
+    assert conn.execute("SELECT timezone FROM users WHERE user_id = 1").fetchone() == ("UTC+05:00",)
+    conn.close()
+
+
+def test_init_db_on_empty_database(db):
+    database.init_db()
+
+    assert database.get_digest_zones() == []
@@ -0,0 +1,69 @@
+import database
+
+
+def _seed():
+    # Привычки двух пользователей вперемешку, с дыркой от удалённой — id у первого идут не подряд
+    database.init_db()
+    database.set_user_timezone(1, "Europe/Berlin")
+    database.set_user_timezone(2, "Europe/Berlin")
+    ids = []
+    for n in range(8):
+        ids.append(database.add_habit(1, f"Привычка {n}", "Каждый день", "08:00"))
+        database.add_habit(2, f"Чужая {n}", "Каждый день", "08:00")
+    database.delete_habit(ids.pop(3), 1)
+    return ids
+
+
+def _page(**kwargs):
+    rows, has_prev, has_next = database.get_user_habits_page(1, limit=3, **kwargs)
+    return [row[0] for row in rows], has_prev, has_next
+
+
+def test_first_page(db):
+    ids = _seed()
+
+    assert _page() == (ids[:3], False, True)
+
+
+def test_walk_forward_and_back(db):
+    ids = _seed()
+
+    assert _page(after_id=ids[2]) == (ids[3:6], True, True)
+    assert _page(after_id=ids[5]) == (ids[6:], True, False)
+    # Назад от последней страницы — та же средняя страница, а от средней — первая
+    assert _page(before_id=ids[6]) == (ids[3:6], True, True)
+    assert _page(before_id=ids[3]) == (ids[:3], False, True)
+
+
+def test_cursor_survives_deleting_its_row(db):
+    ids = _seed()
+    # Кнопка "дальше" хранит id последней строки; если её удалили, страница не съезжает
+    database.delete_habit(ids[2], 1)
+
+    assert _page(after_id=ids[2]) == (ids[3:6], True, True)
+    assert _page(before_id=ids[3]) == (ids[:2], False, True)
+
+
+def test_page_past_the_end_is_empty(db):
+    ids = _seed()
+
+    assert _page(after_id=ids[-1]) == ([], False, False)
+    assert _page(before_id=ids[0]) == ([], False, False)
+
+
+def test_single_page_has_no_neighbours(db):
+    database.init_db()
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "08:00")
+
+    assert _page() == ([habit_id], False, False)
+    assert database.get_user_habits_page(3) == ([], False, False)
+
+
+def test_stats_page_uses_the_same_keyset(db):
+    ids = _seed()
+
+    rows, has_prev, has_next = database.get_user_stats_page(1, after_id=ids[2], limit=3)
+
+    assert ([row[0] for row in rows], has_prev, has_next) == (ids[3:6], True, True)
+    assert [row[1] for row in rows] == ["Привычка 4", "Привычка 5", "Привычка 6"]
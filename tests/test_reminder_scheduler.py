@@ -0,0 +1,90 @@
+import asyncio
+from datetime import datetime, timezone
+
+import database
+from reminder_scheduler import ReminderScheduler
+
+# 2024-06-03 08:00 в Берлине (UTC+2)
+EIGHT = int(datetime(2024, 6, 3, 6, 0, tzinfo=timezone.utc).timestamp() // 60)
+NINE = EIGHT + 60
+EIGHT_KEY = "202406030800"
+
+
+def _habit(user_id=1, habit_time="08:00"):
+    database.set_user_timezone(user_id, "Europe/Berlin")
+    return database.add_habit(user_id, "Зарядка", "Каждый день", habit_time)
+
+
+def test_reminder_habits_recheck_current_schedule(db):
+    database.init_db()
+    habit_id = _habit()
+    assert database.get_reminder_habits({habit_id: EIGHT_KEY}, EIGHT) == [(habit_id, 1, "Зарядка", "08:00")]
+    # Колесо этой копии ещё помнит 08:00, а время уже поменяли на другой
+    database.update_habit_time(habit_id, 1, "09:00")
+    assert database.get_reminder_habits({habit_id: EIGHT_KEY}, EIGHT) == []
+    database.update_habit_time(habit_id, 1, "Без напоминаний")
+    assert database.get_reminder_habits({habit_id: "202406030900"}, NINE) == []
+    database.update_habit_time(habit_id, 1, "08:00")
+    database.delete_habit(habit_id, 1)
+    assert database.get_reminder_habits({habit_id: EIGHT_KEY}, EIGHT) == []
+
+
+def test_reminder_habits_check_fire_key_and_partitions(db):
+    database.init_db()
+    habit_id = _habit(user_id=3)
+    assert database.get_reminder_habits({habit_id: "202406020800"}, EIGHT) == []
+    assert database.get_reminder_habits({habit_id: EIGHT_KEY}, EIGHT, {0}, 2) == []
+    assert database.get_reminder_habits({habit_id: EIGHT_KEY}, EIGHT, {1}, 2) == [(habit_id, 3, "Зарядка", "08:00")]
+
+
+def test_wheel_picks_up_changes_made_by_another_copy(adb):
+    async def fire(fire_at, due):
+        pass
+
+    async def scenario():
+        scheduler = ReminderScheduler(fire, resync_interval=0, changes_interval=0)
+        await scheduler.start()
+        try:
+            # Изменения делает "другая копия": подписчиков в этом процессе нет (см. conftest)
+            await adb.set_user_timezone(1, "Europe/Berlin")
+            habit_id = await adb.add_habit(1, "Зарядка", "Каждый день", "08:00")
+            await scheduler.apply_changes()
+            added = scheduler.due_at(EIGHT)
+            await adb.update_habit_time(habit_id, 1, "09:00")
+            await scheduler.apply_changes()
+            moved = scheduler.due_at(EIGHT), scheduler.due_at(NINE)
+            await adb.set_user_timezone(1, "Asia/Tokyo")
+            await scheduler.apply_changes()
+            # 09:00 в Токио — 00:00 UTC
+            tokyo = scheduler.due_at(int(datetime(2024, 6, 3, 0, 0, tzinfo=timezone.utc).timestamp() // 60))
+            await adb.delete_habit(habit_id, 1)
+            await scheduler.apply_changes()
+            return habit_id, added, moved, tokyo, len(scheduler.wheel)
+        finally:
+            await scheduler.stop()
+
+    habit_id, added, moved, tokyo, left = asyncio.run(scenario())
+
+    assert added == [(habit_id, EIGHT_KEY)]
+    assert moved == ([], [(habit_id, "202406030900")])
+    assert tokyo == [(habit_id, "202406030900")]
+    assert left == 0
+
+
+def test_reload_keeps_changes_cursor(adb):
+    async def fire(fire_at, due):
+        pass
+
+    async def scenario():
+        await adb.set_user_timezone(1, "Europe/Berlin")
+        await adb.add_habit(1, "Зарядка", "Каждый день", "08:00")
+        scheduler = ReminderScheduler(fire, resync_interval=0, changes_interval=0)
+        await scheduler.start()
+        try:
+            # Всё записанное до загрузки уже в колесе — журнал с начала не перечитываем
+            return scheduler._changes_after, database.get_last_schedule_change_id()
+        finally:
+            await scheduler.stop()
+
+    cursor, last_id = asyncio.run(scenario())
+    assert cursor == last_id > 0
@@ -0,0 +1,150 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.methods import SendMessage
+
+import sender
+from sender import MessageSender, OutgoingMessage, PerChatLimiter, SendStats, TokenBucket
+
+METHOD = SendMessage(chat_id=1, text="test")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Виртуальное время: sleep не ждёт, а двигает часы (настоящий sleep тоже не бывает мгновенным)
+    state = SimpleNamespace(now=1000.0, sleeps=[])
+
+    async def sleep(seconds):
+        state.sleeps.append(seconds)
+        state.now += max(seconds, 1e-6)
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(sender, "time", SimpleNamespace(monotonic=lambda: state.now))
+    monkeypatch.setattr(sender, "asyncio", SimpleNamespace(sleep=sleep, Lock=asyncio.Lock, gather=asyncio.gather))
+    monkeypatch.setattr(sender.random, "random", lambda: 1.0)
+    return state
+
+
+class FakeBot:
+    def __init__(self, *results):
+        # results — по одному на вызов: исключение или None (доставлено)
+        self.results = list(results)
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(chat_id)
+        result = self.results.pop(0) if self.results else None
+        if result is not None:
+            raise result
+
+
+def _send(bot, message=OutgoingMessage(1, "привет"), **kwargs):
+    stats = SendStats()
+    ok = asyncio.run(MessageSender(bot, **kwargs).send(message, stats))
+    return ok, stats
+
+
+def test_bucket_allows_burst_then_rate(clock):
+    async def scenario():
+        bucket = TokenBucket(rate=3)
+        moments = []
+        for _ in range(6):
+            await bucket.acquire()
+            moments.append(clock.now - 1000.0)
+        return moments
+
+    assert asyncio.run(scenario()) == pytest.approx([0, 0, 0, 1 / 3, 2 / 3, 1], abs=1e-3)
+
+
+def test_bucket_pause_holds_everyone(clock):
+    async def scenario():
+        bucket = TokenBucket(rate=30)
+        bucket.pause(5)
+        await bucket.acquire()
+        return clock.now - 1000.0
+
+    assert asyncio.run(scenario()) >= 5
+
+
+def test_per_chat_interval(clock):
+    async def scenario():
+        limiter = PerChatLimiter(interval=1.0)
+        await limiter.wait(1)
+        await limiter.wait(2)
+        other_chat = clock.now - 1000.0
+        await limiter.wait(1)
+        return other_chat, clock.now - 1000.0
+
+    assert asyncio.run(scenario()) == pytest.approx((0, 1.0), abs=1e-3)
+
+
+def test_per_chat_prunes_expired_chats(clock):
+    async def scenario():
+        limiter = PerChatLimiter(interval=1.0, max_tracked=2)
+        for chat_id in (1, 2):
+            await limiter.wait(chat_id)
+        clock.now += 10
+        await limiter.wait(3)
+        return list(limiter._next_slot)
+
+    assert asyncio.run(scenario()) == [3]
+
+
+def test_server_errors_are_retried_with_backoff(clock):
+    bot = FakeBot(TelegramServerError(METHOD, "Bad Gateway"), TelegramNetworkError(METHOD, "timeout"))
+    ok, stats = _send(bot)
+    assert ok and stats.sent == 1 and stats.retried == 2
+    assert clock.sleeps[-2:] == [sender.BACKOFF_BASE, sender.BACKOFF_BASE * 2]
+
+
+def test_gives_up_after_max_attempts(clock):
+    bot = FakeBot(*[TelegramServerError(METHOD, "Bad Gateway")] * 10)
+    ok, stats = _send(bot, max_attempts=3)
+    assert not ok and stats.failed == 1 and len(bot.calls) == 3
+
+
+def test_retry_after_pauses_and_does_not_count_as_attempt(clock):
+    bot = FakeBot(*[TelegramRetryAfter(METHOD, "Too Many Requests", 7)] * 3)
+    ok, stats = _send(bot, max_attempts=1)
+    assert ok and stats.rate_limited == 3 and stats.sent == 1
+    assert clock.now - 1000.0 >= 21
+
+
+@pytest.mark.parametrize("error, unreachable", [
+    (TelegramForbiddenError(METHOD, "Forbidden: bot was blocked by the user"), True),
+    (TelegramBadRequest(METHOD, "Bad Request: chat not found"), True),
+    (TelegramBadRequest(METHOD, "Bad Request: can't parse entities"), False),
+])
+def test_permanent_errors_are_not_retried(clock, error, unreachable):
+    bot = FakeBot(error)
+    ok, stats = _send(bot)
+    assert not ok and len(bot.calls) == 1
+    assert stats.unreachable == ([1] if unreachable else [])
+    assert stats.failed == (0 if unreachable else 1)
+
+
+def test_send_many_is_bounded_and_sends_everything(clock):
+    running, peak, delivered = 0, 0, []
+
+    class SlowBot:
+        async def send_message(self, chat_id, text, **kwargs):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            running -= 1
+            delivered.append(chat_id)
+
+    stats = asyncio.run(MessageSender(SlowBot(), concurrency=3).send_many(OutgoingMessage(chat_id, "x") for chat_id in range(10)))
+
+    assert stats.sent == 10 and sorted(delivered) == list(range(10))
+    assert peak == 3
@@ -0,0 +1,64 @@
+import asyncio
+
+import database
+import sheets_writer
+from google_manager import SheetsAPIError
+from sheets_writer import SheetsWriter
+
+
+def test_backed_off_sheet_does_not_hold_up_others(adb, monkeypatch):
+    written, reads = {}, []
+    read = adb.get_pending_sheet_rows
+
+    async def append_rows(sheet_url, rows):
+        if sheet_url == "slow":
+            raise SheetsAPIError(503, "backend error")
+        written.setdefault(sheet_url, []).extend(rows)
+
+    async def get_pending_sheet_rows(sheet_url, limit):
+        reads.append(sheet_url)
+        return await read(sheet_url, limit)
+
+    monkeypatch.setattr(sheets_writer, "append_rows", append_rows)
+    monkeypatch.setattr(sheets_writer, "get_pending_sheet_rows", get_pending_sheet_rows)
+
+    async def scenario():
+        writer = SheetsWriter()
+        # Хвост отложенной таблицы старше и длиннее всей выборки
+        for _ in range(sheets_writer.MAX_ROWS_PER_REQUEST + 100):
+            await writer.enqueue("slow", "Зарядка", "ВЫПОЛНЕНО")
+        await writer.enqueue("fast", "Зарядка", "ВЫПОЛНЕНО")
+        await writer.flush()
+        first = list(reads)
+        reads.clear()
+        await writer.enqueue("fast", "Чтение", "ПРОПУЩЕНО")
+        await writer.flush()
+        return first, list(reads), writer.pending
+
+    first, second, pending = asyncio.run(scenario())
+
+    assert first == ["slow", "fast"]
+    # Таблица в backoff: её строки не читаются вовсе
+    assert second == ["fast"]
+    assert [row[2] for row in written["fast"]] == ["Зарядка", "Чтение"]
+    assert pending == sheets_writer.MAX_ROWS_PER_REQUEST + 100
+
+
+def test_pending_is_recounted_from_database(adb, monkeypatch):
+    async def append_rows(sheet_url, rows):
+        raise SheetsAPIError(503, "backend error")
+
+    monkeypatch.setattr(sheets_writer, "append_rows", append_rows)
+
+    async def scenario():
+        writer = SheetsWriter()
+        for _ in range(3):
+            await writer.enqueue("sheet", "Зарядка", "ВЫПОЛНЕНО", chat_id=5)
+        before = writer.pending
+        # Строки пользователя удалила архивация (или отправила другая копия бота)
+        with database.get_connection() as conn:
+            conn.execute("DELETE FROM sheet_outbox WHERE chat_id = 5")
+        await writer.flush()
+        return before, writer.pending
+
+    assert asyncio.run(scenario()) == (3, 0)
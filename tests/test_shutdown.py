@@ -0,0 +1,54 @@
+import asyncio
+
+from async_database import StatsBuffer
+from reminder_scheduler import ReminderScheduler
+from sheets_writer import SheetsWriter
+
+STOP_TIMEOUT = 2
+
+
+async def _stops_promptly(wake, stop):
+    # wake() и stop() — в одном шаге цикла событий: именно так отмена попадала в wait_for
+    # вместе с завершением ожидания и терялась
+    async def scenario():
+        wake()
+        await stop()
+
+    task = asyncio.create_task(scenario())
+    done, _ = await asyncio.wait({task}, timeout=STOP_TIMEOUT)
+    if not done:
+        task.cancel()
+    return bool(done)
+
+
+def test_reminder_scheduler_stops_right_after_schedule_change(adb):
+    async def fire(fire_at, due):
+        pass
+
+    async def scenario():
+        scheduler = ReminderScheduler(fire, resync_interval=0)
+        await scheduler.start()
+        await asyncio.sleep(0.05)
+        return await _stops_promptly(lambda: scheduler.update(1, "Europe/Berlin", 8 * 60, 0b1111111), scheduler.stop)
+
+    assert asyncio.run(scenario())
+
+
+def test_stats_buffer_closes_right_after_wake(adb):
+    async def scenario():
+        buffer = StatsBuffer(flush_interval=60)
+        buffer._ensure_started()
+        await asyncio.sleep(0.05)
+        return await _stops_promptly(buffer._wake.set, buffer.close)
+
+    assert asyncio.run(scenario())
+
+
+def test_sheets_writer_stops_right_after_wake(adb):
+    async def scenario():
+        writer = SheetsWriter(flush_interval=60)
+        await writer.start()
+        await asyncio.sleep(0.05)
+        return await _stops_promptly(writer._wake.set, writer.stop)
+
+    assert asyncio.run(scenario())
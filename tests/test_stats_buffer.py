@@ -0,0 +1,52 @@
+import asyncio
+
+import database
+
+
+def _events(habit_id):
+    with database.get_connection() as conn:
+        return conn.execute('SELECT user_id, ts, status FROM habit_events WHERE habit_id = ? ORDER BY id', (habit_id,)).fetchall()
+
+
+def test_every_tap_of_a_day_is_written(adb):
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "08:00")
+
+    async def scenario():
+        buffer = adb.StatsBuffer(flush_interval=60)
+        buffer.add(habit_id, 1, True, ts=1_000_000)
+        # Нажатие по чужой привычке (старая кнопка в пересланном сообщении) — не должно вытеснить
+        buffer.add(habit_id, 2, True, ts=1_000_050)
+        buffer.add(habit_id, 1, False, ts=1_000_100)
+        assert buffer.pending == 3
+        await buffer.close()
+
+    asyncio.run(scenario())
+
+    assert _events(habit_id) == [(1, 1_000_000, 1), (1, 1_000_100, 0)]
+    assert database.get_user_habit(habit_id, 1)[5:7] == (1, 1)
+
+
+def test_failed_flush_keeps_taps(adb, monkeypatch):
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "08:00")
+    apply = database.apply_habit_stats
+
+    def broken(batch):
+        raise RuntimeError("disk I/O error")
+
+    async def scenario():
+        buffer = adb.StatsBuffer(flush_interval=60)
+        buffer.add(habit_id, 1, True, ts=1_000_000)
+        monkeypatch.setattr(database, "apply_habit_stats", broken)
+        try:
+            await buffer.flush()
+        except RuntimeError:
+            pass
+        buffer.add(habit_id, 1, True, ts=1_000_100)
+        monkeypatch.setattr(database, "apply_habit_stats", apply)
+        await buffer.close()
+
+    asyncio.run(scenario())
+
+    assert [ts for _, ts, _ in _events(habit_id)] == [1_000_000, 1_000_100]
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta, timezone
+
+import database
+from database import FREQ_WEEKDAYS, FREQ_WEEKLY, effective_streak, streak_period_index
+
+BERLIN_SUMMER = timedelta(hours=2)
+
+
+def _ts(year, month, day, hour=12, minute=0):
+    # Местное время Берлина летом -> unix time
+    local = datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+    return int((local - BERLIN_SUMMER).timestamp())
+
+
+def _habit(frequency="Каждый день"):
+    database.set_user_timezone(1, "Europe/Berlin")
+    return database.add_habit(1, "Зарядка", frequency, "08:00")
+
+
+def _streaks(habit_id):
+    with database.get_connection() as conn:
+        return conn.execute('SELECT current_streak, best_streak, streak_period FROM habits WHERE id = ?', (habit_id,)).fetchone()
+
+
+def _rollups(habit_id):
+    with database.get_connection() as conn:
+        rows = conn.execute(
+            'SELECT period, period_key, done_count, skip_count FROM habit_rollups WHERE habit_id = ? ORDER BY period, period_key',
+            (habit_id,),
+        ).fetchall()
+    return {(period, key): (done, skip) for period, key, done, skip in rows}
+
+
+def test_daily_streak_grows_breaks_and_keeps_best(db):
+    database.init_db()
+    habit_id = _habit()
+    for day in (3, 4, 5):
+        database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, day))
+    # Второе "сделано" в тот же день серию не растит
+    database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, 5, 20))
+    assert _streaks(habit_id)[:2] == (3, 3)
+    database.update_habit_stats(habit_id, 1, False, ts=_ts(2024, 6, 6))
+    assert _streaks(habit_id)[:2] == (0, 3)
+    # Пропущенный день: новая серия с единицы
+    database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, 8))
+    assert _streaks(habit_id)[:2] == (1, 3)
+
+
+def test_skip_after_done_in_same_day_keeps_streak(db):
+    database.init_db()
+    habit_id = _habit()
+    database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, 3))
+    database.update_habit_stats(habit_id, 1, False, ts=_ts(2024, 6, 3, 20))
+    assert _streaks(habit_id)[:2] == (1, 1)
+
+
+def test_weekday_streak_spans_weekend(db):
+    database.init_db()
+    habit_id = _habit(FREQ_WEEKDAYS)
+    # Четверг, пятница, понедельник — подряд по будним дням
+    for day in (6, 7, 10):
+        database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, day))
+    assert _streaks(habit_id)[:2] == (3, 3)
+
+
+def test_weekly_streak_counts_weeks(db):
+    database.init_db()
+    habit_id = _habit(FREQ_WEEKLY)
+    for day in (3, 7, 12, 19):
+        database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, day))
+    assert _streaks(habit_id)[:2] == (3, 3)
+
+
+def test_buffered_batch_matches_one_by_one(db):
+    database.init_db()
+    habit_id = _habit()
+    events = [(_ts(2024, 6, 4), True), (_ts(2024, 6, 3), True), (_ts(2024, 6, 5), False)]
+    # События пачки применяются по времени, в каком бы порядке ни пришли
+    database.apply_habit_stats([(habit_id, 1, events)])
+    assert _streaks(habit_id)[:2] == (0, 2)
+    assert database.get_user_habit(habit_id, 1)[5:7] == (2, 1)
+
+
+def test_rollups_by_local_day_week_and_month(db):
+    database.init_db()
+    habit_id = _habit()
+    # 00:30 1 июля по-местному — в UTC ещё 30 июня: агрегаты считаются по местному времени
+    database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 6, 30, 23, 30))
+    database.update_habit_stats(habit_id, 1, True, ts=_ts(2024, 7, 1, 0, 30))
+    database.update_habit_stats(habit_id, 1, False, ts=_ts(2024, 7, 2))
+
+    assert _rollups(habit_id) == {
+        ("day", "2024-06-30"): (1, 0),
+        ("day", "2024-07-01"): (1, 0),
+        ("day", "2024-07-02"): (0, 1),
+        ("month", "2024-06"): (1, 0),
+        ("month", "2024-07"): (1, 1),
+        ("week", "2024-W26"): (1, 0),
+        ("week", "2024-W27"): (1, 1),
+    }
+
+
+def test_effective_streak_expires_after_missed_period():
+    monday = datetime(2024, 6, 10, 9)
+    sunday_period = streak_period_index("Каждый день", monday - timedelta(days=1))
+    assert effective_streak("Каждый день", 5, sunday_period, monday) == 5
+    assert effective_streak("Каждый день", 5, sunday_period - 1, monday) == 0
+    # По будням: последняя отметка в пятницу — в понедельник серия ещё жива
+    friday_period = streak_period_index(FREQ_WEEKDAYS, monday - timedelta(days=3))
+    assert effective_streak(FREQ_WEEKDAYS, 4, friday_period, monday) == 4
+    assert effective_streak("Каждый день", 0, sunday_period, monday) == 0
+    assert effective_streak("Каждый день", 3, None, monday) == 0
@@ -0,0 +1,70 @@
+from datetime import datetime, timezone
+
+import database
+from timezones import local_slots
+
+
+def _utc_minute(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp() // 60)
+
+
+def _times(slots):
+    return [f"{minute // 60:02d}:{minute % 60:02d}" for minute, _, _ in slots]
+
+
+def test_regular_minute_is_one_slot():
+    # 2024-06-03 — понедельник, Берлин — UTC+2
+    assert local_slots("Europe/Berlin", _utc_minute(2024, 6, 3, 6, 30)) == [(8 * 60 + 30, 0, "202406030830")]
+
+
+def test_spring_forward_fires_skipped_minutes():
+    # 2024-03-31 в Берлине 02:00-02:59 не наступает: в 01:00 UTC часы прыгают с 01:59 на 03:00
+    assert local_slots("Europe/Berlin", _utc_minute(2024, 3, 31, 0, 59)) == [(119, 6, "202403310159")]
+    slots = local_slots("Europe/Berlin", _utc_minute(2024, 3, 31, 1, 0))
+    assert len(slots) == 61
+    assert _times(slots)[:2] == ["02:00", "02:01"] and _times(slots)[-1] == "03:00"
+    assert (150, 6, "202403310230") in slots
+    assert local_slots("Europe/Berlin", _utc_minute(2024, 3, 31, 1, 1)) == [(181, 6, "202403310301")]
+
+
+def test_fall_back_repeats_minute_with_same_fire_key():
+    # 2024-10-27 в Берлине 02:00-02:59 проходит дважды: в 00:00 UTC (CEST) и в 01:00 UTC (CET)
+    first = local_slots("Europe/Berlin", _utc_minute(2024, 10, 27, 0, 30))
+    second = local_slots("Europe/Berlin", _utc_minute(2024, 10, 27, 1, 30))
+    assert first == second == [(150, 6, "202410270230")]
+    # Сам момент перевода назад — одна минута, без "обратного" диапазона
+    assert local_slots("Europe/Berlin", _utc_minute(2024, 10, 27, 1, 0)) == [(120, 6, "202410270200")]
+
+
+def test_half_hour_shift():
+    # Лорд-Хау переводит часы на 30 минут: 2024-10-06 02:00 -> 02:30 по местному (15:30 UTC накануне)
+    slots = local_slots("Australia/Lord_Howe", _utc_minute(2024, 10, 5, 15, 30))
+    assert _times(slots) == [f"02:{minute:02d}" for minute in range(0, 31)]
+
+
+def test_fixed_offset_has_no_transitions():
+    assert local_slots("UTC+05:30", _utc_minute(2024, 3, 31, 1, 0)) == [(6 * 60 + 30, 6, "202403310630")]
+
+
+def test_reminder_in_skipped_hour_fires_once(db):
+    database.init_db()
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "02:30")
+
+    due = [database.get_due_habits(minute, {0}, 1) for minute in range(_utc_minute(2024, 3, 30, 23, 0), _utc_minute(2024, 3, 31, 3, 0))]
+    fired = [habit for habits in due for habit in habits]
+
+    assert [(habit[0], habit[4]) for habit in fired] == [(habit_id, "202403310230")]
+
+
+def test_reminder_in_repeated_hour_is_claimed_once(db):
+    database.init_db()
+    database.set_user_timezone(1, "Europe/Berlin")
+    habit_id = database.add_habit(1, "Зарядка", "Каждый день", "02:30")
+
+    fired = []
+    for hour in (0, 1):
+        for habit in database.get_due_habits(_utc_minute(2024, 10, 27, hour, 30), {0}, 1):
+            fired += database.claim_reminders([(habit[0], habit[4])], "worker-1")
+
+    assert fired == [(habit_id, "202410270230")]
@@ -0,0 +1,59 @@
+import asyncio
+
+import database
+from user_cache import UserProfile, UserProfileCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_profile_expires_after_ttl():
+    clock = Clock()
+    cache = UserProfileCache(ttl=60, timer=clock)
+    cache.put_many({1: UserProfile(sheet_link="old")}, cache.version)
+    clock.now = 59
+    assert cache.get(1).sheet_link == "old"
+    clock.now = 61
+    assert cache.get(1) is None
+    assert cache.missing([1]) == [1]
+
+
+def test_zero_ttl_keeps_profiles():
+    clock = Clock()
+    cache = UserProfileCache(ttl=0, timer=clock)
+    cache.put_many({1: UserProfile()}, cache.version)
+    clock.now = 10 ** 6
+    assert cache.get(1) == UserProfile()
+
+
+def test_stale_put_is_dropped():
+    cache = UserProfileCache()
+    version = cache.version
+    cache.invalidate(1)
+    cache.put_many({1: UserProfile(sheet_link="stale")}, version)
+    assert cache.get(1) is None
+
+
+def test_change_from_another_copy_is_seen_after_ttl(adb, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(adb, "profile_cache", UserProfileCache(ttl=60, timer=clock))
+    database.set_user_timezone(1, "Europe/Berlin")
+
+    async def scenario():
+        before = await adb.get_user_profile(1)
+        # Другая копия бота сменила пояс и подключила таблицу — в этом процессе кэш не сброшен
+        database.set_user_timezone(1, "Asia/Tokyo")
+        database.set_user_sheet(1, "https://docs.google.com/spreadsheets/d/x")
+        cached = await adb.get_user_profile(1)
+        clock.now = 61
+        return before, cached, await adb.get_user_profile(1)
+
+    before, cached, fresh = asyncio.run(scenario())
+
+    assert before.timezone == cached.timezone == "Europe/Berlin"
+    assert fresh.timezone == "Asia/Tokyo" and fresh.sheet_link.endswith("/x")
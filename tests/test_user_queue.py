@@ -0,0 +1,145 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram import Bot, Dispatcher
+from aiogram.filters import StateFilter
+from aiogram.types import Update
+
+from user_queue import UserQueueMiddleware
+
+
+def _data(user_id):
+    return {"event_from_user": SimpleNamespace(id=user_id)}
+
+
+class _Recorder:
+    # Обработчик, который пишет начало/конец апдейта и ждёт разрешения завершиться
+    def __init__(self):
+        self.log = []
+        self.gates = {}
+
+    def gate(self, name):
+        return self.gates.setdefault(name, asyncio.Event())
+
+    async def __call__(self, event, data):
+        self.log.append(("start", event))
+        await self.gate(event).wait()
+        self.log.append(("end", event))
+        return event
+
+
+def test_same_user_in_order_other_users_in_parallel():
+    async def scenario():
+        queue = UserQueueMiddleware(workers=8)
+        handler = _Recorder()
+        tasks = [
+            asyncio.create_task(queue(handler, name, _data(user_id)))
+            for name, user_id in (("a1", 1), ("a2", 1), ("b1", 2), ("a3", 1))
+        ]
+        await asyncio.sleep(0.01)
+        assert handler.log == [("start", "a1"), ("start", "b1")]
+        assert queue.pending == 4 and queue.users == 2 and queue.max_depth == 3
+        for name in ("a2", "a3", "b1", "a1"):
+            handler.gate(name).set()
+        assert await asyncio.gather(*tasks) == ["a1", "a2", "b1", "a3"]
+        starts = [name for kind, name in handler.log if kind == "start" and name.startswith("a")]
+        assert starts == ["a1", "a2", "a3"]
+        assert queue.pending == 0 and not queue._tails
+
+    asyncio.run(scenario())
+
+
+def test_workers_limit():
+    async def scenario():
+        queue = UserQueueMiddleware(workers=2)
+        handler = _Recorder()
+        tasks = [asyncio.create_task(queue(handler, f"u{user_id}", _data(user_id))) for user_id in range(3)]
+        await asyncio.sleep(0.01)
+        assert queue.running == 2 and len(handler.log) == 2
+        handler.gate("u0").set()
+        await asyncio.sleep(0.01)
+        assert ("start", "u2") in handler.log
+        for user_id in range(3):
+            handler.gate(f"u{user_id}").set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_keeps_order_for_next_update():
+    async def scenario():
+        queue = UserQueueMiddleware(workers=8)
+        handler = _Recorder()
+        first = asyncio.create_task(queue(handler, "first", _data(1)))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.create_task(queue(handler, "cancelled", _data(1)))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        # Следующий апдейт пришёл, пока первый ещё работает: он должен дождаться первого
+        third = asyncio.create_task(queue(handler, "third", _data(1)))
+        await asyncio.sleep(0.01)
+        assert handler.log == [("start", "first")]
+        handler.gate("first").set()
+        handler.gate("third").set()
+        await asyncio.gather(first, third)
+        assert handler.log == [("start", "first"), ("end", "first"), ("start", "third"), ("end", "third")]
+        assert queue.pending == 0 and not queue._tails
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_running_update_releases_queue():
+    async def scenario():
+        queue = UserQueueMiddleware(workers=1)
+        handler = _Recorder()
+        first = asyncio.create_task(queue(handler, "first", _data(1)))
+        second = asyncio.create_task(queue(handler, "second", _data(1)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        handler.gate("second").set()
+        assert await second == "second"
+        assert queue.running == 0 and queue.pending == 0 and not queue._tails
+
+    asyncio.run(scenario())
+
+
+def _message(update_id, user_id, text):
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    })
+
+
+def test_state_is_read_after_previous_update_of_user():
+    # Обработчик что-то ждёт (запись в базу) и только потом меняет состояние: второй апдейт
+    # должен увидеть уже новое состояние, а не то, что было до обоих
+    dp = Dispatcher(disable_fsm=True)
+    UserQueueMiddleware(workers=8).register(dp)
+    routed = []
+
+    @dp.message(StateFilter("a"))
+    async def in_a(message, state):
+        await asyncio.sleep(0.01)
+        routed.append(("a", message.text))
+        await state.set_state("b")
+
+    @dp.message(StateFilter("b"))
+    async def in_b(message, state):
+        routed.append(("b", message.text))
+
+    async def scenario():
+        bot = Bot("123456:TEST")
+        await dp.fsm.get_context(bot, chat_id=1, user_id=1).set_state("a")
+        await asyncio.gather(dp.feed_update(bot, _message(1, 1, "1")), dp.feed_update(bot, _message(2, 1, "2")))
+        await bot.session.close()
+
+    asyncio.run(scenario())
+
+    assert routed == [("a", "1"), ("b", "2")]
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook import SECRET_HEADER, BoundedWebhookHandler, WebhookConfig
+
+
+def test_webhook_requires_a_secret(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_BASE_URL", "https://bot.example.com")
+    monkeypatch.delenv("WEBHOOK_SECRET", raising=False)
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        WebhookConfig.from_env()
+
+    monkeypatch.setenv("WEBHOOK_SECRET", "")
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        WebhookConfig.from_env()
+
+
+def test_webhook_secret_must_be_accepted_by_telegram():
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        WebhookConfig("https://bot.example.com", "not allowed!")
+
+
+def test_webhook_config_from_env(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_BASE_URL", "https://bot.example.com/")
+    monkeypatch.setenv("WEBHOOK_SECRET", "s3cret_token-1")
+
+    config = WebhookConfig.from_env()
+
+    assert config.secret == "s3cret_token-1"
+    assert config.url == "https://bot.example.com/webhook"
+
+
+def _message_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": "hi",
+        },
+    }
+
+
+def test_handler_bounds_background_updates_and_drains():
+    release = asyncio.Event()
+    running = []
+    handled = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message):
+        running.append(message.message_id)
+        await release.wait()
+        handled.append(message.message_id)
+
+    async def scenario():
+        bot = Bot("123456:TEST")
+        handler = BoundedWebhookHandler(dp, bot, "secret", max_concurrent_updates=2)
+        app = web.Application()
+        app.router.add_route("POST", "/webhook", handler.handle)
+        async with TestClient(TestServer(app)) as client:
+            headers = {SECRET_HEADER: "secret"}
+            forged = await client.post("/webhook", json=_message_update(1, 1), headers={SECRET_HEADER: "wrong"})
+            assert forged.status == 401
+            # Ответ — сразу, обработка в фоне
+            for update_id in (1, 2):
+                assert (await client.post("/webhook", json=_message_update(update_id, update_id), headers=headers)).status == 200
+            # Слотов нет — третий запрос держим
+            third = asyncio.create_task(client.post("/webhook", json=_message_update(3, 3), headers=headers))
+            await asyncio.sleep(0.1)
+            assert not third.done() and sorted(running) == [1, 2]
+            release.set()
+            assert (await third).status == 200
+            await handler.drain(timeout=2)
+            assert sorted(handled) == [1, 2, 3] and handler.in_flight == 0
+            assert (await client.post("/webhook", json=_message_update(4, 4), headers=headers)).status == 503
+        await bot.session.close()
+
+    asyncio.run(scenario())
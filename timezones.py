@@ -0,0 +1,93 @@
+import functools
+import re
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Часовые пояса пользователей: имя IANA ("Europe/Berlin" — с переходами на летнее время)
+# или фиксированное смещение "UTC+05:30" (если человек просто сказал, сколько у него времени).
+DEFAULT_TIMEZONE = "Europe/Moscow"
+FIXED_OFFSET_RE = re.compile(r"^UTC([+-])(\d{2}):(\d{2})$")
+# Смещение из "сколько у тебя времени" округляем до 15 минут (Индия, Непал, Австралия)
+OFFSET_STEP_MINUTES = 15
+MIN_OFFSET_MINUTES = -12 * 60
+MAX_OFFSET_MINUTES = 14 * 60
+
+
+@functools.lru_cache(maxsize=1024)
+def get_zone(name):
+    # Имя -> tzinfo; неизвестное имя -> ValueError
+    match = FIXED_OFFSET_RE.match(name or "")
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        return timezone(-offset if sign == "-" else offset)
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Unknown timezone: {name}") from e
+
+
+def is_valid_timezone(name):
+    try:
+        get_zone(name)
+        return True
+    except ValueError:
+        return False
+
+
+def fixed_offset_name(offset_minutes):
+    sign = "-" if offset_minutes < 0 else "+"
+    hours, minutes = divmod(abs(int(offset_minutes)), 60)
+    return f"UTC{sign}{hours:02d}:{minutes:02d}"
+
+
+def offset_from_local_time(local_hour, local_minute, utc_now=None):
+    # Пользователь назвал своё текущее время -> смещение от UTC в минутах (кратно 15)
+    utc_now = utc_now or datetime.utcnow()
+    diff = (local_hour * 60 + local_minute) - (utc_now.hour * 60 + utc_now.minute)
+    # Разница может перейти через полночь: приводим к диапазону поясов
+    while diff > MAX_OFFSET_MINUTES:
+        diff -= 24 * 60
+    while diff < MIN_OFFSET_MINUTES:
+        diff += 24 * 60
+    return round(diff / OFFSET_STEP_MINUTES) * OFFSET_STEP_MINUTES
+
+
+def local_now(zone_name, ts=None):
+    # Наивное локальное время (как на часах у пользователя) для момента ts (по умолчанию — сейчас)
+    zone = get_zone(zone_name or DEFAULT_TIMEZONE)
+    if ts is None:
+        return datetime.now(zone).replace(tzinfo=None)
+    return datetime.fromtimestamp(ts, zone).replace(tzinfo=None)
+
+
+def local_to_timestamp(zone_name, local_dt):
+    # Наивное локальное время -> unix time. Несуществующее время (перевод вперёд) сдвигается
+    # на величину перевода, повторяющееся берётся в первый раз (fold=0).
+    return local_dt.replace(tzinfo=get_zone(zone_name or DEFAULT_TIMEZONE)).timestamp()
+
+
+def utc_offset_label(zone_name, ts=None):
+    # "UTC+3", "UTC+5:30" — для сообщений пользователю
+    zone = get_zone(zone_name or DEFAULT_TIMEZONE)
+    offset = datetime.fromtimestamp(ts if ts is not None else datetime.now().timestamp(), zone).utcoffset()
+    minutes = int(offset.total_seconds() // 60)
+    sign = "-" if minutes < 0 else "+"
+    hours, minutes = divmod(abs(minutes), 60)
+    return f"UTC{sign}{hours}" + (f":{minutes:02d}" if minutes else "")
+
+
+def local_slots(zone_name, utc_minute):
+    # Какие локальные минуты наступили в поясе за UTC-минуту utc_minute (= unix time // 60):
+    # [(минута суток, день недели, fire_key)]. Обычно одна; при переводе часов вперёд —
+    # все "перепрыгнутые" минуты, чтобы напоминание на 02:30 не потерялось. При переводе
+    # назад минута повторяется с тем же fire_key — второй раз её отсечёт reminder_claims.
+    zone = get_zone(zone_name)
+    current = datetime.fromtimestamp(utc_minute * 60, zone).replace(tzinfo=None)
+    previous = datetime.fromtimestamp((utc_minute - 1) * 60, zone).replace(tzinfo=None)
+    gap = int((current - previous).total_seconds() // 60)
+    slots = []
+    for back in range(max(gap, 1) - 1, -1, -1):
+        local = current - timedelta(minutes=back)
+        slots.append((local.hour * 60 + local.minute, local.weekday(), local.strftime("%Y%m%d%H%M")))
+    return slots
@@ -0,0 +1,184 @@
+import cProfile
+import contextvars
+import heapq
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Трассировка апдейтов: дерево спанов (БД, Sheets, Telegram API) на каждый апдейт.
+# Медленные апдейты пишутся в лог целиком, худшие WORST_TRACES хранятся в памяти для /slow.
+SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_MS", 1000)) / 1000
+WORST_TRACES = int(os.getenv("TRACE_KEEP", 20))
+# Доля апдейтов под cProfile (0 — выключено). Профилировщик видит весь поток event loop,
+# поэтому включается не больше чем на один апдейт одновременно.
+PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", 0))
+PROFILE_TOP = 15
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "started", "duration", "children", "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.children = []
+        self.error = None
+
+
+class span:
+    # with span("db.get_user_habit"): ... — вне трассируемого апдейта ничего не делает
+    __slots__ = ("name", "_span", "_token")
+
+    def __init__(self, name):
+        self.name = name
+        self._span = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None and parent.duration is None:
+            self._span = Span(self.name)
+            parent.children.append(self._span)
+            self._token = _current_span.set(self._span)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is not None:
+            self._span.duration = time.perf_counter() - self._span.started
+            if exc_type is not None:
+                self._span.error = exc_type.__name__
+            _current_span.reset(self._token)
+
+
+def render(root, limit=None):
+    lines = []
+
+    def walk(node, depth):
+        offset = (node.started - root.started) * 1000
+        duration = (node.duration if node.duration is not None else time.perf_counter() - node.started) * 1000
+        error = f" !{node.error}" if node.error else ""
+        lines.append(f"{'  ' * depth}{duration:8.1f} ms  +{offset:.1f}  {node.name}{error}")
+        for child in node.children:
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    if limit is not None and len(lines) > limit:
+        lines = lines[:limit] + [f"... ещё {len(lines) - limit} спанов"]
+    return "\n".join(lines)
+
+
+class Trace:
+    __slots__ = ("root", "user_id", "finished_at", "profile")
+
+    def __init__(self, root, user_id):
+        self.root = root
+        self.user_id = user_id
+        self.finished_at = None
+        self.profile = None
+
+
+class TraceRecorder:
+    def __init__(self, threshold=SLOW_THRESHOLD, keep=WORST_TRACES, profile_rate=PROFILE_RATE):
+        self.threshold = threshold
+        self.keep = keep
+        self.profile_rate = profile_rate
+        self._worst = []
+        self._seq = itertools.count()
+        self._profiling = False
+
+    def record(self, trace):
+        duration = trace.root.duration
+        if duration >= self.threshold:
+            logger.warning("Slow update (user %s):\n%s%s", trace.user_id, render(trace.root), f"\n{trace.profile}" if trace.profile else "")
+        entry = (duration, next(self._seq), trace)
+        if len(self._worst) < self.keep:
+            heapq.heappush(self._worst, entry)
+        elif duration > self._worst[0][0]:
+            heapq.heapreplace(self._worst, entry)
+
+    def worst(self):
+        return [trace for _, _, trace in sorted(self._worst, reverse=True)]
+
+    def start_profile(self):
+        if self.profile_rate <= 0 or self._profiling or random.random() >= self.profile_rate:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Уже работает другой профилировщик (например, внешний)
+            return None
+        self._profiling = True
+        return profiler
+
+    def finish_profile(self, profiler, trace):
+        profiler.disable()
+        self._profiling = False
+        if trace.root.duration < self.threshold:
+            return
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        trace.profile = out.getvalue()
+
+
+recorder = TraceRecorder()
+
+
+def _event_name(update):
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        return f"callback_query {data.split('_', 1)[0]}"
+    if update.message is not None:
+        return "message"
+    return update.event_type
+
+
+class TracingMiddleware(BaseMiddleware):
+    # Внешний middleware на dp.update: корневой спан — весь апдейт, включая фильтры и FSM
+    def __init__(self, recorder=recorder):
+        self.recorder = recorder
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        root = Span(_event_name(event))
+        trace = Trace(root, user.id if user else None)
+        token = _current_span.set(root)
+        profiler = self.recorder.start_profile()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            root.error = type(e).__name__
+            raise
+        finally:
+            root.duration = time.perf_counter() - root.started
+            trace.finished_at = time.time()
+            _current_span.reset(token)
+            if profiler is not None:
+                self.recorder.finish_profile(profiler, trace)
+            self.recorder.record(trace)
+
+
+class HandlerSpanMiddleware(BaseMiddleware):
+    # Внутренний middleware (dp.message / dp.callback_query): спан с именем выбранного обработчика
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", None)
+        with span(f"handler {getattr(callback, '__name__', 'unknown')}"):
+            return await handler(event, data)
+
+
+class TelegramSpanMiddleware(BaseRequestMiddleware):
+    # bot.session.middleware(...): каждый вызов Bot API — отдельный спан
+    async def __call__(self, make_request, bot, method):
+        with span(f"tg.{type(method).__name__}"):
+            return await make_request(bot, method)
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from cachetools import LRUCache, TTLCache
+
+from timezones import DEFAULT_TIMEZONE
+
+PROFILE_CACHE_SIZE = 100_000
+# Кэш у каждой копии бота свой: пояс или таблицу, изменённые через другую копию, эта увидит
+# не позже чем через PROFILE_CACHE_TTL секунд. 0 — без срока (одна копия бота).
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 60))
+
+
+class UserProfile(NamedTuple):
+    timezone: str = DEFAULT_TIMEZONE
+    timezone_confirmed: bool = False
+    sheet_link: Optional[str] = None
+    # Telegram не доставляет ему сообщения (заблокировал бота) или он в архиве
+    inactive: bool = False
+
+    @classmethod
+    def from_row(cls, row):
+        # row — (user_id, timezone, timezone_confirmed, sheet_link, inactive) или None, если юзера ещё нет
+        if row is None:
+            return cls()
+        _, timezone, confirmed, sheet_link, inactive = row
+        return cls(timezone or DEFAULT_TIMEZONE, bool(confirmed), sheet_link, bool(inactive))
+
+
+class UserProfileCache:
+    # Ограниченный LRU-кэш профилей, записи живут не дольше ttl. Любая инвалидация
+    # увеличивает version: чтение, начатое до неё, не сможет положить в кэш устаревший профиль.
+    def __init__(self, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, timer=time.monotonic):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer) if ttl else LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            profile = self._cache.get(user_id)
+            if profile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return profile
+
+    def peek(self, user_id):
+        # Без учёта в hits/misses
+        with self._lock:
+            return self._cache.get(user_id)
+
+    def missing(self, user_ids):
+        with self._lock:
+            return [user_id for user_id in user_ids if user_id not in self._cache]
+
+    def put_many(self, profiles, version):
+        with self._lock:
+            if version != self.version:
+                return
+            for user_id, profile in profiles.items():
+                self._cache[user_id] = profile
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.version += 1
+            self._cache.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+from metrics import UPDATE_QUEUE_WAIT_SECONDS
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Апдейты одного пользователя обрабатываются строго по очереди (FSM-диалоги HabitForm/EditForm
+# не гоняются сами с собой), апдейты разных пользователей — параллельно, но не больше
+# UPDATE_WORKERS обработчиков одновременно.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 64))
+# Сколько апдейтов может ждать и выполняться одновременно. Дальше polling перестаёт забирать
+# новые из Telegram (tasks_concurrency_limit), webhook держит запросы (max_concurrent_updates).
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", 1000))
+
+
+def _queue_key(data):
+    user = data.get("event_from_user")
+    if user is not None:
+        return user.id
+    chat = data.get("event_chat")
+    return chat.id if chat is not None else None
+
+
+class UserQueueMiddleware(BaseMiddleware):
+    # Внешний middleware на dp.update (после UserContextMiddleware aiogram, который кладёт
+    # event_from_user). Очередь пользователя — цепочка future: каждый апдейт ждёт, пока
+    # доработает предыдущий апдейт того же пользователя, затем берёт место в пуле.
+    # Порядок внутри цепочки — порядок, в котором апдейты пришли в dispatcher.
+    def __init__(self, workers=UPDATE_WORKERS):
+        self.workers = workers
+        self._slots = asyncio.Semaphore(workers)
+        self._tails = {}
+        self._depths = {}
+        self.running = 0
+
+    def register(self, dp):
+        # Dispatcher должен быть создан с disable_fsm=True. Свой FSMContextMiddleware aiogram
+        # регистрирует в Dispatcher.__init__, раньше любых наших outer middleware: он читал бы
+        # raw_state до очереди, и два быстрых апдейта пользователя маршрутизировались бы по
+        # состоянию "до обоих". Ставим его сразу за очередью — состояние читается в свой черёд.
+        dp.update.outer_middleware(self)
+        dp.update.outer_middleware(dp.fsm)
+
+    @property
+    def pending(self):
+        # Апдейты в очередях и в работе
+        return sum(self._depths.values())
+
+    @property
+    def users(self):
+        return len(self._depths)
+
+    @property
+    def max_depth(self):
+        return max(self._depths.values(), default=0)
+
+    def _resolve(self, key, done):
+        done.set_result(None)
+        # Если за нами уже встал следующий апдейт, хвост теперь его
+        if self._tails.get(key) is done:
+            del self._tails[key]
+
+    async def __call__(self, handler, event, data):
+        key = _queue_key(data)
+        if key is None:
+            # Не от пользователя (например, изменение статуса в канале) — порядок не важен
+            async with self._slots:
+                return await handler(event, data)
+
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        self._depths[key] = self._depths.get(key, 0) + 1
+        queued = time.perf_counter()
+        try:
+            with span("update.queue"):
+                if previous is not None:
+                    # shield: если этот апдейт отменят, future предыдущего не должен пострадать
+                    await asyncio.shield(previous)
+                await self._slots.acquire()
+            UPDATE_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued)
+            self.running += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.running -= 1
+                self._slots.release()
+        finally:
+            if previous is not None and not previous.done():
+                # Отменили, пока ждали очереди: следующие всё равно ждут предыдущий апдейт,
+                # и хвост освобождается только вместе с ним
+                previous.add_done_callback(lambda _: self._resolve(key, done))
+            else:
+                self._resolve(key, done)
+            depth = self._depths[key] - 1
+            if depth:
+                self._depths[key] = depth
+            else:
+                del self._depths[key]
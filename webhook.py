@@ -0,0 +1,154 @@
+import asyncio
+import hmac
+import logging
+import os
+import re
+import signal
+from dataclasses import dataclass
+from typing import Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Telegram на secret_token в setWebhook
+SECRET_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+@dataclass
+class WebhookConfig:
+    base_url: str
+    # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; без него апдейт
+    # мог бы подделать любой, кто узнал URL, — поэтому обязателен
+    secret: str
+    path: str = "/webhook"
+    host: str = "0.0.0.0"
+    port: int = 8080
+    # Сколько апдейтов обрабатываем одновременно; остальные ждут (Telegram повторит позже)
+    max_concurrent_updates: int = 100
+    # Сколько параллельных соединений Telegram откроет к нам (параметр setWebhook)
+    max_connections: int = 40
+    keepalive_timeout: float = 75.0
+    drain_timeout: float = 30.0
+
+    def __post_init__(self):
+        if not self.secret:
+            raise RuntimeError("WEBHOOK_SECRET не задан: без него webhook примет поддельные апдейты")
+        if not SECRET_RE.match(self.secret):
+            raise RuntimeError("WEBHOOK_SECRET: 1-256 символов A-Z, a-z, 0-9, _ и -")
+
+    @property
+    def url(self):
+        return self.base_url.rstrip("/") + self.path
+
+    @classmethod
+    def from_env(cls):
+        base_url = os.getenv("WEBHOOK_BASE_URL")
+        if not base_url:
+            raise RuntimeError("WEBHOOK_BASE_URL не задан")
+        return cls(
+            base_url=base_url,
+            secret=os.getenv("WEBHOOK_SECRET", ""),
+            path=os.getenv("WEBHOOK_PATH", cls.path),
+            host=os.getenv("WEBHOOK_HOST", cls.host),
+            port=int(os.getenv("WEBHOOK_PORT", cls.port)),
+            max_concurrent_updates=int(os.getenv("WEBHOOK_MAX_UPDATES", cls.max_concurrent_updates)),
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", cls.max_connections)),
+            keepalive_timeout=float(os.getenv("WEBHOOK_KEEPALIVE", cls.keepalive_timeout)),
+            drain_timeout=float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", cls.drain_timeout)),
+        )
+
+
+class BoundedWebhookHandler:
+    # Обработчик POST от Telegram: проверяет секрет, отвечает сразу и обрабатывает апдейт в фоне,
+    # но не больше max_concurrent_updates одновременно (нет слота — держим запрос, пока не
+    # освободится). При остановке новые запросы получают 503, а уже принятые доделываются (drain).
+    # Только публичное API Dispatcher — не зависит от внутренностей SimpleRequestHandler aiogram.
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret: str, max_concurrent_updates: int, **data):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret = secret
+        self.data = data
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._tasks = set()
+        self._accepting = True
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._accepting:
+            return web.Response(status=503, text="Shutting down")
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401, text="Unauthorized")
+        update = await request.json(loads=self.bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._feed_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+    async def _feed_update(self, update):
+        try:
+            result = await self.dispatcher.feed_raw_update(self.bot, update, **self.data)
+            # Ответ обработчика в виде метода API (например, answer без await) — отправляем сами
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(self.bot, result)
+        except Exception:
+            logger.exception("Failed to handle webhook update %s", update.get("update_id"))
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout: float):
+        self._accepting = False
+        pending = set(self._tasks)
+        if not pending:
+            return
+        logger.info("Draining %s in-flight updates", len(pending))
+        _, still_running = await asyncio.wait(pending, timeout=timeout)
+        if still_running:
+            logger.warning("%s updates did not finish in %.0fs, cancelling", len(still_running), timeout)
+            for task in still_running:
+                task.cancel()
+
+
+def _install_stop_signals(stop_event: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остаётся обычный KeyboardInterrupt
+            pass
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, config: WebhookConfig, stop_event: Optional[asyncio.Event] = None):
+    stop_event = stop_event or asyncio.Event()
+    _install_stop_signals(stop_event)
+
+    handler = BoundedWebhookHandler(dp, bot, config.secret, config.max_concurrent_updates)
+    app = web.Application()
+    app.router.add_route("POST", config.path, handler.handle)
+
+    runner = web.AppRunner(app, keepalive_timeout=config.keepalive_timeout)
+    await runner.setup()
+    site = web.TCPSite(runner, config.host, config.port)
+    await site.start()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    try:
+        await bot.set_webhook(
+            config.url,
+            secret_token=config.secret,
+            max_connections=config.max_connections,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info("Webhook server listening on %s:%s, url %s", config.host, config.port, config.url)
+        await stop_event.wait()
+    finally:
+        await handler.drain(config.drain_timeout)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await runner.cleanup()